@@ -15,4 +15,41 @@ CONTINUE_TRAINING = (
 
 OUTPUT_MODEL_SUMMARY = (
     'Prints the model summary to console.'
-)
\ No newline at end of file
+)
+
+EMBED = (
+    'Streams the sample embeddings of a trained encoder to '
+    'numbered .npy shards (embeddings-*.npy, sample_ids-*.npy). '
+    'Rerunning the command resumes after the last complete shard, '
+    'the encoder and table must be the same as in the first run.'
+)
+
+OUTPUT_DIR = (
+    'Directory the embedding shards are written to.'
+)
+
+ENCODER_PATH = (
+    'Path of the trained encoder. By default base_model_path '
+    'of the config is used.'
+)
+
+BATCH_SIZE = (
+    'Number of samples per prediction batch. By default batch_size '
+    'of the config is used.'
+)
+
+SHARD_SIZE = (
+    'Number of samples per output shard, rounded up to a multiple of '
+    'the batch size.'
+)
+
+LOCAL_WORKERS = (
+    'Runs the command on a MultiWorkerMirroredStrategy cluster of this '
+    'many CPU workers on this machine, i.e. to test distributed training.'
+)
+
+PROFILE = (
+    'Records the step time (input wait and compute), samples and ASVs per '
+    'second, padding efficiency and memory of the training to TensorBoard '
+    'and a profile.json summary in the logdir of the config.'
+)
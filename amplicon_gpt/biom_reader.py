@@ -0,0 +1,83 @@
+import h5py
+import numpy as np
+from biom import load_table
+
+def read_ids(table_path, axis='sample'):
+    """
+    Returns the sample or observation IDs of a BIOM table, without reading
+    its matrix if it is HDF5 (JSON/TSV tables are loaded).
+    """
+    if not h5py.is_hdf5(table_path):
+        return load_table(table_path).ids(axis=axis).astype(str)
+    with h5py.File(table_path, 'r') as f:
+        return f[f'{axis}/ids'].asstr()[:].astype(str)
+
+def _sample_positions(ids, sample_ids):
+    if sample_ids is None:
+        return np.arange(len(ids))
+    return np.flatnonzero(np.isin(ids, np.asarray(sample_ids, dtype=str)))
+
+def iter_sample_chunks(table_path, sample_ids=None, min_count=0, chunk_size=4096):
+    """
+    Reads the requested samples of an HDF5 BIOM table, chunk_size table
+    columns at a time, and yields their observations whose count is greater
+    than min_count. Only the chunks containing requested samples are read
+    and the table is never held in memory.
+
+    Yields:
+        (positions, row_splits, indices, counts) of each chunk, where
+        positions are the table columns of the yielded samples (in table
+        order) and row_splits is relative to indices/counts of the chunk
+    """
+    with h5py.File(table_path, 'r') as f:
+        # biom stores the matrix twice, sample/matrix is its csc layout
+        matrix = f['sample/matrix']
+        indptr = matrix['indptr'][:]
+        positions = _sample_positions(f['sample/ids'].asstr()[:].astype(str), sample_ids)
+        for start in range(0, len(indptr) - 1, chunk_size):
+            chunk = positions[(positions >= start) & (positions < start + chunk_size)]
+            if not len(chunk):
+                continue
+            first, last = indptr[chunk[0]], indptr[chunk[-1] + 1]
+            indices = matrix['indices'][first:last]
+            data = matrix['data'][first:last]
+
+            # entries of the requested columns only
+            sizes = indptr[chunk + 1] - indptr[chunk]
+            offsets = np.repeat(indptr[chunk] - first - np.concatenate([[0], np.cumsum(sizes)[:-1]]), sizes)
+            entries = np.arange(sizes.sum()) + offsets
+            columns = np.repeat(np.arange(len(chunk)), sizes)
+            indices, data = indices[entries], data[entries]
+
+            keep = data > min_count
+            columns, indices, data = columns[keep], indices[keep], data[keep]
+            order = np.lexsort((indices, columns))
+            row_splits = np.searchsorted(columns[order], np.arange(len(chunk) + 1))
+            yield chunk, row_splits, indices[order].astype(np.int32), data[order].astype(np.float32)
+
+def read_samples(table_path, sample_ids=None, min_count=0, chunk_size=4096):
+    """
+    CSR style layout of the observations of the requested samples (in table
+    order) whose count is greater than min_count, read chunk by chunk.
+        sample_ids: (n_samples,)
+        observation_ids: (n_obs,)
+        row_splits: (n_samples + 1,) start/end of each sample in indices
+        indices: observation indices of each sample
+        counts: count of each entry in indices
+    """
+    ids = read_ids(table_path)
+    positions, sizes, indices, counts = [], [], [], []
+    for chunk, row_splits, chunk_indices, chunk_counts in iter_sample_chunks(
+            table_path, sample_ids, min_count, chunk_size):
+        positions.append(chunk)
+        sizes.append(np.diff(row_splits))
+        indices.append(chunk_indices)
+        counts.append(chunk_counts)
+    positions = np.concatenate(positions) if positions else np.zeros(0, dtype=np.int64)
+    return {
+        'sample_ids': ids[positions],
+        'observation_ids': read_ids(table_path, axis='observation'),
+        'row_splits': np.concatenate([[0], np.cumsum(np.concatenate(sizes or [[]]))]).astype(np.int64),
+        'indices': np.concatenate(indices or [[]]).astype(np.int32),
+        'counts': np.concatenate(counts or [[]]).astype(np.float32)
+    }
@@ -0,0 +1,121 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+# bump whenever the layout or encoding of any artifact changes
+CACHE_VERSION = 2
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'amplicon_gpt')
+MANIFEST = 'manifest.json'
+
+_file_hashes = {}
+
+def hash_file(path, chunk_size=1 << 24):
+    """
+    Returns the sha256 of the file content. Hashes are memoized on
+    (path, size, mtime) so that multiple loaders only read the file once.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    memo_key = (path, stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_hashes:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha.update(chunk)
+        _file_hashes[memo_key] = sha.hexdigest()
+    return _file_hashes[memo_key]
+
+def cache_key(*paths, **params):
+    """
+    Key of an artifact built from the content of paths (i.e. table, tree)
+    and the parameters used to create it (i.e. seq_len).
+    """
+    sha = hashlib.sha256()
+    sha.update(f'v{CACHE_VERSION}'.encode())
+    for path in paths:
+        sha.update(hash_file(path).encode())
+    sha.update(json.dumps(params, sort_keys=True).encode())
+    return sha.hexdigest()[:24]
+
+def _artifact_path(cache_dir, name, key):
+    return os.path.join(cache_dir, name, key)
+
+def _read_artifact(path, mmap_mode=None):
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    return {array: np.load(os.path.join(path, f'{array}.npy'), mmap_mode=mmap_mode)
+            for array in manifest['arrays']}
+
+def _write_artifact(cache_dir, name, key, arrays, inputs, params):
+    root = os.path.join(cache_dir, name)
+    os.makedirs(root, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=root, prefix='.tmp-')
+    for array, value in arrays.items():
+        array_path = os.path.join(tmp_path, f'{array}.npy')
+        if callable(value):
+            # large arrays are streamed to disk by the producer
+            value(array_path)
+        else:
+            np.save(array_path, value, allow_pickle=False)
+    with open(os.path.join(tmp_path, MANIFEST), 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'arrays': list(arrays), 'inputs': inputs, 'params': params}, f)
+    try:
+        os.replace(tmp_path, _artifact_path(cache_dir, name, key))
+    except OSError:
+        # another process finished writing the same artifact first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+def _input_paths(paths):
+    return [os.path.abspath(path) for path in paths]
+
+def _remove_stale(cache_dir, name, key, inputs, params):
+    """
+    Removes the artifacts `name` made by an older CACHE_VERSION, or from
+    the same input paths and params (whose content has since changed).
+    Artifacts of other inputs or params are kept.
+    """
+    root = os.path.join(cache_dir, name)
+    params = json.dumps(params, sort_keys=True)
+    for entry in os.listdir(root):
+        if entry == key or entry.startswith('.tmp-'):
+            continue
+        try:
+            with open(os.path.join(root, entry, MANIFEST)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if (manifest.get('version') != CACHE_VERSION or
+                (manifest.get('inputs') == inputs and
+                 json.dumps(manifest.get('params'), sort_keys=True) == params)):
+            shutil.rmtree(os.path.join(root, entry), ignore_errors=True)
+
+def load_artifact(name, compute, paths, params, cache_dir=None, mmap_mode=None):
+    """
+    Returns the artifact `name` keyed by the content of paths and params.
+    On a miss compute() is called and must return a dict of numpy arrays,
+    which is written to the cache (replacing the artifact of older
+    versions of the same files and params) before being read back. Instead of an array, a value can be
+    a callable taking the .npy path to write, for arrays that should not
+    be held in memory.
+
+    Args:
+        name: artifact name, i.e. 'sequences'
+        compute: callable returning {array_name: np.ndarray or writer}
+        paths: files the artifact depends on
+        params: json serializable parameters the artifact depends on
+        cache_dir: root directory of the cache
+        mmap_mode: passed to np.load
+    """
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+    key = cache_key(*paths, **params)
+    path = _artifact_path(cache_dir, name, key)
+    if not os.path.exists(os.path.join(path, MANIFEST)):
+        print(f'building {name} cache...')
+        inputs = _input_paths(paths)
+        _write_artifact(cache_dir, name, key, compute(), inputs, params)
+        _remove_stale(cache_dir, name, key, inputs, params)
+    return _read_artifact(path, mmap_mode=mmap_mode)
@@ -1,15 +1,19 @@
 import os
+import collections
+import shutil
+import tempfile
+import threading
+import traceback
 import scipy
 import numpy as np
 import tensorflow as tf
-import matplotlib.pyplot as plt
-import sklearn
+from matplotlib.figure import Figure
 from tensorboard.plugins import projector
-from amplicon_gpt.losses import _pairwise_distances
-from skbio.stats.distance import DistanceMatrix
 import skbio.stats.ordination
 from unifrac import unweighted
-from biom import load_table
+from amplicon_gpt.biom_reader import read_ids
+from amplicon_gpt.embedding_distances import compare_distances, embedding_pcoa, randomized_pcoa
+from amplicon_gpt.distributed import worker_save_path
 
 def mean_confidence_interval(data, confidence=0.95):
     a = 1.0 * np.array(data)
@@ -18,10 +22,112 @@ def mean_confidence_interval(data, confidence=0.95):
     h = se * scipy.stats.t.ppf((1 + confidence) / 2., n-1)
     return m, h
 
+class StreamingMAE:
+    """
+    Mean absolute error with its confidence interval, updated batch by batch
+    (running mean and variance of the absolute errors).
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, labels, predictions):
+        errors = np.abs(labels - predictions).ravel()
+        n = errors.size
+        if n == 0:
+            return
+        mean = errors.mean()
+        delta = mean - self.mean
+        total = self.count + n
+        self.m2 += np.sum((errors - mean) ** 2) + delta ** 2 * self.count * n / total
+        self.mean += delta * n / total
+        self.count = total
+
+    def result(self, confidence=0.95):
+        """
+        Returns the mean and the half width of its confidence interval, the
+        same as mean_confidence_interval on all the errors.
+        """
+        se = np.sqrt(self.m2 / (self.count - 1) / self.count)
+        h = se * scipy.stats.t.ppf((1 + confidence) / 2., self.count - 1)
+        return self.mean, h
+
+class StreamingCurves:
+    """
+    Precision recall and ROC curves of scores in [0, 1], updated batch by
+    batch by counting the positives and negatives of num_thresholds equal
+    width score bins (the thresholds of tf.keras.metrics.AUC).
+    """
+    def __init__(self, num_thresholds=200):
+        self.num_thresholds = num_thresholds
+        self.positives = np.zeros(num_thresholds, dtype=np.int64)
+        self.negatives = np.zeros(num_thresholds, dtype=np.int64)
+
+    def update(self, labels, predictions):
+        bins = np.clip((predictions.ravel() * self.num_thresholds).astype(np.int64),
+                       0, self.num_thresholds - 1)
+        positive = labels.ravel() > 0.5
+        self.positives += np.bincount(bins[positive], minlength=self.num_thresholds)
+        self.negatives += np.bincount(bins[~positive], minlength=self.num_thresholds)
+
+    def result(self):
+        """
+        Returns precision, recall (true positive rate) and false positive
+        rate from the highest to the lowest threshold.
+        """
+        tp = np.concatenate([[0], np.cumsum(self.positives[::-1])])
+        fp = np.concatenate([[0], np.cumsum(self.negatives[::-1])])
+        recall = tp / max(tp[-1], 1)
+        fpr = fp / max(fp[-1], 1)
+        precision = np.where(tp + fp > 0, tp / np.maximum(tp + fp, 1), 1.0)
+        return precision, recall, fpr
+
+def _grow(buffer, size, rows):
+    if size + len(rows) <= len(buffer):
+        return buffer
+    capacity = max(2 * len(buffer), size + len(rows))
+    grown = np.empty((capacity,) + buffer.shape[1:], dtype=buffer.dtype)
+    grown[:size] = buffer[:size]
+    return grown
+
+def evaluate_dataset(model, dataset, metrics=()):
+    """
+    Streams the (inputs, labels) batches of dataset once through model so
+    the predictions stay aligned with the labels (the input pipeline runs
+    once), collects both in preallocated arrays (sized from the dataset
+    cardinality when known) and updates each metric batch by batch.
+    Returns labels, predictions with a trailing axis of one squeezed.
+    """
+    labels, predictions, size = None, None, 0
+    num_batches = int(dataset.cardinality())
+    for x, y in dataset:
+        y = np.asarray(y)
+        y = y.reshape(len(y), -1)
+        pred = np.asarray(model.predict_on_batch(x), dtype=np.float32)
+        pred = pred.reshape(len(pred), -1)
+        if labels is None:
+            capacity = len(y) * (num_batches if num_batches > 0 else 16)
+            labels = np.empty((capacity, y.shape[1]), dtype=y.dtype)
+            predictions = np.empty((capacity, pred.shape[1]), dtype=np.float32)
+        labels = _grow(labels, size, y)
+        predictions = _grow(predictions, size, pred)
+        labels[size:size + len(y)] = y
+        predictions[size:size + len(pred)] = pred
+        size += len(y)
+        for metric in metrics:
+            metric.update(y, pred)
+    if labels is None:
+        return np.empty(0), np.empty(0, dtype=np.float32)
+    labels, predictions = labels[:size], predictions[:size]
+    if labels.shape[1] == 1:
+        labels, predictions = labels[:, 0], predictions[:, 0]
+    return labels, predictions
+
 def mean_absolute_error(dataset, model, fname, s_type):
-    pred_age = tf.squeeze(model.predict(dataset)).numpy()
-    true_age = np.concatenate([tf.squeeze(ys).numpy() for (_, ys) in dataset])
-    mae, h = mean_confidence_interval(np.abs(true_age - pred_age))
+    mae_metric = StreamingMAE()
+    true_age, pred_age = evaluate_dataset(model, dataset, [mae_metric])
+    mae, h = mae_metric.result()
     
     min_x = 15
     max_x = np.max(true_age) + 2
@@ -30,22 +136,144 @@ def mean_absolute_error(dataset, model, fname, s_type):
     xx = np.linspace(min_x, max_x, 1000)
     yy = p(xx)
     
-    plt.figure(figsize=(4, 4))
-    plt.rcParams.update({
-        'text.usetex': True
-    })
-    plt.subplot(1,1,1)
-    plt.scatter(true_age, pred_age, 7, marker='.', c='grey', alpha=0.5)
-    plt.plot(xx, yy)
-    # plt.xlim(min_x,max_x)
-    # plt.ylim(min_x,max_x)
+    # the Figure API (unlike pyplot) can be used from the evaluation thread,
+    # mathtext renders the title without a LaTeX install
+    fig = Figure(figsize=(4, 4))
+    ax = fig.add_subplot(1, 1, 1)
+    ax.scatter(true_age, pred_age, 7, marker='.', c='grey', alpha=0.5)
+    ax.plot(xx, yy)
     mae, h = '%.4g' % mae, '%.4g' % h
-    plt.xlabel('Reported age')
-    plt.ylabel('Predicted age')
-    plt.title(f"""{s_type} microbiota
-          MAE: ${mae} \pm {h}$""")
-    plt.savefig(fname)
-    plt.close()
+    ax.set_xlabel('Reported age')
+    ax.set_ylabel('Predicted age')
+    ax.set_title(f"{s_type} microbiota\nMAE: ${mae} \\pm {h}$")
+    fig.savefig(fname)
+
+def plot_prc(fname, name, precision, recall, **kwargs):
+    fig = Figure()
+    ax = fig.add_subplot(1, 1, 1)
+    ax.plot(precision, recall, label=name, linewidth=2, **kwargs)
+    ax.set_xlabel('Precision')
+    ax.set_ylabel('Recall')
+    ax.grid(True)
+    ax.set_aspect('equal')
+    fig.savefig(fname)
+
+def plot_roc(fname, name, fp, tp, **kwargs):
+    fig = Figure()
+    ax = fig.add_subplot(1, 1, 1)
+    ax.plot(100*fp, 100*tp, label=name, linewidth=2, **kwargs)
+    ax.set_xlabel('False positives [%]')
+    ax.set_ylabel('True positives [%]')
+    ax.set_xlim([-0.5,20])
+    ax.set_ylim([80,100.5])
+    ax.grid(True)
+    ax.set_aspect('equal')
+    fig.savefig(fname)
+
+def plot_curves(dataset, model, prc_fname, roc_fname):
+    curves = StreamingCurves()
+    evaluate_dataset(model, dataset, [curves])
+    precision, recall, fpr = curves.result()
+    plot_prc(prc_fname, 'AUC', precision, recall)
+    plot_roc(roc_fname, 'ROC', fpr, recall)
+
+class AsyncEvaluator:
+    """
+    Runs the evaluations of the callbacks on a background thread so that
+    training goes on meanwhile. Each model is loaded once from a saved
+    snapshot and afterwards only updated with the weights of each
+    evaluation. At most one evaluation runs at a time and each callback
+    has at most one waiting, a newer evaluation replaces the waiting one.
+    """
+    def __init__(self):
+        self.pending = collections.OrderedDict()
+        self.running = False
+        self.models = {}
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, job_key, model_key, weights, evaluate, snapshot_path=None):
+        """
+        Queues evaluate(model) with the weights of the model model_key, the
+        model is loaded from snapshot_path (removed afterwards) if given.
+        Returns True if a waiting evaluation of job_key was replaced.
+        """
+        with self.condition:
+            replaced = self.pending.pop(job_key, None)
+            if replaced is not None and snapshot_path is None:
+                # the replaced evaluation would have loaded the model
+                snapshot_path = replaced[3]
+            self.pending[job_key] = (model_key, weights, evaluate, snapshot_path)
+            self.condition.notify_all()
+        return replaced is not None
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                _, job = self.pending.popitem(last=False)
+                self.running = True
+            model_key, weights, evaluate, snapshot_path = job
+            try:
+                if snapshot_path is not None:
+                    self.models[model_key] = tf.keras.models.load_model(snapshot_path, compile=False)
+                model = self.models[model_key]
+                model.set_weights(weights)
+                evaluate(model)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                if snapshot_path is not None:
+                    shutil.rmtree(os.path.dirname(snapshot_path), ignore_errors=True)
+                with self.condition:
+                    self.running = False
+                    self.condition.notify_all()
+
+    def join(self):
+        """
+        Waits for the waiting and running evaluations.
+        """
+        with self.condition:
+            while self.pending or self.running:
+                self.condition.wait()
+
+_evaluator = None
+
+def get_evaluator():
+    global _evaluator
+    if _evaluator is None:
+        _evaluator = AsyncEvaluator()
+    return _evaluator
+
+class AsyncCallback(tf.keras.callbacks.Callback):
+    """
+    Callback whose evaluations run on the shared AsyncEvaluator. The
+    training thread only copies the weights (and saves the model once),
+    training end waits for the last evaluation. The evaluator's model is
+    not compiled, checkpoints are saved on the training thread.
+    """
+    def __init__(self):
+        super().__init__()
+        self.snapshot_saved = False
+
+    def _snapshot_path(self):
+        if self.snapshot_saved:
+            return None
+        path = os.path.join(tempfile.mkdtemp(), 'snapshot.keras')
+        self.model.save(path, save_format='keras')
+        return path
+
+    def _submit(self, evaluate):
+        snapshot_path = self._snapshot_path()
+        self.snapshot_saved = True
+        if get_evaluator().submit(id(self), id(self.model), self.model.get_weights(),
+                                  evaluate, snapshot_path):
+            print('previous evaluation still waiting, replaced by the current one')
+
+    def on_train_end(self, logs=None):
+        get_evaluator().join()
 
 class BaseCheckpoint(tf.keras.callbacks.Callback):
     def __init__(self, root_path, dataset, s_type, steps_per_checkpoint=5, **kwargs):
@@ -63,7 +291,7 @@ class BaseCheckpoint(tf.keras.callbacks.Callback):
         if not os.path.exists(self.figure_path):
             os.makedirs(self.figure_path)
 
-class MAE_Scatter(tf.keras.callbacks.Callback):
+class MAE_Scatter(AsyncCallback):
     def __init__(self, root_path, dataset, s_type, title, steps_per_checkpoint=5, **kwargs):
         super().__init__()
         self.dataset = dataset
@@ -79,22 +307,39 @@ class MAE_Scatter(tf.keras.callbacks.Callback):
         if not os.path.exists(self.figure_path):
             os.makedirs(self.figure_path)
 
+    def _evaluate(self, model, fname):
+        mean_absolute_error(self.dataset, model, fname=fname, s_type=self.s_type)
+
     def on_epoch_end(self, epoch, logs=None):
         if self.cur_step % 5 == 0:
             self.total_mae += 1
+            fname = os.path.join(self.figure_path, f'MAE-{self.title}-{self.total_mae}.png')
             self.model.save(self.model_path, save_format='keras')
-            mean_absolute_error(self.dataset, self.model, fname=os.path.join(self.figure_path,
-                                f'MAE-{self.title}-{self.total_mae}.png'), s_type=self.s_type)
+            self._submit(lambda model: self._evaluate(model, fname))
             self.cur_step = 0
         self.cur_step += 1
         return super().on_epoch_end(epoch, logs)
     
-class ProjectEncoder(tf.keras.callbacks.Callback):
-    def __init__(self, data, model_path, pred_pcoa_path, true_pcoa_path, table_path, tree_path, num_samples, batch_size, **kwargs):
+class ProjectEncoder(AsyncCallback):
+    def __init__(self, data, model_path, pred_pcoa_path, true_pcoa_path, table_path, tree_path, num_samples, batch_size,
+                 distances=None, get_inputs=None, seed=None, pcoa_dimensions=3, chief=True, **kwargs):
+        """
+        Logs the PCoA of the predicted and the true unifrac distances of
+        num_samples samples of data (the sequencing dataset in table order,
+        get_inputs maps its ragged batches to the model inputs). The
+        samples are chosen once, their inputs are cached and only they are
+        predicted. The true PCoA is computed once from distances (see
+        data_utils.get_unifrac_distances) or from table_path and tree_path.
+        With distances each log also prints the correlation of the
+        predicted and the true distances.
+
+        In a distributed run every worker needs the callback (the snapshot
+        save is collective), only the chief (chief=True) evaluates.
+        """
         super().__init__()
+        self.chief = chief
         self.batch_size = batch_size
-        self.data = data
-        self.table = load_table(table_path)
+        self.sample_ids = read_ids(table_path)
         self.model_path = model_path
         self.cur_step = 0
         self.pred_pcoa_path = pred_pcoa_path
@@ -102,34 +347,70 @@ class ProjectEncoder(tf.keras.callbacks.Callback):
         self.table_path = table_path
         self.tree_path = tree_path
         self.num_samples = num_samples
+        self.distances = distances
+        self.seed = seed
+        self.pcoa_dimensions = pcoa_dimensions
+        self.true_pcoa = None
+        rng = np.random.default_rng(seed)
+        num_samples = min(num_samples, len(self.sample_ids))
+        self.sample_indices = np.sort(rng.choice(len(self.sample_ids), num_samples, replace=False))
+        selected = tf.constant(self.sample_indices, dtype=tf.int64)
+        data = (data
+                .enumerate()
+                .filter(lambda i, _: tf.reduce_any(tf.equal(i, selected)))
+                .map(lambda _, x: x)
+                .ragged_batch(32))
+        if get_inputs is not None:
+            data = data.map(get_inputs)
+        self.data = data.cache()
+
+    def _snapshot_path(self):
+        if not self.chief:
+            # the snapshot save is collective, take part in the chief's
+            if not self.snapshot_saved:
+                with worker_save_path('snapshot.keras', chief=False) as path:
+                    self.model.save(path, save_format='keras')
+                self.snapshot_saved = True
+            return None
+        return super()._snapshot_path()
+
+    def _get_true_pcoa(self):
+        sample_ids = self.sample_ids[self.sample_indices]
+        if self.distances is not None:
+            return randomized_pcoa(self.distances, self.sample_indices, sample_ids,
+                                   number_of_dimensions=self.pcoa_dimensions, seed=self.seed)
+        true_unifrac_distances = unweighted(self.table_path, self.tree_path).filter(sample_ids)
+        return skbio.stats.ordination.pcoa(true_unifrac_distances, method='fsvd',
+                                           number_of_dimensions=self.pcoa_dimensions, inplace=True)
 
-    def _log_epoch_data(self):
+    def _log_epoch_data(self, model):
         tf.print('loggin data...')
-        self.model.save(os.path.join(self.model_path, 'encoder.keras'), save_format='keras')
-        total_samples = int(self.table.shape[1] / self.batch_size) * self.batch_size
-        
-        sample_indices = np.arange(total_samples)
-        np.random.shuffle(sample_indices)
-        sample_indices = sample_indices[:self.num_samples]
-        pred = self.model.predict(self.data)
-
-        pred = tf.gather(pred, sample_indices)
-        distances = _pairwise_distances(pred, squared=False)
-        pred_unifrac_distances = DistanceMatrix(distances.numpy(), self.table.ids(axis='sample')[sample_indices], validate=False)
-        pred_pcoa = skbio.stats.ordination.pcoa(pred_unifrac_distances, method='fsvd', number_of_dimensions=3, inplace=True)
+        pred = np.concatenate([model(x, training=False).numpy() for x in self.data])
+
+        pred_pcoa = embedding_pcoa(pred, self.sample_ids[self.sample_indices], number_of_dimensions=self.pcoa_dimensions)
         pred_pcoa.write(self.pred_pcoa_path)
+        if self.distances is not None:
+            print(compare_distances(pred, self.distances, self.sample_indices))
 
-        true_unifrac_distances = unweighted(self.table_path, self.tree_path).filter(self.table.ids(axis='sample')[sample_indices])
-        true_pcoa = skbio.stats.ordination.pcoa(true_unifrac_distances, method='fsvd', number_of_dimensions=3, inplace=True)
-        true_pcoa.write(self.true_pcoa_path)
+        if self.true_pcoa is None:
+            # the samples do not change, neither does their true PCoA
+            self.true_pcoa = self._get_true_pcoa()
+            self.true_pcoa.write(self.true_pcoa_path)
 
     def on_epoch_end(self, epoch, logs=None):
         if self.cur_step % 5 == 0:
-            self._log_epoch_data()
+            # the checkpoint is saved here so that it keeps the optimizer
+            # state, the evaluator's copy has none (the save is collective)
+            with worker_save_path(os.path.join(self.model_path, 'encoder.keras'), self.chief) as path:
+                self.model.save(path, save_format='keras')
+            if self.chief:
+                self._submit(self._log_epoch_data)
+            else:
+                self._snapshot_path()
             self.cur_step = 0
         self.cur_step += 1
     
-class Accuracy(tf.keras.callbacks.Callback):
+class Accuracy(AsyncCallback):
     def __init__(self, root_path, dataset, s_type, steps_per_checkpoint=5, **kwargs):
         super().__init__()
         self.dataset = dataset
@@ -145,47 +426,17 @@ class Accuracy(tf.keras.callbacks.Callback):
         if not os.path.exists(self.figure_path):
             os.makedirs(self.figure_path)
 
+    def _evaluate(self, model, total_mae):
+        plot_curves(self.dataset, model,
+                    os.path.join(self.figure_path, f'auc-{total_mae}.png'),
+                    os.path.join(self.figure_path, f'roc-{total_mae}.png'))
+
     def on_epoch_end(self, epoch, logs=None):
         if self.cur_step % self.steps_per_checkpoint == 0:
             self.total_mae += 1
+            total_mae = self.total_mae
             self.model.save(self.model_path, save_format='keras')
-            
-            pred_cat = tf.squeeze(self.model.predict(self.dataset)).numpy()
-            true_cat = np.concatenate([tf.squeeze(ys).numpy() for (_, ys) in self.dataset])
-            
-
-            def plot_prc(name, labels, predictions, **kwargs):
-                precision, recall, _ = sklearn.metrics.precision_recall_curve(labels, predictions)
-
-                plt.plot(precision, recall, label=name, linewidth=2, **kwargs)
-                plt.xlabel('Precision')
-                plt.ylabel('Recall')
-                plt.grid(True)
-                ax = plt.gca()
-                ax.set_aspect('equal')
-                fname=os.path.join(self.figure_path,
-                                f'auc-{self.total_mae}.png')
-                plt.savefig(fname)
-                plt.close('all')
-
-            plot_prc('AUC', true_cat, pred_cat)
-
-            def plot_roc(name, labels, predictions, **kwargs):
-                fp, tp, _ = sklearn.metrics.roc_curve(labels, predictions)
-
-                plt.plot(100*fp, 100*tp, label=name, linewidth=2, **kwargs)
-                plt.xlabel('False positives [%]')
-                plt.ylabel('True positives [%]')
-                plt.xlim([-0.5,20])
-                plt.ylim([80,100.5])
-                plt.grid(True)
-                ax = plt.gca()
-                ax.set_aspect('equal')
-                fname=os.path.join(self.figure_path,
-                                f'roc-{self.total_mae}.png')
-                plt.savefig(fname)
-            plot_roc('ROC', true_cat, pred_cat)
-
+            self._submit(lambda model: self._evaluate(model, total_mae))
             self.cur_step = 0
         self.cur_step += 1
         return super().on_epoch_end(epoch, logs)
\ No newline at end of file
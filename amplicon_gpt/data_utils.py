@@ -1,165 +1,506 @@
+import os
+import json
+from collections import namedtuple
+import h5py
 import numpy as np
 import pandas as pd
 import tensorflow as tf
 from biom import load_table
-from unifrac import unweighted
+from unifrac import unweighted_to_file
+from amplicon_gpt.cache import load_artifact
+from amplicon_gpt.biom_reader import read_samples
+from amplicon_gpt.phylogeny import load_batch_unifrac
 
-def create_base_sequencing_data(table_path, tree_path, batch_size, max_num_per_seq, seq_len, **kwargs):
+NUCLEOTIDES = b'ACGT'
+
+# sequences: (n_obs, seq_len) token matrix shared by all samples
+# samples: (n_samples, None) ragged observation indices of each sample
+# counts: (n_samples, None) ragged counts of each observation in samples
+SequencingData = namedtuple('SequencingData', ['sequences', 'samples', 'counts'], defaults=(None,))
+
+# byte -> token lookup, voc is <MASK> := 0, A := 1, C := 2, G := 3, T := 4
+_NUCLEOTIDE_LOOKUP = np.zeros(256, dtype=np.uint8)
+_NUCLEOTIDE_LOOKUP[np.frombuffer(NUCLEOTIDES, dtype=np.uint8)] = np.arange(1, len(NUCLEOTIDES) + 1)
+
+def encode_sequences(o_ids, seq_len):
+    """
+    Encodes every ASV sequence in a single pass.
+    Sequences are truncated/zero padded to seq_len and any character that
+    is not a nucleotide is mapped to the mask token.
+
+    Returns:
+        uint8 token matrix of shape (len(o_ids), seq_len)
+    """
+    o_ids = np.asarray(o_ids, dtype=np.bytes_).astype(f'S{seq_len}')
+    buffer = np.frombuffer(o_ids.tobytes(), dtype=np.uint8).reshape(-1, seq_len)
+    return _NUCLEOTIDE_LOOKUP[buffer]
+
+def _get_sample_splits(table, min_count=0):
+    """
+    CSR style layout of the observations of each sample (in table order)
+    whose count is greater than min_count.
+    """
+    matrix = table.matrix_data.tocsc()
+    matrix.sort_indices()
+    keep = matrix.data > min_count
+    row_splits = np.concatenate([[0], np.cumsum(keep)])[matrix.indptr]
+    indices = matrix.indices[keep].astype(np.int32)
+    counts = matrix.data[keep].astype(np.float32)
+    return row_splits, indices, counts
+
+def get_sample_indices(table, min_count=0):
+    """
+    Returns a list with the (sorted) observation indices of each sample
+    whose count is greater than min_count.
+    """
+    row_splits, indices, _ = _get_sample_splits(table, min_count)
+    return np.split(indices, row_splits[1:-1])
+
+def encode_table(table, seq_len, min_count=0):
+    """
+    Encodes all observation IDs of table once and returns the per sample
+    token matrices, i.e. a slice of rows of the shared token matrix.
+    """
+    sequences = encode_sequences(table.ids(axis='observation'), seq_len)
+    return [sequences[sample] for sample in get_sample_indices(table, min_count)]
+
+def _load_samples(table_path, min_count=0, cache_dir=None):
+    # all samples are cached on purpose, the sample positions index the
+    # cached distance matrix and phylogeny, and the commands select their
+    # samples from the same entry (see get_samples)
+    def compute():
+        if h5py.is_hdf5(table_path):
+            return read_samples(table_path, min_count=min_count)
+        table = load_table(table_path)
+        row_splits, indices, counts = _get_sample_splits(table, min_count)
+        return {
+            'sample_ids': table.ids(axis='sample').astype(str),
+            'observation_ids': table.ids(axis='observation').astype(str),
+            'row_splits': row_splits,
+            'indices': indices,
+            'counts': counts
+        }
+    return load_artifact('samples', compute, [table_path], {'min_count': min_count}, cache_dir)
+
+def load_encoded_table(table_path, seq_len, min_count=0, cache_dir=None, **kwargs):
+    """
+    Returns the cached encoding of the table, the table is only read
+    when the table, seq_len or min_count changed.
+        sample_ids: (n_samples,)
+        observation_ids: (n_obs,)
+        sequences: (n_obs, seq_len) uint8 token matrix
+        row_splits: (n_samples + 1,) start/end of each sample in indices
+        indices: observation indices of each sample
+        counts: count of each entry in indices
+    """
+    encoded = _load_samples(table_path, min_count, cache_dir)
+    encode = lambda: {'sequences': encode_sequences(encoded['observation_ids'], seq_len)}
+    encoded.update(load_artifact('sequences', encode, [table_path], {'seq_len': seq_len}, cache_dir))
+    return encoded
+
+def _write_unifrac_distances(table_path, tree_path, sample_ids, block_elements=1 << 26):
+    """
+    Streams the unweighted unifrac distances into a float32 .npy file in
+    table sample order without holding the N x N matrix in memory.
+    """
+    def write(path):
+        h5_path = f'{path}.h5'
+        unweighted_to_file(table_path, tree_path, h5_path, pcoa_dims=0, format='hdf5_fp32')
+        try:
+            with h5py.File(h5_path, 'r') as f:
+                order = np.asarray(f['order'][:]).astype(str)
+                position = dict(zip(order, range(len(order))))
+                perm = np.array([position[id] for id in sample_ids])
+                identity = np.array_equal(perm, np.arange(len(perm)))
+                distances = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32,
+                                                      shape=(len(perm), len(perm)))
+                block_size = max(1, block_elements // len(perm))
+                for start in range(0, len(perm), block_size):
+                    rows = perm[start:start + block_size]
+                    if identity:
+                        block = f['matrix'][rows[0]:rows[-1] + 1]
+                    else:
+                        block = f['matrix'][np.sort(rows)][np.argsort(np.argsort(rows))][:, perm]
+                    distances[start:start + len(rows)] = block
+                distances.flush()
+                del distances
+        finally:
+            os.remove(h5_path)
+    return write
+
+def load_unifrac_distances(table_path, tree_path, cache_dir=None, **kwargs):
+    """
+    Returns the cached unweighted unifrac distance matrix of the table
+    with rows/columns in table sample order. The matrix is stored once as
+    float32 and returned as a read only memory map, use
+    gather_distances to read the submatrix of a batch.
+    """
+    def compute():
+        sample_ids = _load_samples(table_path, cache_dir=cache_dir)['sample_ids']
+        return {'distances': _write_unifrac_distances(table_path, tree_path, sample_ids)}
+    return load_artifact('unifrac', compute, [table_path, tree_path], {}, cache_dir,
+                         mmap_mode='r')['distances']
+
+def get_unifrac_distances(table_path, tree_path, unifrac_mode='precomputed', cache_dir=None, **kwargs):
+    """
+    Returns the source of the unifrac distances of a batch.
+        precomputed: the cached N x N distance matrix (memory mapped)
+        batch: a BatchUnifrac that computes the distances of each batch
+            from the (cached) phylogeny
+    """
+    if unifrac_mode == 'batch':
+        samples = _load_samples(table_path, cache_dir=cache_dir)
+        return load_batch_unifrac(table_path, tree_path, samples, cache_dir=cache_dir)
+    return load_unifrac_distances(table_path, tree_path, cache_dir=cache_dir)
+
+def _read_submatrix(distances, indices, rows=None):
+    if callable(distances):
+        submatrix = distances(indices)
+        return submatrix if rows is None else submatrix[rows]
+    row_indices = indices if rows is None else indices[rows]
+    # read rows in sorted order so that the memory map is accessed sequentially
+    row_order, column_order = np.argsort(row_indices), np.argsort(indices)
+    submatrix = distances[np.ix_(row_indices[row_order], indices[column_order])]
+    inverse = np.ix_(np.argsort(row_order), np.argsort(column_order))
+    return np.asarray(submatrix[inverse], dtype=np.float32)
+
+def gather_distances(distances, indices, rows=None):
+    """
+    Reads the len(indices) x len(indices) distance submatrix of a batch
+    from the (memory mapped) distance matrix or computes it with a
+    BatchUnifrac. rows optionally restricts the rows to the samples at
+    these positions of indices, i.e. (len(rows), len(indices)). Runs in the
+    tf.data worker threads when used in a parallel map.
+    """
+    if rows is None:
+        submatrix = tf.numpy_function(lambda x: _read_submatrix(distances, x), [indices],
+                                      tf.float32, stateful=False)
+        submatrix.set_shape([indices.shape[0], indices.shape[0]])
+    else:
+        submatrix = tf.numpy_function(lambda x, r: _read_submatrix(distances, x, r), [indices, rows],
+                                      tf.float32, stateful=False)
+        submatrix.set_shape([rows.shape[0], indices.shape[0]])
+    return submatrix
+
+def _read_bank_submatrix(distances, indices, bank_indices):
+    # bank slots that were not filled yet (-1) are nan
+    submatrix = np.full((len(indices), len(bank_indices)), np.nan, dtype=np.float32)
+    valid = bank_indices >= 0
+    if valid.any():
+        columns = np.concatenate([indices, bank_indices[valid]])
+        rows = np.arange(len(indices))
+        submatrix[:, valid] = _read_submatrix(distances, columns, rows)[:, len(indices):]
+    return submatrix
+
+def gather_bank_distances(distances, indices, bank_indices):
+    """
+    Reads the (len(indices), len(bank_indices)) distances between a batch
+    and the samples of the memory bank, nan for empty bank slots (-1).
+    """
+    submatrix = tf.numpy_function(lambda x, b: _read_bank_submatrix(distances, x, b), [indices, bank_indices],
+                                  tf.float32, stateful=False)
+    submatrix.set_shape([indices.shape[0], bank_indices.shape[0]])
+    return submatrix
+
+def get_sequencing_data(encoded, samples, counts=None):
+    """
+    Returns the SequencingData of samples, the token matrix is shared and
+    each sample is a ragged row of observation indices into it.
+    """
+    row_lengths = np.array([len(sample) for sample in samples], dtype=np.int64)
+    indices = np.concatenate(samples) if len(samples) else np.zeros(0, dtype=np.int32)
+    if counts is not None:
+        counts = np.concatenate(counts) if len(counts) else np.zeros(0, dtype=np.float32)
+        counts = tf.RaggedTensor.from_row_lengths(counts, row_lengths)
+    return SequencingData(encoded['sequences'], tf.RaggedTensor.from_row_lengths(indices, row_lengths), counts)
+
+def select_top_k(encoded, max_asvs_per_sample):
+    """
+    Keeps the max_asvs_per_sample most abundant observations of each sample
+    of the encoded table (ties are broken by observation index), the kept
+    observations stay in their order.
+    """
+    row_splits, indices, counts = encoded['row_splits'], encoded['indices'], encoded['counts']
+    rows = np.repeat(np.arange(len(row_splits) - 1), np.diff(row_splits))
+    order = np.lexsort((-counts, rows))
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order)) - row_splits[rows[order]]
+    keep = ranks < max_asvs_per_sample
+    return dict(encoded,
+                row_splits=np.concatenate([[0], np.cumsum(keep)])[row_splits],
+                indices=indices[keep],
+                counts=counts[keep])
+
+def subsample_table(encoded, subsample=None, max_asvs_per_sample=None, **kwargs):
+    """
+    Applies the static part of the subsample config to the encoded table.
+        top_k: keep the max_asvs_per_sample most abundant ASVs of each sample
+        rarefy: nothing to do here, a count weighted random subset of
+            max_asvs_per_sample ASVs is drawn for every batch
+    """
+    if subsample is None:
+        return encoded
+    if subsample not in ('top_k', 'rarefy'):
+        raise ValueError(f'unknown subsample {subsample}, expected top_k or rarefy')
+    if not max_asvs_per_sample:
+        raise ValueError(f'subsample {subsample} requires max_asvs_per_sample')
+    if subsample == 'top_k':
+        return select_top_k(encoded, max_asvs_per_sample)
+    return encoded
+
+def _get_tokens(sequences, max_num_per_seq):
+    """
+    Returns a function mapping ragged (batch, None) observation indices to
+    the padded (batch, max_asvs_in_batch, max_num_per_seq) int32 token
+    tensor.
+    """
+    pad_width = max_num_per_seq - sequences.shape[1]
+    sequences = tf.constant(sequences)
+
+    def get_tokens(indices):
+        tokens = tf.gather(sequences, indices).to_tensor(default_value=0)
+        tokens = tf.pad(tf.cast(tokens, tf.int32), [[0, 0], [0, 0], [0, pad_width]])
+        tokens.set_shape([indices.shape[0], None, max_num_per_seq])
+        return tokens
+    return get_tokens
+
+def _get_token_batch(sequencing_data, max_num_per_seq):
+    """
+    Returns a function mapping a batch of sample indices to the padded
+    (batch, max_asvs_in_batch, max_num_per_seq) int32 token tensor.
+    """
+    samples = sequencing_data.samples
+    get_tokens = _get_tokens(sequencing_data.sequences, max_num_per_seq)
+    return lambda xs: get_tokens(tf.gather(samples, xs))
+
+def padding_efficiency(row_lengths, batch_size, bucket_boundaries=None, seed=None):
+    """
+    Simulates one (shuffled) epoch of batching and returns the fraction of
+    ASV slots in the padded batches that hold a real ASV.
+    """
+    rng = np.random.default_rng(seed)
+    lengths = rng.permutation(np.asarray(row_lengths))
+    if bucket_boundaries:
+        buckets = np.digitize(lengths, bucket_boundaries)
+        lengths = [lengths[buckets == bucket] for bucket in range(len(bucket_boundaries) + 1)]
+    else:
+        lengths = [lengths]
+
+    real_asvs, padded_asvs, num_batches = 0, 0, 0
+    for bucket in lengths:
+        num_bucket_batches = len(bucket) // batch_size
+        batches = np.reshape(bucket[:num_bucket_batches*batch_size], (num_bucket_batches, batch_size))
+        real_asvs += int(np.sum(batches))
+        padded_asvs += int(np.sum(np.max(batches, axis=1, initial=0))*batch_size)
+        num_batches += num_bucket_batches
+    return {
+        'efficiency': real_asvs / max(padded_asvs, 1),
+        'real_asvs': real_asvs,
+        'padded_asvs': padded_asvs,
+        'num_batches': num_batches
+    }
+
+def _batch_samples(dataset, sequencing_data, batch_size, bucket_boundaries=None):
+    """
+    Batches a dataset of sample indices. If bucket_boundaries is given,
+    samples are grouped by their number of ASVs so that each batch is only
+    padded to the longest sample of its bucket.
+    """
+    row_lengths = sequencing_data.samples.row_lengths().numpy()
+    # the same shuffle with and without buckets
+    configurations = [('without buckets', None)]
+    if bucket_boundaries:
+        configurations.append(('with buckets', bucket_boundaries))
+    for name, boundaries in configurations:
+        stats = padding_efficiency(row_lengths, batch_size, boundaries, seed=0)
+        print(f"padding efficiency {name}: {stats['efficiency']:.3f} "
+              f"({stats['real_asvs']} of {stats['padded_asvs']} ASV slots, {stats['num_batches']} batches)")
+    if not bucket_boundaries:
+        return dataset.batch(batch_size, drop_remainder=True)
+
+    return (dataset
+            .bucket_by_sequence_length(
+                lambda x: tf.cast(tf.gather(row_lengths, x), tf.int32),
+                bucket_boundaries=bucket_boundaries,
+                bucket_batch_sizes=[batch_size]*(len(bucket_boundaries) + 1),
+                drop_remainder=True)
+            .map(lambda xs: tf.ensure_shape(xs, [batch_size]))
+    )
+
+def _get_index_input(indices):
+    # shifted by one so that 0 is the padding index
+    # (see model_utils.get_cached_base_model)
+    output = (tf.cast(indices, tf.int32) + 1).to_tensor(default_value=0)
+    output.set_shape([indices.shape[0], None])
+    return output
+
+def _get_index_batch(sequencing_data):
+    """
+    Returns a function mapping a batch of sample indices to the padded
+    (batch, max_asvs_in_batch) int32 observation indices, shifted by one so
+    that 0 is the padding index (see model_utils.get_cached_base_model).
+    """
+    samples = sequencing_data.samples
+    return lambda xs: _get_index_input(tf.gather(samples, xs))
+
+def _get_feature_batch(feature_store):
+    """
+    Returns a function mapping a batch of sample indices to the zero padded
+    (batch, max_asvs_in_batch, feature_dim) float32 features read from a
+    (memory mapped) feature_store.FeatureStore.
+    """
+    values, row_splits = feature_store.values, feature_store.row_splits
+    feature_dim = values.shape[1]
+
+    def read(xs):
+        lengths = row_splits[xs + 1] - row_splits[xs]
+        batch = np.zeros((len(xs), np.max(lengths, initial=0), feature_dim), dtype=np.float16)
+        for k, x in enumerate(xs):
+            batch[k, :lengths[k]] = values[row_splits[x]:row_splits[x + 1]]
+        return batch
+
+    def get_features(xs):
+        features = tf.numpy_function(read, [xs], tf.float16, stateful=False)
+        features.set_shape([xs.shape[0], None, feature_dim])
+        return tf.cast(features, tf.float32)
+    return get_features
+
+def _rarefy(indices, counts, max_asvs_per_sample):
+    """
+    Draws a count weighted random subset (without replacement) of at most
+    max_asvs_per_sample ASVs of each sample of a ragged batch, the ASVs keep
+    their order. Uses the exponential keys of Efraimidis & Spirakis, i.e.
+    keeps the ASVs with the largest log(u) / count.
+    """
+    flat_counts = counts.flat_values
+    keys = tf.math.log(tf.random.uniform(tf.shape(flat_counts), minval=1e-7, maxval=1.0)) / flat_counts
+    keys = counts.with_flat_values(keys).to_tensor(default_value=-np.inf)
+    ranks = tf.argsort(tf.argsort(keys, axis=1, direction='DESCENDING'), axis=1)
+    keep = tf.RaggedTensor.from_tensor(ranks < max_asvs_per_sample, lengths=counts.row_lengths())
+    return tf.ragged.boolean_mask(indices, keep), tf.ragged.boolean_mask(counts, keep)
+
+def _get_input_batch(sequencing_data, max_num_per_seq, cache_asv_embeddings=False, feature_store=None,
+                     subsample=None, max_asvs_per_sample=None, **kwargs):
+    """
+    Returns a function mapping a batch of sample indices to the model input,
+    the features of feature_store, the observation indices if
+    cache_asv_embeddings or else the tokens. With subsample 'rarefy' each
+    batch only holds a random subset of max_asvs_per_sample ASVs per sample.
+    """
+    samples, counts = sequencing_data.samples, sequencing_data.counts
+    rarefy = subsample == 'rarefy'
+    if rarefy and counts is None:
+        raise ValueError('subsample rarefy requires the counts of the samples')
+    if feature_store is not None:
+        if rarefy:
+            raise ValueError('subsample rarefy can not be used with a feature store')
+        get_features = _get_feature_batch(feature_store)
+    elif cache_asv_embeddings:
+        get_values = _get_index_input
+    else:
+        get_values = _get_tokens(sequencing_data.sequences, max_num_per_seq)
+
+    def get_inputs(xs):
+        indices = tf.gather(samples, xs)
+        if rarefy:
+            indices, _ = _rarefy(indices, tf.gather(counts, xs), max_asvs_per_sample)
+        return get_features(xs) if feature_store is not None else get_values(indices)
+    return get_inputs
+
+def get_samples(encoded, sample_ids=None, drop_empty=False, with_counts=False):
+    """
+    Returns the observation indices of each sample (in table order). If
+    sample_ids is given, only the samples in sample_ids are returned. If
+    with_counts, the counts of each sample are returned as well.
+    """
+    samples = np.split(encoded['indices'], encoded['row_splits'][1:-1])
+    counts = np.split(encoded['counts'], encoded['row_splits'][1:-1])
+    keep = np.ones(len(samples), dtype=bool)
+    if sample_ids is not None:
+        keep &= np.isin(encoded['sample_ids'], np.asarray(sample_ids, dtype=str))
+    if drop_empty:
+        keep &= np.diff(encoded['row_splits']) > 0
+    samples = [sample for sample, k in zip(samples, keep) if k]
+    if with_counts:
+        return samples, [count for count, k in zip(counts, keep) if k]
+    return samples
+
+def create_base_sequencing_data(table_path, tree_path, batch_size, max_num_per_seq, seq_len, cache_dir=None, **kwargs):
     tree_path = tree_path
     table_path = table_path
     seq_len=seq_len
-    table = load_table(table_path)
-    randomize=False
-    s_ids = table.ids(axis='sample')
-    o_ids = np.array(table.ids(axis='observation'))
-    samples = [np.argwhere(table.data(id, axis='sample') > 0).astype(np.int32).flatten() for id in s_ids]
-
-    get_ids = lambda x: o_ids[x]
-    get_seq = lambda x: [[*seq] for seq in x]
-    equal = lambda x: [seq == np.array([[b'A'], [b'C'], [b'G'], [b'T']], dtype='<U1') for seq in x]
-    argmax = lambda x: [np.argmax(seq, 0) + 1 for seq in x]
-    sequencing_data = [np.apply_along_axis(
-                        lambda sample: argmax(equal(get_seq(get_ids(sample)))), 0, sample)
-    for sample in samples]
-    unifrac_distances = unweighted(table_path, tree_path).data
-
-    class Dataset:
-        def __init__(self, sequencing_data, unifrac_distances, batch_size=16, num_epochs=10, randomize=False, items_per_epoch=None):
-            self.sequencing_data = sequencing_data
-            self.unifrac_distances = unifrac_distances
-            self.batch_size = batch_size
-            self.xs = np.arange(len(sequencing_data))
-            self.num_epochs = num_epochs
-            self.randomize = randomize
-            if items_per_epoch is not None:
-                self.items_per_epoch =  items_per_epoch
-            else:
-                self.items_per_epoch = int(len(unifrac_distances))
-            self.on_epoch_end()
-
-        def __len__(self):
-            return int(len(self.sequencing_data)/self.batch_size)
-        
-        def __getitem__(self, index):
-            start = index*self.batch_size
-            pad = lambda x, pad_width: np.array([np.pad(z.tolist(),((0, pad_width - len(z)), (0,max_num_per_seq-seq_len))) for z in x])
-            pad_width = lambda x: pad(x, np.max([len(z) for z in x]))
-            sequence_batch = lambda i: pad_width([self.sequencing_data[i] for i in self.xs[i:i+self.batch_size]])
-            unifrac_batch = lambda i: self.unifrac_distances[self.xs[i:i+self.batch_size], :][:, self.xs[i:i+self.batch_size]]
-            get_batch = lambda i: (sequence_batch(i), unifrac_batch(i))
-            return get_batch(start)
-        
-        def __call__(self):
-            for _ in range(5):
-                for i in range(self.__len__()):
-                    yield self.__getitem__(i)
-                self.on_epoch_end()
-
-        def on_epoch_end(self):
-            if self.randomize:
-                tf.print('Randomizing data!!!!')
-                np.random.shuffle(self.xs)
-
-    dataset = Dataset(sequencing_data, unifrac_distances, batch_size, randomize=randomize)
-    return tf.data.Dataset.from_generator(
-        dataset,
-        output_signature=(
-            tf.TensorSpec(shape=(batch_size, None, max_num_per_seq), dtype=tf.int32),
-            tf.TensorSpec(shape=(batch_size, batch_size), dtype=tf.float32)
-        )
+    encoded = subsample_table(load_encoded_table(table_path, seq_len, cache_dir=cache_dir), **kwargs)
+    sequencing_data = get_sequencing_data(encoded, *get_samples(encoded, with_counts=True))
+    unifrac_distances = get_unifrac_distances(table_path, tree_path, cache_dir=cache_dir, **kwargs)
+    get_tokens = _get_input_batch(sequencing_data, max_num_per_seq, **kwargs)
+
+    get_batch = lambda xs: (get_tokens(xs), gather_distances(unifrac_distances, xs))
+    return (tf.data.Dataset.range(sequencing_data.samples.nrows())
+            .batch(batch_size, drop_remainder=True)
+            .repeat(5)
+            .map(get_batch, num_parallel_calls=tf.data.AUTOTUNE)
+            .prefetch(tf.data.AUTOTUNE)
+    )
+
+def create_embedding_dataset(table_path, seq_len, max_num_per_seq, batch_size, start=0, cache_dir=None, **kwargs):
+    """
+    Token batches of every sample of the table, in table order, starting at
+    sample start. The base model expects full batches so the last batch is
+    filled with copies of the last sample.
+
+    Returns:
+        the dataset and the sample IDs of the table
+    """
+    encoded = load_encoded_table(table_path, seq_len, cache_dir=cache_dir)
+    sequencing_data = get_sequencing_data(encoded, get_samples(encoded))
+    num_samples = len(encoded['sample_ids'])
+    get_tokens = _get_token_batch(sequencing_data, max_num_per_seq)
+
+    def fill_batch(xs):
+        xs = tf.pad(xs, [[0, batch_size - tf.shape(xs)[0]]], constant_values=num_samples - 1)
+        return tf.ensure_shape(xs, [batch_size])
+    dataset = (tf.data.Dataset.range(start, num_samples)
+               .batch(batch_size)
+               .map(fill_batch)
+               .map(get_tokens, num_parallel_calls=tf.data.AUTOTUNE)
+               .prefetch(tf.data.AUTOTUNE)
     )
+    return dataset, encoded['sample_ids']
 
-def create_veg_sequencing_data(table_path, batch_size, max_num_per_seq, seq_len, metadata_path, randomize=True, **kwargs):
+def create_veg_sequencing_data(table_path, batch_size, max_num_per_seq, seq_len, metadata_path, randomize=True, cache_dir=None, **kwargs):
     meta = pd.read_csv(metadata_path, sep='\t', index_col=0, dtype={'#SampleID':str})
     categories = np.array([1 if cat == 'high' else 0 for cat in meta['veg_cat']])
     categories = np.reshape(categories, (-1, 1))
 
     seq_len=seq_len
     table_path = table_path
-    table = load_table(table_path)
-    table.filter(meta.index, axis='sample')
-    s_ids = table.ids(axis='sample')
-    o_ids = np.array(table.ids(axis='observation'))
-    samples = [np.argwhere(table.data(id, axis='sample') > 0).astype(np.int32).flatten() for id in s_ids]
-
-    get_ids = lambda x: o_ids[x]
-    get_seq = lambda x: [[*seq] for seq in x]
-    equal = lambda x: [seq == np.array([[b'A'], [b'C'], [b'G'], [b'T']], dtype='<U1') for seq in x]
-    argmax = lambda x: [np.argmax(seq, 0) + 1 for seq in x]
-    sequencing_data = [np.apply_along_axis(
-                        lambda sample: argmax(equal(get_seq(get_ids(sample)))), 0, sample)
-    for sample in samples]
-
-    
+    encoded = subsample_table(load_encoded_table(table_path, seq_len, cache_dir=cache_dir), **kwargs)
+    sequencing_data = get_sequencing_data(encoded, *get_samples(encoded, meta.index, with_counts=True))
     return sequencing_data, categories
 
-def create_veg_dataset(sequencing_data, categories, batch_size, randomize, limit_size, max_num_per_seq, seq_len, **kwargs):
-    class Dataset:
-        def __init__(self, sequencing_data, categories, batch_size=16, num_epochs=10, randomize=False, items_per_epoch=None):
-            self.sequencing_data = sequencing_data
-            self.categories = categories
-            self.batch_size = batch_size
-            self.xs = np.arange(len(sequencing_data))
-            self.num_epochs = num_epochs
-            self.randomize = randomize
-            if items_per_epoch is not None:
-                self.items_per_epoch =  items_per_epoch
-            else:
-                self.items_per_epoch = int(len(categories))
-            self.on_epoch_end()
-            self.limit_size = limit_size
-            self.max_num_per_seq = max_num_per_seq
-            self.seq_len = seq_len
-
-        def __len__(self):
-            return int((len(self.sequencing_data)*self.limit_size)/self.batch_size)
-        
-        def __getitem__(self, index):
-            start = index*self.batch_size
-            pad = lambda x, pad_width: np.array([np.pad(z.tolist(),((0, pad_width - len(z)), (0,self.max_num_per_seq-self.seq_len))) for z in x])
-            pad_width = lambda x: pad(x, np.max([len(z) for z in x]))
-            sequence_batch = lambda i: pad_width([self.sequencing_data[i] for i in self.xs[i:i+self.batch_size]])
-            category_batch = lambda i: self.categories[self.xs[i:i+self.batch_size]]
-            get_batch = lambda i: (sequence_batch(i), category_batch(i))
-            return get_batch(start)
-        
-        def __call__(self):
-            for i in range(self.__len__()):
-                yield self.__getitem__(i)
-            self.on_epoch_end()
-
-        def on_epoch_end(self):
-            if self.randomize:
-                tf.print('Randomizing data!!!!')
-                np.random.shuffle(self.xs)
-
-    dataset = Dataset(sequencing_data, categories, batch_size, randomize=randomize)
-    return tf.data.Dataset.from_generator(
-        dataset,
-        output_signature=(
-            tf.TensorSpec(shape=(batch_size, None, max_num_per_seq), dtype=tf.int32),
-            tf.TensorSpec(shape=(batch_size, 1), dtype=tf.float32)
-        )
+def create_veg_dataset(sequencing_data, categories, batch_size, randomize, limit_size, max_num_per_seq, seq_len, bucket_boundaries=None, cache_asv_embeddings=False, feature_store=None, **kwargs):
+    num_samples = int(sequencing_data.samples.nrows())
+    num_batches = int((num_samples*limit_size)/batch_size)
+    categories = tf.constant(categories, dtype=tf.float32)
+    get_tokens = _get_input_batch(sequencing_data, max_num_per_seq, cache_asv_embeddings, feature_store, **kwargs)
+
+    dataset = tf.data.Dataset.range(num_samples)
+    if randomize:
+        dataset = dataset.shuffle(num_samples, reshuffle_each_iteration=True)
+    get_batch = lambda xs: (get_tokens(xs), tf.gather(categories, xs))
+    return (_batch_samples(dataset, sequencing_data, batch_size, bucket_boundaries)
+            .take(num_batches)
+            .map(get_batch, num_parallel_calls=tf.data.AUTOTUNE)
+            .prefetch(tf.data.AUTOTUNE)
     )
-def _get_sequencing_data(table, metadata, group_step):
+
+def _get_sequencing_data(encoded, metadata, group_step):
     # filter table to only include agp samples
     agp_meta = metadata
     agp_samples = agp_meta.index.to_list()
-    table.filter(agp_samples, axis='sample', inplace=True)
-    print('???', agp_meta.shape, table.shape)
-    table.remove_empty()
-    print('!!!', agp_meta.shape, table.shape)
-    s_ids = table.ids(axis='sample')
-    o_ids = np.array(table.ids(axis='observation'))
-    samples = [np.argwhere(table.data(id, axis='sample') > 0.5).astype(np.int32).flatten() for id in s_ids]
-
-    get_ids = lambda x: o_ids[x]
-    get_seq = lambda x: [[*seq] for seq in x]
-    equal = lambda x: [seq == np.array([[b'A'], [b'C'], [b'G'], [b'T']], dtype='<U1') for seq in x]
-    argmax = lambda x: [np.argmax(seq, 0) + 1 for seq in x] # add one to account for mask token
-    sequencing_data = [np.apply_along_axis(
-                        lambda sample: argmax(equal(get_seq(get_ids(sample)))), 0, sample)
-        for sample in samples]
+    samples, counts = get_samples(encoded, agp_samples, drop_empty=True, with_counts=True)
+    print('!!!', agp_meta.shape, len(samples))
+    sequencing_data = get_sequencing_data(encoded, samples, counts)
     age_data = np.array(agp_meta['age'].tolist())
 
     step = group_step
@@ -171,53 +512,122 @@ def _get_sequencing_data(table, metadata, group_step):
         groups.append(agp_meta.loc[(agp_meta['age']  >= i-step)  & (agp_meta['age']  < i)].shape[0])
     return sequencing_data, age_data
 
-def get_sequencing_dataset(table_path, **kwargs):
+def get_observation_ids(table_path, cache_dir=None, **kwargs):
+    return _load_samples(table_path, cache_dir=cache_dir)['observation_ids']
+
+def get_sequencing_dataset(table_path, cache_dir=None, **kwargs):
+    """
+    Dataset of the (sorted) observation indices of each sample in table
+    order. table_path is either the path of the table or a biom Table.
+    Only subsample 'top_k' applies to this dataset.
+    """
     if type(table_path) == str:
-        table = load_table(table_path)
+        encoded = _load_samples(table_path, cache_dir=cache_dir)
     else:
-        table = table_path
-    o_ids = tf.constant(table.ids(axis='observation'))
-    table = table.transpose()
-    data = table.matrix_data.tocoo()
-    row_ind = data.row
-    col_ind = data.col
-    values = data.data
-    indices = [[r, c] for r, c in zip(row_ind, col_ind)]
-    table_data = tf.sparse.SparseTensor(indices=indices, values=values,dense_shape=table.shape)
-    table_data = tf.sparse.reorder(table_data)
-    get_asv_id = lambda x: tf.gather(o_ids, x.indices)
-    return (tf.data.Dataset.from_tensor_slices(table_data)
-                           .map(get_asv_id, num_parallel_calls=tf.data.AUTOTUNE)
-                           .prefetch(tf.data.AUTOTUNE)
-    )
-
-def get_unifrac_dataset(table_path, tree_path, **kwargs):
-    distance = unweighted(table_path, tree_path).data
-    return (tf.data.Dataset.from_tensor_slices(distance)
-                           .prefetch(tf.data.AUTOTUNE)
-    )
+        row_splits, indices, counts = _get_sample_splits(table_path)
+        encoded = {'row_splits': row_splits, 'indices': indices, 'counts': counts}
+    encoded = subsample_table(encoded, **kwargs)
+    samples = tf.RaggedTensor.from_row_splits(encoded['indices'], encoded['row_splits'], validate=False)
+    return tf.data.Dataset.from_tensor_slices(samples).prefetch(tf.data.AUTOTUNE)
 
-def combine_seq_dist_dataset(seq_dataset, dist_dataset, batch_size, **kwargs):
+def combine_seq_dist_dataset(seq_dataset, batch_size, seed=None, **kwargs):
+    """
+    Pairs each sample with its row in the distance matrix, the distances
+    themselves are only read per batch in batch_dist_dataset. All workers
+    of a distributed run must use the same seed.
+    """
     dataset_size = seq_dataset.cardinality()
-    return (tf.data.Dataset
-            .zip(seq_dataset, dist_dataset)
+    return (seq_dataset
             .enumerate()
-            .shuffle(dataset_size, reshuffle_each_iteration=False)
+            .shuffle(dataset_size, seed=seed, reshuffle_each_iteration=False)
             .prefetch(tf.data.AUTOTUNE)
     )
 
-def batch_dist_dataset(dataset, batch_size, shuffle=False, repeat=None, **kwargs):
+def get_token_inputs(table_path, seq_len, max_num_per_seq, cache_dir=None, **kwargs):
+    """
+    Returns a function mapping a ragged batch of observation indices (see
+    get_sequencing_dataset) to the token input of a base model with
+    input_type 'tokens'.
+    """
+    encoded = load_encoded_table(table_path, seq_len, cache_dir=cache_dir)
+    return _get_tokens(encoded['sequences'], max_num_per_seq)
+
+def save_tokenizer(path, seq_len, max_num_per_seq, **kwargs):
+    """
+    Saves the tokenization used by base models with input_type 'tokens',
+    the models themselves never see the ASV strings.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'vocabulary': NUCLEOTIDES.decode(), 'mask_token': 0,
+                   'seq_len': seq_len, 'max_num_per_seq': max_num_per_seq}, f)
+
+def load_tokenizer(path):
+    """
+    Returns a function mapping ASV sequences to their (n, max_num_per_seq)
+    int32 tokens as saved by save_tokenizer.
+    """
+    with open(path) as f:
+        tokenizer = json.load(f)
+    if tokenizer['vocabulary'] != NUCLEOTIDES.decode():
+        raise ValueError(f"unsupported tokenizer vocabulary {tokenizer['vocabulary']}")
+    pad_width = tokenizer['max_num_per_seq'] - tokenizer['seq_len']
+    return lambda o_ids: np.pad(encode_sequences(o_ids, tokenizer['seq_len']),
+                                [[0, 0], [0, pad_width]]).astype(np.int32)
+
+def _add_memory_bank(dataset, memory_bank_size, batch_size):
+    """
+    Adds the samples of the memory bank (the previous memory_bank_size /
+    batch_size batches) and the bank slot of each batch of (indices, x).
+    """
+    if memory_bank_size % batch_size != 0:
+        raise ValueError(f'memory_bank_size {memory_bank_size} is not a multiple of batch_size {batch_size}')
+    num_slots = memory_bank_size // batch_size
+
+    def add_batch(state, batch):
+        bank_indices, step = state
+        ind, x = batch
+        slot = step % num_slots
+        positions = slot * batch_size + tf.range(batch_size, dtype=tf.int64)
+        updated = tf.tensor_scatter_nd_update(bank_indices, positions[:, tf.newaxis], ind)
+        return (updated, step + 1), (ind, x, bank_indices, slot)
+    initial_state = (tf.fill([memory_bank_size], tf.constant(-1, dtype=tf.int64)), tf.constant(0, dtype=tf.int64))
+    return dataset.scan(initial_state, add_batch)
+
+def batch_dist_dataset(dataset, distances, batch_size, shuffle=False, repeat=None, get_inputs=None, memory_bank_size=None, **kwargs):
+    """
+    Batches the samples of combine_seq_dist_dataset with the distances
+    between them. get_inputs optionally maps the ragged batch of samples to
+    the model input, i.e. get_token_inputs.
+    With memory_bank_size, the targets are (distances, bank_distances,
+    slot) for model_utils.MemoryBankModel: bank_distances are the distances
+    to the samples of the previous memory_bank_size / batch_size batches
+    (nan until the bank is filled) and slot is where the batch goes in the
+    bank. The dataset is then infinite, fit needs steps_per_epoch.
+    """
+    if get_inputs is None:
+        get_inputs = lambda x: x
     dataset = dataset.cache()
     size = dataset.cardinality()
     
     if shuffle:
         dataset = dataset.shuffle(size, reshuffle_each_iteration=True)
 
-    get_pairwise_dist = lambda ind, x: (x[0], tf.gather(x[1], ind, axis=1, batch_dims=0))
-    dataset = (dataset
-        .ragged_batch(batch_size, drop_remainder=True)
-        .map(get_pairwise_dist, num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
-    )
+    dataset = dataset.ragged_batch(batch_size, drop_remainder=True)
+    if memory_bank_size:
+        # repeated before the scan so that the bank carries over the epochs,
+        # in step with the bank of the model (fit keeps the iterator of an
+        # infinite dataset with steps_per_epoch). The bank slots follow the
+        # batch order, so the order must be kept.
+        dataset = _add_memory_bank(dataset.repeat(), memory_bank_size, batch_size)
+        get_pairwise_dist = lambda ind, x, bank_ind, slot: (
+            get_inputs(x),
+            (gather_distances(distances, ind), gather_bank_distances(distances, ind, bank_ind), slot))
+        dataset = dataset.map(get_pairwise_dist, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+    get_pairwise_dist = lambda ind, x: (get_inputs(x), gather_distances(distances, ind))
+    dataset = dataset.map(get_pairwise_dist, num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
 
     if not shuffle:
         dataset = dataset.cache()
@@ -226,45 +636,61 @@ def batch_dist_dataset(dataset, batch_size, shuffle=False, repeat=None, **kwargs
 
     return dataset.prefetch(tf.data.AUTOTUNE)
 
-
-def create_unifrac_sequencing_data(table_path, tree_path, batch_size, max_num_per_seq, seq_len, repeat=1, split_percent=None, **kwargs):
+def replica_dist_dataset(dataset, distances, batch_size, input_context, shuffle=False, repeat=None, get_inputs=None, seed=None, **kwargs):
     """
-    ONLY NEED TO RUN THIS IS MISSING PRELOADED DATASETS
+    batch_dist_dataset for tf.distribute.Strategy.distribute_datasets_from_function.
+    Every worker batches the same global batches of batch_size samples (the
+    order only depends on seed) and feeds each of its replicas their slice
+    of the global batch, i.e. the inputs of batch_size / num_replicas samples
+    and their distances to all samples of the global batch.
     """
-    # table = load_table(table_path)
+    if get_inputs is None:
+        get_inputs = lambda x: x
+    replica_batch_size = input_context.get_per_replica_batch_size(batch_size)
+    local_replicas = input_context.num_replicas_in_sync // input_context.num_input_pipelines
+    first_replica = input_context.input_pipeline_id * local_replicas
+    dataset = dataset.cache()
+    size = dataset.cardinality()
+
+    if shuffle:
+        dataset = dataset.shuffle(size, seed=seed, reshuffle_each_iteration=True)
+
+    def split_replicas(ind, x):
+        # local replicas take consecutive elements of the worker dataset
+        replicas = tf.data.Dataset.range(first_replica, first_replica + local_replicas)
+        return replicas.map(lambda r: (ind, r * replica_batch_size + tf.range(replica_batch_size, dtype=tf.int64),
+                                       x[r*replica_batch_size:(r + 1)*replica_batch_size]))
+
+    get_pairwise_dist = lambda ind, rows, x: (get_inputs(x), gather_distances(distances, ind, rows))
+    dataset = (dataset
+        .ragged_batch(batch_size, drop_remainder=True)
+        .flat_map(split_replicas)
+        .map(get_pairwise_dist, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+    )
 
-    # s_ids = table.ids(axis='sample')
-    # o_ids = np.array(table.ids(axis='observation'))
+    if not shuffle:
+        dataset = dataset.cache()
+    else:
+        dataset = dataset.repeat(repeat)
 
-    # samples = [np.argwhere(table.data(id, axis='sample') > 0).astype(np.int32).flatten() for id in s_ids]
+    return dataset.prefetch(tf.data.AUTOTUNE)
 
-    # get_ids = lambda x: o_ids[x]
-    # get_seq = lambda x: [[*seq] for seq in x]
-    # equal = lambda x: [seq == np.array([[b'A'], [b'C'], [b'G'], [b'T']], dtype='<U1') for seq in x]
-    # argmax = lambda x: [np.argmax(seq, 0) + 1 for seq in x]
-    # sequencing_data = [np.apply_along_axis(
-    #                     lambda sample: argmax(equal(get_seq(get_ids(sample)))), 0, sample)
-    #                         for sample in samples]
-    # unifrac_distances = unweighted(table_path, tree_path).data
 
+def create_unifrac_sequencing_data(table_path, tree_path, batch_size, max_num_per_seq, seq_len, repeat=1, split_percent=None, cache_dir=None, **kwargs):
     """
-    PRELOADED DATASETS
+    CACHED DATASETS, ONLY BUILT WHEN THE TABLE/TREE CHANGES
     """
-    seq_dataset = tf.data.Dataset.load('agp-data/base-seq')
-    seq_dataset = seq_dataset.ragged_batch(seq_dataset.cardinality())
-    seq_data = [x for x in seq_dataset][0]
-    unifrac_dataset = tf.data.Dataset.load('agp-data/base-unifrac')
-    unifrac_dataset = unifrac_dataset.ragged_batch(unifrac_dataset.cardinality())
-    unifrac_data = [x for x in unifrac_dataset][0]
+    encoded = load_encoded_table(table_path, seq_len, cache_dir=cache_dir)
+    sequences = tf.constant(encoded['sequences'], dtype=tf.int32)
+    seq_data = tf.RaggedTensor.from_row_splits(encoded['indices'], encoded['row_splits'])
+    unifrac_data = get_unifrac_distances(table_path, tree_path, cache_dir=cache_dir, **kwargs)
 
     """
     CREATE DATASETS, THIS IS ALWAYS DONE
     """
-    @tf.function
     def get_items(indices, seq_data, unifrac_data):
-        seq_items = tf.gather(seq_data, indices).to_tensor(default_value=0)
-        unifrac_items = tf.gather(unifrac_data, indices)
-        unifrac_items = tf.gather(unifrac_items, indices, axis=1)
+        seq_items = tf.gather(sequences, tf.gather(seq_data, indices)).to_tensor(default_value=0)
+        unifrac_items = gather_distances(unifrac_data, indices)
         return seq_items, unifrac_items
 
     def create_dataset(start, end, seq_data, unifrac_data, batch_size=16, repeat=1):
@@ -291,99 +717,57 @@ def create_unifrac_sequencing_data(table_path, tree_path, batch_size, max_num_pe
                        seq_data, unifrac_data,
                        batch_size=batch_size, repeat=repeat)
     
-def create_sequencing_data(table_path, metadata_path, split_percent=None, group_step=25, **kwargs):
+def create_sequencing_data(table_path, metadata_path, seq_len, split_percent=None, group_step=25, cache_dir=None, **kwargs):
     """
     voc for embedding layer is <MASK> := 0, A := 1, C := 2, G := 3, T := 4
     """
-    table = load_table(table_path)
+    encoded = load_encoded_table(table_path, seq_len, min_count=0.5, cache_dir=cache_dir)
+    encoded = subsample_table(encoded, **kwargs)
     meta = pd.read_csv(metadata_path, sep='\t', index_col=0, dtype={'#SampleID':str})
     meta['age'] = meta['age'].astype(np.float32)
 
     if split_percent:
         training_df = meta.sample(frac=1-split_percent, replace=False, random_state=1)
-        training_table = table.filter(training_df.index, axis='sample', inplace=False)
         validation_df = meta[~meta.index.isin(training_df.index)]
-        validation_table = table.filter(validation_df.index, axis='sample', inplace=False)
-        return (_get_sequencing_data(training_table, training_df, group_step),
-                _get_sequencing_data(validation_table, validation_df, group_step)
+        return (_get_sequencing_data(encoded, training_df, group_step),
+                _get_sequencing_data(encoded, validation_df, group_step)
         )
     else:
-        return _get_sequencing_data(table, meta, group_step)
+        return _get_sequencing_data(encoded, meta, group_step)
         
-def create_dataset(sequencing_data, age_data, groups, batch_size, randomize, max_num_per_seq, seq_len, repeat=None, **kwargs):
-    class Dataset:
-        def __init__(self, sequencing_data, age_data, batch_size, groups, randomize, max_num_per_seq, seq_len, repeat=None, **kwargs):
-            self.sequencing_data = sequencing_data
-            self.age_data = age_data
-            self.batch_size = batch_size
-            if groups is None:
-                self.xs = np.arange(len(sequencing_data))
-            else:
-                start = 0
-                max_group_size = np.max(groups)
-                self.sequence_groups = []
-                self.num_groups = len(groups)
-                for size in groups:
-                    self.sequence_groups.append(np.tile(np.arange(start, start + size),
-                                                        int(max_group_size / size) + 1))
-                    start += size
-
-            self.randomize=randomize
-            self.max_num_per_seq = max_num_per_seq
-            self.seq_len = seq_len
-            if repeat is None:
-                self.repeat = 1
-            else:
-                self.repeat = repeat
-            self._shuffle()
-
-        def __len__(self):
-
-            return int(len(self.sequencing_data)/self.batch_size)
-        
-        def __getitem__(self, xs):
-            pad = lambda x, pad_width: np.array([np.pad(z.tolist(),((0, pad_width - len(z)), (0,self.max_num_per_seq-self.seq_len))) for z in x])
-            pad_width = lambda x: pad(x, np.max([len(z) for z in x]))
-            sequence_batch = lambda xs: pad_width([self.sequencing_data[i] for i in xs])
-            get_batch = lambda xs: (sequence_batch(xs), self.age_data[xs, np.newaxis])
-            return get_batch(xs)
-        
-        def _get_xs(self, i):
-            if hasattr(self, 'xs'):
-                start = i*self.batch_size
-                xs = self.xs[start:start+self.batch_size]
-            else:
-                start = i*int(self.batch_size/self.num_groups)
-                end = start + int(self.batch_size/self.num_groups)
-                xs = self.sequence_groups[0][start:end]
-                for group_inds in self.sequence_groups[1:]:
-                    xs = np.append(xs, group_inds[start:end])
-            return xs
-        
-        def __call__(self):
-            for j in range(self.repeat):
-                for i in range(self.__len__()):
-                    xs = self._get_xs(i)
-                    yield self.__getitem__(xs)
-                self._shuffle()
-
-        def _shuffle(self):
-            if self.randomize:
-                if hasattr(self, 'xs'):
-                    np.random.shuffle(self.xs)
-                else:
-                    for group_inds in self.sequence_groups:
-                        np.random.shuffle(group_inds)
-        def on_epoch_end(self):
-            self._shuffle()
-
-    from_generator = lambda dataset: tf.data.Dataset.from_generator(
-        dataset,
-        output_signature=(
-            tf.TensorSpec(shape=(batch_size, None, 150), dtype=tf.int32),
-            tf.TensorSpec(shape=(batch_size, 1), dtype=tf.float32)
-    ))
-    dataset = Dataset(sequencing_data, age_data, batch_size, groups, randomize, max_num_per_seq, seq_len, repeat)
-    return from_generator(dataset)
-
-
+def create_dataset(sequencing_data, age_data, groups, batch_size, randomize, max_num_per_seq, seq_len, repeat=None, bucket_boundaries=None, cache_asv_embeddings=False, feature_store=None, **kwargs):
+    num_samples = int(sequencing_data.samples.nrows())
+    age_data = tf.constant(np.reshape(age_data, (-1, 1)), dtype=tf.float32)
+    get_tokens = _get_input_batch(sequencing_data, max_num_per_seq, cache_asv_embeddings, feature_store, **kwargs)
+    if repeat is None:
+        repeat = 1
+
+    if groups is None:
+        dataset = tf.data.Dataset.range(num_samples)
+        if randomize:
+            dataset = dataset.shuffle(num_samples, reshuffle_each_iteration=True)
+        dataset = _batch_samples(dataset, sequencing_data, batch_size, bucket_boundaries)
+    else:
+        # each batch holds batch_size/num_groups samples of every group,
+        # smaller groups are tiled up to the size of the largest group
+        start = 0
+        max_group_size = np.max(groups)
+        group_batch_size = int(batch_size/len(groups))
+        group_datasets = []
+        for size in groups:
+            group = tf.data.Dataset.from_tensor_slices(
+                np.tile(np.arange(start, start + size), int(max_group_size / size) + 1))
+            if randomize:
+                group = group.shuffle(group.cardinality(), reshuffle_each_iteration=True)
+            group_datasets.append(group.batch(group_batch_size, drop_remainder=True))
+            start += size
+        dataset = (tf.data.Dataset.zip(tuple(group_datasets))
+                   .map(lambda *xs: tf.concat(xs, axis=0))
+                   .take(int(num_samples/batch_size)))
+
+    get_batch = lambda xs: (get_tokens(xs), tf.gather(age_data, xs))
+    return (dataset
+            .repeat(repeat)
+            .map(get_batch, num_parallel_calls=tf.data.AUTOTUNE)
+            .prefetch(tf.data.AUTOTUNE)
+    )
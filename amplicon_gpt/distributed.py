@@ -0,0 +1,65 @@
+import os
+import sys
+import json
+import socket
+import tempfile
+import subprocess
+from contextlib import contextmanager
+import tensorflow as tf
+
+def get_strategy(distributed=False, **kwargs):
+    """
+    Returns a MultiWorkerMirroredStrategy if distributed or if the cluster
+    is described by TF_CONFIG, otherwise the default (single device)
+    strategy. Must be called before any other TensorFlow op.
+    """
+    if distributed or 'TF_CONFIG' in os.environ:
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    return tf.distribute.get_strategy()
+
+def is_chief(strategy):
+    """
+    Whether this worker writes the models and figures of a run.
+    """
+    resolver = getattr(strategy, 'cluster_resolver', None)
+    if resolver is None or resolver.task_type is None:
+        return True
+    return resolver.task_type == 'chief' or (resolver.task_type == 'worker' and resolver.task_id == 0)
+
+@contextmanager
+def worker_save_path(path, chief=True):
+    """
+    Every worker of a distributed run must take part in saving a model (its
+    metrics are reduced across the workers) but only the chief keeps it.
+    Yields path on the chief and a temporary path otherwise.
+    """
+    if chief:
+        yield path
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        yield os.path.join(tmp, os.path.basename(path))
+
+def _free_ports(num_ports):
+    sockets = [socket.socket() for _ in range(num_ports)]
+    for s in sockets:
+        s.bind(('localhost', 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+def launch_local_workers(num_workers, argv=None):
+    """
+    Runs the command (argv, by default the current command line) once per
+    worker of a local cluster of CPU workers, each with its TF_CONFIG.
+    Returns the exit code of the first failed worker or 0.
+    """
+    argv = sys.argv if argv is None else argv
+    workers = [f'localhost:{port}' for port in _free_ports(num_workers)]
+    processes = []
+    for task_id in range(num_workers):
+        tf_config = {'cluster': {'worker': workers}, 'task': {'type': 'worker', 'index': task_id}}
+        env = dict(os.environ, TF_CONFIG=json.dumps(tf_config), CUDA_VISIBLE_DEVICES='')
+        processes.append(subprocess.Popen([sys.executable] + argv, env=env))
+    exit_codes = [process.wait() for process in processes]
+    return next((code for code in exit_codes if code), 0)
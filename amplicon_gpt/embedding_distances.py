@@ -0,0 +1,179 @@
+"""
+Blocked distance computations to evaluate sample embeddings on tables too
+large for a dense distance matrix. The pairwise distances are visited tile
+by tile over the upper triangle so memory stays bounded by block_size, the
+true distances come from the same sources as in training (the memory mapped
+matrix or the BatchUnifrac of data_utils.get_unifrac_distances).
+"""
+import numpy as np
+import pandas as pd
+from skbio import OrdinationResults
+
+def _tiles(n, block_size):
+    for i in range(0, n, block_size):
+        for j in range(i, n, block_size):
+            yield slice(i, min(i + block_size, n)), slice(j, min(j + block_size, n))
+
+def _as_index(indices):
+    # contiguous indices read the memory map as a slice
+    if len(indices) and indices[-1] - indices[0] + 1 == len(indices):
+        return slice(int(indices[0]), int(indices[-1]) + 1)
+    return indices
+
+def read_tile(distances, rows, columns):
+    """
+    Reads the len(rows) x len(columns) distances between the (sorted)
+    sample indices rows and columns from the distance matrix or computes
+    them with a BatchUnifrac.
+    """
+    if callable(distances):
+        if np.array_equal(rows, columns):
+            return np.asarray(distances(rows), dtype=np.float64)
+        tile = distances(np.concatenate([rows, columns]))
+        return np.asarray(tile[:len(rows), len(rows):], dtype=np.float64)
+    rows, columns = _as_index(rows), _as_index(columns)
+    if isinstance(rows, slice):
+        tile = distances[rows][:, columns]
+    elif isinstance(columns, slice):
+        tile = distances[:, columns][rows]
+    else:
+        tile = distances[np.ix_(rows, columns)]
+    return np.asarray(tile, dtype=np.float64)
+
+def embedding_tile(embeddings, squared_norms, rows, columns):
+    """
+    Euclidean distances between the embeddings at positions rows and
+    columns, the embeddings should be centered (see compare_distances).
+    """
+    dot_product = embeddings[rows] @ embeddings[columns].T
+    distances = squared_norms[rows, None] - 2.0 * dot_product + squared_norms[None, columns]
+    return np.sqrt(np.maximum(distances, 0.0))
+
+def _upper(tile, diagonal):
+    if diagonal:
+        return tile[np.triu_indices(tile.shape[0], 1)]
+    return tile.ravel()
+
+def _bins(values, low, high, num_bins):
+    bins = (values - low) * (num_bins / (high - low))
+    return np.clip(bins.astype(np.int64), 0, num_bins - 1)
+
+def _midranks(counts):
+    below = np.cumsum(counts) - counts
+    return below + (counts + 1) / 2.0
+
+def compare_distances(embeddings, distances, indices=None, block_size=2048, num_bins=2048, true_range=(0.0, 1.0)):
+    """
+    Correlates the euclidean distances of the embeddings with the true
+    distances of the samples indices (default all, one per embedding) in
+    a single blocked pass over the sample pairs.
+
+    The Mantel statistic (Pearson correlation of the pairs) is exact. The
+    Spearman correlation is approximated by ranking the pairs within
+    num_bins equal width bins per side (true_range for the true distances,
+    the largest possible embedding distance for the predicted ones). No
+    permutation test is done, it would take a pass per permutation.
+
+    Returns a dict with mantel_r, spearman_rho and num_pairs.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    # centering keeps the norms small, the distances do not change
+    embeddings = embeddings - embeddings.mean(axis=0)
+    squared_norms = np.sum(embeddings ** 2, axis=1)
+    indices = np.arange(len(embeddings)) if indices is None else np.asarray(indices)
+    max_distance = 2.0 * np.sqrt(squared_norms.max()) if len(embeddings) else 1.0
+    max_distance = max(max_distance, 1e-12)
+
+    shift = None
+    sums = np.zeros(6)  # n, x, y, xx, yy, xy of the shifted pairs
+    histogram = np.zeros(num_bins * num_bins, dtype=np.int64)
+    for rows, columns in _tiles(len(embeddings), block_size):
+        diagonal = rows == columns
+        x = _upper(embedding_tile(embeddings, squared_norms, rows, columns), diagonal)
+        y = _upper(read_tile(distances, indices[rows], indices[columns]), diagonal)
+        if len(x) == 0:
+            continue
+        if shift is None:
+            # shifting by an estimate of the means keeps the sums precise
+            shift = x.mean(), y.mean()
+        dx, dy = x - shift[0], y - shift[1]
+        sums += [len(x), dx.sum(), dy.sum(), dx @ dx, dy @ dy, dx @ dy]
+        joint = _bins(x, 0.0, max_distance, num_bins) * num_bins + _bins(y, *true_range, num_bins)
+        histogram += np.bincount(joint, minlength=num_bins * num_bins)
+
+    n, sx, sy, sxx, syy, sxy = sums
+    if n < 2:
+        return {'mantel_r': np.nan, 'spearman_rho': np.nan, 'num_pairs': int(n)}
+    covariance = sxy - sx * sy / n
+    mantel_r = covariance / np.sqrt((sxx - sx * sx / n) * (syy - sy * sy / n))
+
+    histogram = histogram.reshape(num_bins, num_bins).astype(np.float64)
+    x_counts, y_counts = histogram.sum(axis=1), histogram.sum(axis=0)
+    mean_rank = (n + 1) / 2.0
+    x_ranks, y_ranks = _midranks(x_counts) - mean_rank, _midranks(y_counts) - mean_rank
+    spearman_rho = (x_ranks @ histogram @ y_ranks) / np.sqrt((x_counts @ x_ranks ** 2) * (y_counts @ y_ranks ** 2))
+    return {'mantel_r': float(mantel_r), 'spearman_rho': float(spearman_rho), 'num_pairs': int(n)}
+
+def _ordination_results(long_method_name, eigvals, coordinates, proportion_explained, sample_ids):
+    axis_labels = [f'PC{i}' for i in range(1, len(eigvals) + 1)]
+    return OrdinationResults(
+        short_method_name='PCoA',
+        long_method_name=long_method_name,
+        eigvals=pd.Series(eigvals, index=axis_labels),
+        samples=pd.DataFrame(coordinates, index=sample_ids, columns=axis_labels),
+        proportion_explained=pd.Series(proportion_explained, index=axis_labels))
+
+def embedding_pcoa(embeddings, sample_ids, number_of_dimensions=3):
+    """
+    PCoA of the euclidean distances of the embeddings without the
+    distance matrix, it equals the PCA of the centered embeddings.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    embeddings = embeddings - embeddings.mean(axis=0)
+    u, s, _ = np.linalg.svd(embeddings, full_matrices=False)
+    eigvals = s ** 2
+    total = max(eigvals.sum(), 1e-300)
+    k = min(number_of_dimensions, len(s))
+    return _ordination_results('Principal Coordinate Analysis', eigvals[:k], u[:, :k] * s[:k],
+                               eigvals[:k] / total, sample_ids)
+
+def randomized_pcoa(distances, indices, sample_ids, number_of_dimensions=3, oversamples=10, power_iterations=2,
+                    block_size=2048, seed=None):
+    """
+    PCoA of the distances of the samples indices by a randomized
+    eigendecomposition of the centered matrix -1/2 J D^2 J. Each product
+    with it is a blocked pass over the distances (power_iterations + 2
+    passes), only n x (number_of_dimensions + oversamples) values are
+    kept in memory.
+    """
+    indices = np.asarray(indices)
+    n = len(indices)
+    size = min(n, number_of_dimensions + oversamples)
+    total = [0.0]
+
+    def multiply(x, accumulate=False):
+        x = x - x.mean(axis=0)
+        product = np.zeros_like(x)
+        for rows, columns in _tiles(n, block_size):
+            tile = read_tile(distances, indices[rows], indices[columns]) ** 2
+            product[rows] += tile @ x[columns]
+            if rows != columns:
+                product[columns] += tile.T @ x[rows]
+            if accumulate:
+                total[0] += tile.sum() * (1 if rows == columns else 2)
+        product -= product.mean(axis=0)
+        return -0.5 * product
+
+    rng = np.random.default_rng(seed)
+    q, _ = np.linalg.qr(multiply(rng.standard_normal((n, size)), accumulate=True))
+    for _ in range(power_iterations):
+        q, _ = np.linalg.qr(multiply(q))
+    small = q.T @ multiply(q)
+    eigvals, eigvecs = np.linalg.eigh((small + small.T) / 2.0)
+    order = np.argsort(eigvals)[::-1][:number_of_dimensions]
+    eigvals, eigvecs = eigvals[order], q @ eigvecs[:, order]
+    # the trace of -1/2 J D^2 J, i.e. the sum of all its eigenvalues
+    trace = max(total[0] / (2.0 * n), 1e-300)
+    coordinates = eigvecs * np.sqrt(np.maximum(eigvals, 0.0))
+    return _ordination_results('Randomized Principal Coordinate Analysis', eigvals, coordinates,
+                               eigvals / trace, sample_ids)
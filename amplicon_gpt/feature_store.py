@@ -0,0 +1,68 @@
+import hashlib
+from collections import namedtuple
+import numpy as np
+import tensorflow as tf
+from amplicon_gpt.cache import load_artifact
+from amplicon_gpt.data_utils import _get_token_batch, _get_index_batch
+from amplicon_gpt.model_utils import get_base_model, get_cached_base_model
+
+# values: (total_asvs, feature_dim) float16 memory map of the frozen encoder
+#     output of every (non padded) ASV
+# row_splits: (n_samples + 1,) start/end of each sample in values
+FeatureStore = namedtuple('FeatureStore', ['values', 'row_splits'])
+
+def _samples_digest(sequencing_data):
+    sha = hashlib.sha256()
+    sha.update(sequencing_data.samples.row_splits.numpy().tobytes())
+    sha.update(sequencing_data.samples.values.numpy().tobytes())
+    return sha.hexdigest()
+
+def _write_features(extractor, get_inputs, row_splits, batch_size):
+    """
+    Streams the extractor output of every sample, without its padding, into
+    a float16 .npy file.
+    """
+    def write(path):
+        num_samples = len(row_splits) - 1
+        values = np.lib.format.open_memmap(path, mode='w+', dtype=np.float16,
+                                           shape=(int(row_splits[-1]), extractor.output_shape[-1]))
+        for start in range(0, num_samples, batch_size):
+            # the base model expects full batches, the last one is filled
+            # with copies of the last sample
+            xs = np.minimum(np.arange(start, start + batch_size), num_samples - 1)
+            features = extractor(get_inputs(tf.constant(xs)), training=False).numpy()
+            for k, x in enumerate(xs[:num_samples - start]):
+                values[row_splits[x]:row_splits[x + 1]] = features[k, :row_splits[x + 1] - row_splits[x]]
+        values.flush()
+        del values
+    return write
+
+def load_feature_store(sequencing_data, base_model_path, table_path, max_num_per_seq, batch_size,
+                       cache_dir=None, asv_embeddings=None, **kwargs):
+    """
+    Returns the FeatureStore of sequencing_data, i.e. the output of the
+    frozen base model encoder for each of its samples. The features are
+    computed once and rebuilt only when the base model, table or samples
+    change.
+    """
+    row_splits = sequencing_data.samples.row_splits.numpy()
+
+    def compute():
+        if asv_embeddings is not None:
+            input, base_output, _ = get_cached_base_model(base_model_path, asv_embeddings)
+            get_inputs = _get_index_batch(sequencing_data)
+        else:
+            input, base_output = get_base_model(base_model_path)
+            get_inputs = _get_token_batch(sequencing_data, max_num_per_seq)
+        extractor = tf.keras.Model(inputs=input, outputs=base_output)
+        return {
+            'row_splits': row_splits,
+            'values': _write_features(extractor, get_inputs, row_splits, batch_size)
+        }
+    # one artifact per set of samples so that i.e. the training and
+    # validation stores do not replace each other
+    name = f'features-{_samples_digest(sequencing_data)[:16]}'
+    params = {'max_num_per_seq': max_num_per_seq, 'asv_embeddings': asv_embeddings is not None}
+    store = load_artifact(name, compute, [base_model_path, table_path], params, cache_dir,
+                          mmap_mode='r')
+    return FeatureStore(store['values'], store['row_splits'])
@@ -7,7 +7,7 @@ class UnitUniform(tf.keras.initializers.Initializer):
         self.fan_out = fan_out
 
     def __call__(self, shape, dtype=None):
-        return tf.ones(shape=shape, dtype=tf.float32)  / self.fan_out
+        return tf.ones(shape=shape, dtype=dtype or tf.float32)  / self.fan_out
     
     def get_config(self):
         return {
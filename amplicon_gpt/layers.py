@@ -49,10 +49,25 @@ conv_2_filter = 64
 #         return z
         
 
+def _encode_real_asvs(encode, input):
+    """
+    Flattens the (batch, n_asvs, seq_len) tokens into a single batch of
+    ASVs, encodes the non padded ASVs only and scatters the result back
+    into the (batch, n_asvs, embedding_dim) layout, padded ASVs are zeros.
+    """
+    shape = tf.shape(input)
+    asvs = tf.reshape(input, [-1, shape[2]])
+    real = tf.where(tf.reduce_any(tf.not_equal(asvs, 0), axis=-1))
+    real = tf.cast(real, tf.int32)
+    output = encode(tf.gather_nd(asvs, real))
+    embedding_dim = output.shape[-1]
+    output = tf.scatter_nd(real, output, [shape[0] * shape[1], embedding_dim])
+    return tf.reshape(output, [shape[0], shape[1], embedding_dim])
+
 @tf.keras.saving.register_keras_serializable(package="amplicon_gpt", name="NucleotideSequenceEmbedding")
 class NucleotideSequenceEmbedding(tf.keras.layers.Layer):
     def __init__(self, embedding_dim, dropout, **kwargs):
-        super().__init__(name="nucleotide_sequence_embedding", **kwargs)
+        super().__init__(name=kwargs.pop('name', "nucleotide_sequence_embedding"), **kwargs)
         self.embedding_dim = embedding_dim
         self.dropout = dropout
         self.embedding = tf.keras.layers.Embedding(5, embedding_dim, input_length=100, mask_zero=False, embeddings_initializer="glorot_normal")
@@ -63,12 +78,16 @@ class NucleotideSequenceEmbedding(tf.keras.layers.Layer):
         ]))
         self.supports_masking = True
 
-    def call(self, input, mask=None, training=False):
-        output = self.embedding(input, training=training)
+    def _encode(self, tokens, training):
+        # the real ASVs form a single sample for the TimeDistributed layers
+        output = self.embedding(tokens[tf.newaxis], training=training)
         output = self.lstm(output, training=training)
         output = tf.transpose(output, perm=[0,1,3,2])
         output = self.dense(output)
-        return output
+        return output[0]
+
+    def call(self, input, mask=None, training=False):
+        return _encode_real_asvs(lambda tokens: self._encode(tokens, training), input)
     
     def get_config(self):
         config = super().get_config()
@@ -78,18 +97,195 @@ class NucleotideSequenceEmbedding(tf.keras.layers.Layer):
         })
         return config
     
+@tf.keras.saving.register_keras_serializable(package="amplicon_gpt", name="ConvNucleotideEmbedding")
+class ConvNucleotideEmbedding(tf.keras.layers.Layer):
+    """
+    Non recurrent alternative to NucleotideSequenceEmbedding, a stack of
+    residual dilated convolutions over the nucleotides of each ASV followed
+    by a masked mean. All ASVs of the batch are encoded as one batch and
+    padded ASVs are skipped.
+    """
+    def __init__(self, embedding_dim, dropout, kernel_size=5, num_conv_layers=3, **kwargs):
+        super().__init__(name=kwargs.pop('name', "nucleotide_sequence_embedding"), **kwargs)
+        self.embedding_dim = embedding_dim
+        self.dropout = dropout
+        self.kernel_size = kernel_size
+        self.num_conv_layers = num_conv_layers
+        self.embedding = tf.keras.layers.Embedding(5, embedding_dim, embeddings_initializer="glorot_normal")
+        self.convs = [tf.keras.layers.Conv1D(embedding_dim, kernel_size, padding='same', dilation_rate=2**i,
+                                             activation='gelu', name=f'nucleotide_conv_{i}')
+                      for i in range(num_conv_layers)]
+        self.conv_dropout = tf.keras.layers.Dropout(dropout)
+        self.dense = tf.keras.layers.Dense(embedding_dim)
+        self.supports_masking = True
+
+    def _encode(self, tokens, training):
+        nucleotide_mask = tf.cast(tf.not_equal(tokens, 0), self.compute_dtype)[:, :, tf.newaxis]
+        output = self.embedding(tokens)
+        for conv in self.convs:
+            output = output + self.conv_dropout(conv(output), training=training)
+        output = tf.reduce_sum(output * nucleotide_mask, axis=1) / tf.maximum(tf.reduce_sum(nucleotide_mask, axis=1), 1.0)
+        return self.dense(output)
+
+    def call(self, input, mask=None, training=False):
+        return _encode_real_asvs(lambda tokens: self._encode(tokens, training), input)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+                "embedding_dim": self.embedding_dim,
+                "dropout": self.dropout,
+                "kernel_size": self.kernel_size,
+                "num_conv_layers": self.num_conv_layers
+        })
+        return config
+
+def _key_bias(key_mask):
+    # additive float32 bias removing the padded keys from the softmax
+    if key_mask is None:
+        return tf.zeros([])
+    return (1.0 - tf.cast(key_mask, tf.float32))[:, tf.newaxis, tf.newaxis, :] * -1e9
+
+def _chunked_attention(query, key, value, key_mask, chunk_size):
+    """
+    Exact softmax attention computed chunk_size queries at a time, only a
+    (batch, heads, chunk_size, n) block of scores exists at any time. Each
+    chunk is recomputed in the backward pass instead of being stored.
+    """
+    shape = tf.shape(query)
+    num_chunks = (shape[2] + chunk_size - 1) // chunk_size
+    pad = num_chunks * chunk_size - shape[2]
+    query = tf.pad(query, [[0, 0], [0, 0], [0, pad], [0, 0]])
+    query = tf.reshape(query, [shape[0], shape[1], num_chunks, chunk_size, shape[3]])
+    query = tf.transpose(query, [2, 0, 1, 3, 4])
+
+    @tf.recompute_grad
+    def attend(query_chunk, key, value, bias):
+        scores = tf.cast(tf.einsum('bhqd,bhkd->bhqk', query_chunk, key), tf.float32) + bias
+        weights = tf.cast(tf.nn.softmax(scores, axis=-1), value.dtype)
+        return tf.einsum('bhqk,bhkd->bhqd', weights, value)
+    bias = _key_bias(key_mask)
+    output = tf.map_fn(lambda query_chunk: attend(query_chunk, key, value, bias), query,
+                       fn_output_signature=value.dtype)
+    output = tf.transpose(output, [1, 2, 0, 3, 4])
+    output = tf.reshape(output, [shape[0], shape[1], num_chunks * chunk_size, shape[3]])
+    return output[:, :, :shape[2]]
+
+def _linear_attention(query, key, value, key_mask):
+    """
+    Kernelized attention with the elu + 1 feature map, linear in the number
+    of ASVs (an approximation of softmax attention).
+    """
+    query = tf.nn.elu(query) + 1.0
+    key = tf.nn.elu(key) + 1.0
+    if key_mask is not None:
+        key *= tf.cast(key_mask, key.dtype)[:, tf.newaxis, :, tf.newaxis]
+    key_value = tf.einsum('bhkd,bhke->bhde', key, value)
+    normalizer = tf.einsum('bhqd,bhd->bhq', query, tf.reduce_sum(key, axis=2))
+    output = tf.einsum('bhqd,bhde->bhqe', query, key_value)
+    return output / (normalizer[:, :, :, tf.newaxis] + 1e-6)
+
+@tf.keras.saving.register_keras_serializable(package="amplicon_gpt", name="SampleEncoderBlock")
+class SampleEncoderBlock(tf.keras.layers.Layer):
+    """
+    Transformer encoder block (same layout as keras_nlp's TransformerEncoder)
+    whose self attention is computed with a memory efficient backend.
+        chunked: exact attention over chunk_size queries at a time
+        linear: kernelized linear attention
+    """
+    def __init__(self, num_heads, intermediate_dim, dropout, attention='chunked', chunk_size=256,
+                 normalize_first=False, **kwargs):
+        super().__init__(**kwargs)
+        self.num_heads = num_heads
+        self.intermediate_dim = intermediate_dim
+        self.dropout = dropout
+        self.attention = attention
+        self.chunk_size = chunk_size
+        self.normalize_first = normalize_first
+        self.supports_masking = True
+
+    def build(self, input_shape):
+        hidden_dim = input_shape[-1]
+        self.head_dim = hidden_dim // self.num_heads
+        self.qkv = tf.keras.layers.Dense(3 * self.num_heads * self.head_dim, name='qkv')
+        self.attention_output = tf.keras.layers.Dense(hidden_dim, name='attention_output')
+        self.attention_norm = tf.keras.layers.LayerNormalization(epsilon=1e-5, name='attention_norm')
+        self.feedforward = tf.keras.Sequential([
+            tf.keras.layers.Dense(self.intermediate_dim, activation='gelu'),
+            tf.keras.layers.Dropout(self.dropout),
+            tf.keras.layers.Dense(hidden_dim)
+        ], name='feedforward')
+        self.feedforward_norm = tf.keras.layers.LayerNormalization(epsilon=1e-5, name='feedforward_norm')
+        self.output_dropout = tf.keras.layers.Dropout(self.dropout)
+        super().build(input_shape)
+
+    def _attend(self, input, padding_mask):
+        shape = tf.shape(input)
+        qkv = tf.reshape(self.qkv(input), [shape[0], shape[1], 3, self.num_heads, self.head_dim])
+        query, key, value = tf.unstack(tf.transpose(qkv, [2, 0, 3, 1, 4]))
+        query *= tf.cast(self.head_dim ** -0.5, query.dtype)
+        if self.attention == 'linear':
+            output = _linear_attention(query, key, value, padding_mask)
+        else:
+            output = _chunked_attention(query, key, value, padding_mask, self.chunk_size)
+        output = tf.reshape(tf.transpose(output, [0, 2, 1, 3]), [shape[0], shape[1], self.num_heads * self.head_dim])
+        return self.attention_output(output)
+
+    def call(self, input, padding_mask=None, training=False):
+        output = input
+        if self.normalize_first:
+            output = self.attention_norm(output)
+        output = self.output_dropout(self._attend(output, padding_mask), training=training)
+        output = input + output
+        if not self.normalize_first:
+            output = self.attention_norm(output)
+
+        residual = output
+        if self.normalize_first:
+            output = self.feedforward_norm(output)
+        output = self.output_dropout(self.feedforward(output, training=training), training=training)
+        output = residual + output
+        if not self.normalize_first:
+            output = self.feedforward_norm(output)
+        return output
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+                "num_heads": self.num_heads,
+                "intermediate_dim": self.intermediate_dim,
+                "dropout": self.dropout,
+                "attention": self.attention,
+                "chunk_size": self.chunk_size,
+                "normalize_first": self.normalize_first
+        })
+        return config
+
 @tf.keras.saving.register_keras_serializable(package="amplicon_gpt", name="PositionEncoder")
 class SampleEncoder(tf.keras.layers.Layer):
-    def __init__(self, nucleotide_embedding_dim, dropout, num_enc_layers, num_heads, dff, norm_first, **kwargs):
-        super().__init__(name="asv_sequence_embedding", **kwargs)
+    def __init__(self, nucleotide_embedding_dim, dropout, num_enc_layers, num_heads, dff, norm_first,
+                 attention='full', attention_chunk_size=256, **kwargs):
+        super().__init__(name=kwargs.pop('name', "asv_sequence_embedding"), **kwargs)
         self.nucleotide_embedding_dim = nucleotide_embedding_dim
         self.dropout = dropout
+        self.num_enc_layers = num_enc_layers
+        self.num_heads = num_heads
+        self.dff = dff
+        self.norm_first = norm_first
+        self.attention = attention
+        self.attention_chunk_size = attention_chunk_size
         self.asv_pos_emb = keras_nlp.layers.PositionEmbedding(sequence_length=1600)
-        self.encoding_blocks = [
-            keras_nlp.layers.TransformerEncoder(num_heads=num_heads, dropout=dropout,
-                    activation='gelu', intermediate_dim=dff, normalize_first=norm_first,
-                    name=f'base_encoder_block_{i}')
-            for i in range(num_enc_layers)]
+        if attention == 'full':
+            self.encoding_blocks = [
+                keras_nlp.layers.TransformerEncoder(num_heads=num_heads, dropout=dropout,
+                        activation='gelu', intermediate_dim=dff, normalize_first=norm_first,
+                        name=f'base_encoder_block_{i}')
+                for i in range(num_enc_layers)]
+        else:
+            self.encoding_blocks = [
+                SampleEncoderBlock(num_heads, dff, dropout, attention=attention, chunk_size=attention_chunk_size,
+                                   normalize_first=norm_first, name=f'base_encoder_block_{i}')
+                for i in range(num_enc_layers)]
         self.supports_masking =True
 
     def call(self, input, mask=None, training=False):
@@ -104,6 +300,174 @@ class SampleEncoder(tf.keras.layers.Layer):
     def get_config(self):
         config = super().get_config()
         config.update({
+                "nucleotide_embedding_dim": self.nucleotide_embedding_dim,
+                "dropout": self.dropout,
+                "num_enc_layers": self.num_enc_layers,
+                "num_heads": self.num_heads,
+                "dff": self.dff,
+                "norm_first": self.norm_first,
+                "attention": self.attention,
+                "attention_chunk_size": self.attention_chunk_size
+        })
+        return config
+
+@tf.keras.saving.register_keras_serializable(package="amplicon_gpt", name="InducedSetAttentionBlock")
+class InducedSetAttentionBlock(tf.keras.layers.Layer):
+    """
+    ISAB of the Set Transformer (Lee et al. 2019), the ASVs attend to
+    num_inducing_points learned points that first attend to the ASVs, so the
+    cost is linear in the number of ASVs.
+    """
+    def __init__(self, num_heads, intermediate_dim, dropout, num_inducing_points=32, **kwargs):
+        super().__init__(**kwargs)
+        self.num_heads = num_heads
+        self.intermediate_dim = intermediate_dim
+        self.dropout = dropout
+        self.num_inducing_points = num_inducing_points
+        self.supports_masking = True
+
+    def build(self, input_shape):
+        hidden_dim = input_shape[-1]
+        self.inducing_points = self.add_weight(name='inducing_points', shape=(self.num_inducing_points, hidden_dim),
+                                               initializer='glorot_uniform')
+        def attention_block(name):
+            return {
+                'attention': tf.keras.layers.MultiHeadAttention(self.num_heads, hidden_dim // self.num_heads,
+                                                                dropout=self.dropout, name=f'{name}_attention'),
+                'attention_norm': tf.keras.layers.LayerNormalization(epsilon=1e-5, name=f'{name}_attention_norm'),
+                'feedforward': tf.keras.Sequential([
+                    tf.keras.layers.Dense(self.intermediate_dim, activation='gelu'),
+                    tf.keras.layers.Dense(hidden_dim)
+                ], name=f'{name}_feedforward'),
+                'feedforward_norm': tf.keras.layers.LayerNormalization(epsilon=1e-5, name=f'{name}_feedforward_norm')
+            }
+        self.induce = attention_block('induce')
+        self.broadcast = attention_block('broadcast')
+        super().build(input_shape)
+
+    def _attend(self, block, query, key, attention_mask, training):
+        output = block['attention'](query, key, attention_mask=attention_mask, training=training)
+        output = block['attention_norm'](query + output)
+        return block['feedforward_norm'](output + block['feedforward'](output))
+
+    def call(self, input, padding_mask=None, training=False):
+        batch_size = tf.shape(input)[0]
+        inducing_points = tf.cast(self.inducing_points, input.dtype)
+        inducing_points = tf.tile(inducing_points[tf.newaxis], [batch_size, 1, 1])
+        attention_mask = None
+        if padding_mask is not None:
+            attention_mask = tf.tile(padding_mask[:, tf.newaxis, :], [1, self.num_inducing_points, 1])
+        induced = self._attend(self.induce, inducing_points, input, attention_mask, training)
+        return self._attend(self.broadcast, input, induced, None, training)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+                "num_heads": self.num_heads,
+                "intermediate_dim": self.intermediate_dim,
+                "dropout": self.dropout,
+                "num_inducing_points": self.num_inducing_points
+        })
+        return config
+
+@tf.keras.saving.register_keras_serializable(package="amplicon_gpt", name="SetSampleEncoder")
+class SetSampleEncoder(tf.keras.layers.Layer):
+    """
+    Permutation invariant alternative to SampleEncoder, a stack of
+    InducedSetAttentionBlock without position embedding, so there is no
+    limit on the number of ASVs of a sample. Also accepts a ragged
+    (batch, None, embedding_dim) input, the output is then ragged too.
+    """
+    def __init__(self, nucleotide_embedding_dim, dropout, num_enc_layers, num_heads, dff,
+                 num_inducing_points=32, **kwargs):
+        super().__init__(name=kwargs.pop('name', "asv_sequence_embedding"), **kwargs)
+        self.nucleotide_embedding_dim = nucleotide_embedding_dim
+        self.dropout = dropout
+        self.num_enc_layers = num_enc_layers
+        self.num_heads = num_heads
+        self.dff = dff
+        self.num_inducing_points = num_inducing_points
+        self.encoding_blocks = [
+            InducedSetAttentionBlock(num_heads, dff, dropout, num_inducing_points=num_inducing_points,
+                                     name=f'base_encoder_block_{i}')
+            for i in range(num_enc_layers)]
+        self.supports_masking = True
+
+    def call(self, input, mask=None, training=False):
+        row_lengths = None
+        if isinstance(input, tf.RaggedTensor):
+            row_lengths = input.row_lengths()
+            mask = tf.sequence_mask(row_lengths, tf.reduce_max(row_lengths))
+            input = input.to_tensor()
+        output = input
+        for block in self.encoding_blocks:
+            output = block(output, padding_mask=mask, training=training)
+        if row_lengths is not None:
+            output = tf.RaggedTensor.from_tensor(output, lengths=row_lengths)
+        return output
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+                "nucleotide_embedding_dim": self.nucleotide_embedding_dim,
+                "dropout": self.dropout,
+                "num_enc_layers": self.num_enc_layers,
+                "num_heads": self.num_heads,
+                "dff": self.dff,
+                "num_inducing_points": self.num_inducing_points
+        })
+        return config
+
+@tf.keras.saving.register_keras_serializable(package="amplicon_gpt", name="PoolingByMultiheadAttention")
+class PoolingByMultiheadAttention(tf.keras.layers.Layer):
+    """
+    PMA of the Set Transformer (Lee et al. 2019), a learned seed query
+    attends over the (non padded) ASVs of a sample and returns a single
+    (batch, embedding_dim) vector that does not depend on the ASV order.
+    Takes a padded input with a mask or a ragged input.
+    """
+    def __init__(self, num_heads, intermediate_dim, dropout, **kwargs):
+        super().__init__(**kwargs)
+        self.num_heads = num_heads
+        self.intermediate_dim = intermediate_dim
+        self.dropout = dropout
+        self.supports_masking = True
+
+    def build(self, input_shape):
+        hidden_dim = input_shape[-1]
+        self.seed = self.add_weight(name='seed', shape=(1, hidden_dim), initializer='glorot_uniform')
+        self.attention = tf.keras.layers.MultiHeadAttention(self.num_heads, hidden_dim // self.num_heads,
+                                                            dropout=self.dropout, name='pooling_attention')
+        self.attention_norm = tf.keras.layers.LayerNormalization(epsilon=1e-5, name='pooling_attention_norm')
+        self.feedforward = tf.keras.Sequential([
+            tf.keras.layers.Dense(self.intermediate_dim, activation='gelu'),
+            tf.keras.layers.Dense(hidden_dim)
+        ], name='pooling_feedforward')
+        self.feedforward_norm = tf.keras.layers.LayerNormalization(epsilon=1e-5, name='pooling_feedforward_norm')
+        super().build(input_shape)
+
+    def call(self, input, mask=None, training=False):
+        if isinstance(input, tf.RaggedTensor):
+            row_lengths = input.row_lengths()
+            mask = tf.sequence_mask(row_lengths, tf.reduce_max(row_lengths))
+            input = input.to_tensor()
+        seed = tf.cast(self.seed, input.dtype)
+        seed = tf.tile(seed[tf.newaxis], [tf.shape(input)[0], 1, 1])
+        attention_mask = None if mask is None else mask[:, tf.newaxis, :]
+        output = self.attention(seed, input, attention_mask=attention_mask, training=training)
+        output = self.attention_norm(seed + output)
+        output = self.feedforward_norm(output + self.feedforward(output))
+        return output[:, 0]
+
+    def compute_mask(self, input, mask=None):
+        # the ASV axis is pooled away
+        return None
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+                "num_heads": self.num_heads,
+                "intermediate_dim": self.intermediate_dim,
                 "dropout": self.dropout
         })
         return config
@@ -10,6 +10,9 @@ def _pairwise_distances(embeddings, squared=False):
     Returns:
         pairwise_distances: tensor of shape (batch_size, batch_size)
     """
+    # always computed in float32, the subtraction below loses all precision
+    # in float16/bfloat16
+    embeddings = tf.cast(embeddings, tf.float32)
     # Get the dot product between all embeddings
     # shape (batch_size, batch_size)
     dot_product = tf.matmul(embeddings, tf.transpose(embeddings))
@@ -40,6 +43,24 @@ def _pairwise_distances(embeddings, squared=False):
 
     return distances
 
+@tf.function
+def _cross_distances(embeddings, others):
+    """Euclidean distances between two sets of embeddings.
+    Args:
+        embeddings: tensor of shape (batch_size, embed_dim)
+        others: tensor of shape (num_others, embed_dim)
+    Returns:
+        distances: tensor of shape (batch_size, num_others)
+    """
+    embeddings, others = tf.cast(embeddings, tf.float32), tf.cast(others, tf.float32)
+    distances = (tf.reduce_sum(tf.square(embeddings), axis=1, keepdims=True)
+                 - 2.0 * tf.matmul(embeddings, others, transpose_b=True)
+                 + tf.reduce_sum(tf.square(others), axis=1)[tf.newaxis, :])
+    distances = tf.maximum(distances, 0.0)
+    # same epsilon as _pairwise_distances so that the gradient of sqrt stays finite
+    mask = tf.cast(tf.equal(distances, 0.0), tf.float32)
+    return tf.sqrt(distances + mask * 1e-16) * (1.0 - mask)
+
 @tf.keras.saving.register_keras_serializable(package="Scale16s", name="unifrac_loss_var")
 def unifrac_loss_var(y_true, y_pred):
     @tf.function
@@ -50,14 +71,27 @@ def unifrac_loss_var(y_true, y_pred):
         # var_dist = tf.math.reduce_variance(square_dist, axis=1)
         # return tf.reduce_sum(var_dist)
         y_pred_dist = _pairwise_distances(y_pred)
-        difference = y_pred_dist - y_true
+        difference = y_pred_dist - tf.cast(y_true, tf.float32)
         square_dist = tf.square(difference) / 2.0
-        var_dist = tf.math.reduce_sum(square_dist, axis=0) / 16.0
+        var_dist = tf.math.reduce_sum(square_dist, axis=0) / tf.cast(tf.shape(y_pred)[0], tf.float32)
         return tf.reduce_sum(var_dist)
     return loss(y_true, y_pred)
 
+def unifrac_bank_loss(y_true, y_pred, bank):
+    """
+    unifrac_loss_var between the batch and the memory bank, y_true are the
+    (batch_size, bank_size) true distances (nan for empty bank slots). The
+    bank embeddings are not trained.
+    """
+    valid = tf.logical_not(tf.math.is_nan(y_true))
+    difference = _cross_distances(y_pred, tf.stop_gradient(bank)) - tf.where(valid, y_true, 0.0)
+    square_dist = tf.where(valid, tf.square(difference) / 2.0, 0.0)
+    var_dist = tf.math.reduce_sum(square_dist, axis=0) / tf.cast(tf.shape(y_pred)[0], tf.float32)
+    return tf.reduce_sum(var_dist)
+
 @tf.keras.saving.register_keras_serializable(package="Scale16s", name="regression_loss_variance")
 def regression_loss_variance(y_true, y_pred):
+    y_true, y_pred = tf.cast(y_true, tf.float32), tf.cast(y_pred, tf.float32)
     true_mean = tf.reduce_mean(y_true)
     true_std = tf.math.reduce_std(y_true)
     pred_mean = tf.reduce_mean(y_pred)
@@ -70,6 +104,7 @@ def regression_loss_variance(y_true, y_pred):
 
 @tf.keras.saving.register_keras_serializable(package="Scale16s", name="regression_loss_difference_in_means")
 def regression_loss_difference_in_means(y_true, y_pred):
+    y_true, y_pred = tf.cast(y_true, tf.float32), tf.cast(y_pred, tf.float32)
     true_mean = tf.reduce_mean(y_true)
     pred_mean = tf.reduce_mean(y_pred)
 
@@ -93,6 +128,7 @@ def regression_loss_combined(y_true, y_pred):
 
 @tf.keras.saving.register_keras_serializable(package="Scale16s", name="regression_loss_normal")
 def regression_loss_normal(y_true, y_pred):
+    y_true, y_pred = tf.cast(y_true, tf.float32), tf.cast(y_pred, tf.float32)
     true_mean = tf.reduce_mean(y_true)
     true_variance = tf.math.reduce_variance(y_true)
 
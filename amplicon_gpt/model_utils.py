@@ -5,9 +5,11 @@ from biom import load_table
 import tensorflow as tf
 import keras_nlp
 from tensorflow_models import nlp # need for PositionEmbedding without cannot load base_model
-from amplicon_gpt.losses import unifrac_loss_var, _pairwise_distances # need for unifrac_loss_var without cannot load base_model
+from amplicon_gpt.losses import unifrac_loss_var, unifrac_bank_loss, _pairwise_distances # need for unifrac_loss_var without cannot load base_model
 from amplicon_gpt.losses import regression_loss_variance, regression_loss_difference_in_means, regression_loss_combined, regression_loss_normal
-from amplicon_gpt.layers import NucleotideSequenceEmbedding, SampleEncoder
+from amplicon_gpt.layers import NucleotideSequenceEmbedding, ConvNucleotideEmbedding, SampleEncoder, SetSampleEncoder, PoolingByMultiheadAttention
+from amplicon_gpt.cache import load_artifact
+from amplicon_gpt.data_utils import load_encoded_table
 
 # physical_devices = tf.config.list_physical_devices('GPU')
 # for device in physical_devices:
@@ -21,11 +23,112 @@ def append_config_num(config, num):
     config['name'] = f"{config['name']}_num"
     return config
 
+def set_precision(mixed_precision=None, **kwargs):
+    """
+    Sets the global keras dtype policy, i.e. 'mixed_float16' or
+    'mixed_bfloat16' (None keeps float32). Must be called before the layers
+    of a model are created. Model outputs and losses stay in float32.
+    """
+    tf.keras.mixed_precision.set_global_policy(mixed_precision or 'float32')
+
+@tf.keras.saving.register_keras_serializable(package="Scale16s", name="GlobalBatchModel")
+class GlobalBatchModel(tf.keras.Model):
+    """
+    Model whose loss and metrics see the whole global batch when trained
+    with a tf.distribute strategy. Each replica gets its slice of the
+    global batch with the (replica batch, global batch) targets of
+    data_utils.replica_dist_dataset, the outputs and targets of all replicas
+    are gathered before the (pairwise) loss, i.e. unifrac_loss_var, is
+    computed. Each replica computes the same loss, the gradients through the
+    gather sum to the gradient of the single device loss.
+    """
+    @property
+    def distribute_reduction_method(self):
+        # the replicas already agree on the loss and metrics, summing them
+        # would scale the logs by the number of replicas
+        return 'first'
+
+    def _gather(self, y, y_pred):
+        replica_context = tf.distribute.get_replica_context()
+        if replica_context is None or replica_context.num_replicas_in_sync == 1:
+            return y, y_pred
+        # all_gather needs placed tensors, the replica inputs are not
+        y, y_pred = tf.identity(y), tf.identity(y_pred)
+        return replica_context.all_gather(y, axis=0), replica_context.all_gather(y_pred, axis=0)
+
+    def compute_loss(self, x=None, y=None, y_pred=None, sample_weight=None):
+        y, y_pred = self._gather(y, y_pred)
+        return super().compute_loss(x, y, y_pred, sample_weight)
+
+    def compute_metrics(self, x, y, y_pred, sample_weight):
+        y, y_pred = self._gather(y, y_pred)
+        return super().compute_metrics(x, y, y_pred, sample_weight)
+
+class MemoryBank:
+    """
+    Embeddings of the previous training batches of a MemoryBankModel, the
+    batch in slot i is stored in rows [i*batch_size, (i+1)*batch_size).
+    Not a keras object, i.e. not saved with the model.
+    """
+    def __init__(self, size, embedding_dim):
+        self.embeddings = tf.Variable(tf.zeros((size, embedding_dim)), trainable=False, name='memory_bank')
+        self.loss = tf.keras.metrics.Mean(name='bank_loss')
+
+    def store(self, embeddings, slot):
+        batch_size = tf.shape(embeddings)[0]
+        positions = tf.cast(slot, tf.int32) * batch_size + tf.range(batch_size)
+        self.embeddings.scatter_update(tf.IndexedSlices(tf.cast(embeddings, tf.float32), positions))
+
+@tf.keras.saving.register_keras_serializable(package="Scale16s", name="MemoryBankModel")
+class MemoryBankModel(GlobalBatchModel):
+    """
+    Base model whose training loss adds unifrac_bank_loss, the distances
+    between the batch and the memory_bank (a MemoryBank of the embeddings
+    of the previous batches). Trains on data_utils.batch_dist_dataset with
+    memory_bank_size, validation only uses the batch.
+    """
+    memory_bank = None
+
+    def train_step(self, data):
+        x, (y, bank_y, slot) = data
+        with tf.GradientTape() as tape:
+            y_pred = self(x, training=True)
+            bank_loss = unifrac_bank_loss(bank_y, y_pred, self.memory_bank.embeddings)
+            loss = self.compute_loss(x, y, y_pred) + bank_loss
+        self.optimizer.minimize(loss, self.trainable_variables, tape=tape)
+        self.memory_bank.store(tf.stop_gradient(y_pred), slot)
+        self.memory_bank.loss.update_state(bank_loss)
+        return dict(self.compute_metrics(x, y, y_pred, None), bank_loss=self.memory_bank.loss.result())
+
+    def reset_metrics(self):
+        super().reset_metrics()
+        if self.memory_bank is not None:
+            self.memory_bank.loss.reset_state()
+
 """
 
 """
 
-def transfer_learn_base(sequence_tokenizer, lstm_seq_out, batch_size, max_num_per_seq, dropout, root_path, load_prev_path=False, **kwargs):
+def transfer_learn_base(sequence_tokenizer, lstm_seq_out, batch_size, max_num_per_seq, dropout, root_path, load_prev_path=False, input_type='string', nucleotide_encoder='lstm', attention='full', attention_chunk_size=256, sample_encoder='transformer', num_inducing_points=32, memory_bank_size=None, mixed_precision=None, jit_compile=False, **kwargs):
+    """
+    input_type 'string' takes the ASV strings and tokenizes them with
+    sequence_tokenizer inside the model, 'tokens' takes the int32 tokens of
+    data_utils.get_token_inputs (sequence_tokenizer is unused).
+    jit_compile requires input_type 'tokens' as XLA does not support the
+    string ops of the tokenizer.
+    nucleotide_encoder selects the per ASV encoder, 'lstm'
+    (NucleotideSequenceEmbedding) or 'conv' (ConvNucleotideEmbedding).
+    attention selects the self attention of the sample encoder, 'full',
+    'chunked' or 'linear' (see layers.SampleEncoderBlock).
+    sample_encoder 'isab' replaces the sample encoder with the permutation
+    invariant layers.SetSampleEncoder and the LSTM readout with
+    layers.PoolingByMultiheadAttention (attention is then unused).
+    Under a tf.distribute strategy, batch_size is the per replica batch
+    size (see GlobalBatchModel).
+    memory_bank_size returns a MemoryBankModel with a bank of the embeddings
+    of the last memory_bank_size training samples.
+    """
+    set_precision(mixed_precision)
     loss = unifrac_loss_var
     @tf.keras.saving.register_keras_serializable(package="Scale16s", name="MAE")
     class MAE(tf.keras.metrics.Metric):
@@ -37,7 +140,7 @@ def transfer_learn_base(sequence_tokenizer, lstm_seq_out, batch_size, max_num_pe
         @tf.function
         def update_state(self, y_true, y_pred, sample_weight=None):
             self.loss.assign_add(tf.reduce_sum(tf.abs(_pairwise_distances(y_pred)-y_true)))
-            self.i.assign_add(tf.constant(batch_size, dtype=tf.float32))
+            self.i.assign_add(tf.cast(tf.shape(y_pred)[0], tf.float32))
 
         def result(self):
             return self.loss / self.i
@@ -59,28 +162,49 @@ def transfer_learn_base(sequence_tokenizer, lstm_seq_out, batch_size, max_num_pe
     conv_2_filter = 64
     MAX_SEQ = 1600
 
-    input = tf.keras.Input(shape=(None, 1), batch_size=batch_size,  name='model_input',
-                           dtype=tf.string)
-    
-    output = sequence_tokenizer(input)
+    if input_type == 'tokens':
+        input = tf.keras.Input(shape=(None, max_num_per_seq), batch_size=batch_size, name='model_input',
+                               dtype=tf.int32)
+        output = input
+    else:
+        input = tf.keras.Input(shape=(None, 1), batch_size=batch_size,  name='model_input',
+                               dtype=tf.string)
+        output = sequence_tokenizer(input)
     mask = tf.reduce_any(tf.not_equal(output, 0), axis=2)
 
-    encoding_blocks = [NucleotideSequenceEmbedding(d_model, dropout), 
-                       SampleEncoder(d_model, dropout, num_enc_layers, num_heads, dff, norm_first),
-                       tf.keras.layers.LSTM(64, dropout=dropout, name='asv_lstm'),
-                       tf.keras.layers.Dense(32, name='base_output')]
+    if nucleotide_encoder == 'conv':
+        nucleotide_embedding = ConvNucleotideEmbedding(d_model, dropout)
+    else:
+        nucleotide_embedding = NucleotideSequenceEmbedding(d_model, dropout)
+    if sample_encoder == 'isab':
+        asv_encoder = SetSampleEncoder(d_model, dropout, num_enc_layers, num_heads, dff,
+                                       num_inducing_points=num_inducing_points)
+        # an LSTM readout would depend on the order of the ASVs
+        readout = PoolingByMultiheadAttention(num_heads, dff, dropout, name='asv_pooling')
+    else:
+        asv_encoder = SampleEncoder(d_model, dropout, num_enc_layers, num_heads, dff, norm_first,
+                                    attention=attention, attention_chunk_size=attention_chunk_size)
+        readout = tf.keras.layers.LSTM(64, dropout=dropout, name='asv_lstm')
+    encoding_blocks = [nucleotide_embedding, 
+                       asv_encoder,
+                       readout,
+                       tf.keras.layers.Dense(32, name='base_output', dtype='float32')]
     output = tf.keras.Sequential(encoding_blocks)(output, mask=mask, training=True)
 
-    model = tf.keras.Model(inputs=input, outputs=output)    
+    if memory_bank_size:
+        model = MemoryBankModel(inputs=input, outputs=output)
+        model.memory_bank = MemoryBank(memory_bank_size, output.shape[-1])
+    else:
+        model = GlobalBatchModel(inputs=input, outputs=output)
     lr = tf.keras.optimizers.schedules.ExponentialDecay(0.0001, decay_steps=100000, decay_rate=0.99, staircase=True)
     optimizer = tf.keras.optimizers.AdamW(learning_rate=lr, epsilon=1e-7)
-    model.compile(optimizer=optimizer,loss=loss, metrics=[MAE()])
+    model.compile(optimizer=optimizer,loss=loss, metrics=[MAE()], jit_compile=jit_compile)
     return model
 
 
 
 def load_full_base_model(base_model_path, **kwargs):
-    base_model = tf.keras.models.load_model(base_model_path)
+    base_model = tf.keras.models.load_model(base_model_path, compile=False)
     base_model.trainable = False
     return base_model
 
@@ -89,12 +213,88 @@ def get_base_model(base_model_path, **kwargs):
     Returns the base model input layer and the output of the 'community level' encoder (i.e. the transformer encoder block).
     This will also disable all trainable parameters.
     """
-    base_model = tf.keras.models.load_model(base_model_path)
+    base_model = tf.keras.models.load_model(base_model_path, compile=False)
     base_model.trainable = False
     input = base_model.inputs[0] # base model only has one input however, .inputs returns list
     base_output = base_model.get_layer('base_encoder_block_3').output
     return input, base_output
 
+def _find_layer(model, name):
+    """
+    get_layer that also searches nested models (i.e. the Sequential of the
+    base model).
+    """
+    for layer in model.layers:
+        if layer.name == name:
+            return layer
+        if isinstance(layer, tf.keras.Model):
+            found = _find_layer(layer, name)
+            if found is not None:
+                return found
+    return None
+
+def precompute_asv_embeddings(base_model_path, sequences, max_num_per_seq, chunk_size=1024, **kwargs):
+    """
+    Runs the frozen nucleotide embedding of the base model once per
+    observation.
+
+    Args:
+        sequences: (n_obs, seq_len) token matrix of the table
+    Returns:
+        (n_obs + 1, embedding_dim) array, row 0 is the padding embedding and
+        row i + 1 the embedding of observation i
+    """
+    base_model = tf.keras.models.load_model(base_model_path, compile=False)
+    nucleotide_embedding = _find_layer(base_model, 'nucleotide_sequence_embedding')
+    pad_width = max_num_per_seq - sequences.shape[1]
+    embeddings = []
+    for start in range(0, sequences.shape[0], chunk_size):
+        tokens = np.pad(sequences[start:start+chunk_size].astype(np.int32), ((0, 0), (0, pad_width)))
+        embeddings.append(nucleotide_embedding(tokens[np.newaxis], training=False)[0].numpy())
+    embeddings = np.concatenate(embeddings)
+    return np.concatenate([np.zeros((1, embeddings.shape[1]), dtype=embeddings.dtype), embeddings])
+
+def load_asv_embeddings(base_model_path, table_path, seq_len, max_num_per_seq, cache_dir=None, **kwargs):
+    """
+    Returns the cached per ASV embeddings of the base model, recomputed when
+    the base model or table changes.
+    """
+    sequences = load_encoded_table(table_path, seq_len, cache_dir=cache_dir)['sequences']
+    compute = lambda: {'embeddings': precompute_asv_embeddings(base_model_path, sequences, max_num_per_seq)}
+    return load_artifact('asv_embeddings', compute, [base_model_path, table_path],
+                         {'seq_len': seq_len, 'max_num_per_seq': max_num_per_seq}, cache_dir)['embeddings']
+
+def get_cached_base_model(base_model_path, asv_embeddings, **kwargs):
+    """
+    Same as get_base_model, except that the model input is the (1-based,
+    0 := padding) observation index of each ASV and the nucleotide
+    embedding is looked up from asv_embeddings instead of being recomputed.
+    Returns the model input, the output of the sample encoder and the ASV
+    mask.
+    """
+    base_model = tf.keras.models.load_model(base_model_path, compile=False)
+    base_model.trainable = False
+    sample_encoder = _find_layer(base_model, 'asv_sequence_embedding')
+
+    input = tf.keras.Input(shape=(None,), dtype=tf.int32, name='asv_input')
+    microbe_mask = tf.not_equal(input, 0)
+    embedding = tf.keras.layers.Embedding(asv_embeddings.shape[0], asv_embeddings.shape[1],
+                                          trainable=False, name='asv_embedding_cache')
+    output = embedding(input)
+    embedding.set_weights([asv_embeddings])
+    base_output = sample_encoder(output, mask=microbe_mask)
+    return input, base_output, microbe_mask
+
+def get_feature_input(feature_dim, **kwargs):
+    """
+    Input of a head only model trained from a feature_store.FeatureStore,
+    i.e. the precomputed output of the frozen base model encoder. Padded
+    ASVs are all zero features.
+    """
+    input = tf.keras.Input(shape=(None, feature_dim), dtype=tf.float32, name='feature_input')
+    microbe_mask = tf.reduce_any(tf.not_equal(input, 0.0), axis=-1)
+    return input, input, microbe_mask
+
 def _add_feature_regression_module(input, microbe_mask, lstm_seq_out, dropout, conv_config, num_enc_layers=4, output_units=1):
     num_heads = 4
     dff = 64
@@ -116,9 +316,10 @@ def _add_feature_regression_module(input, microbe_mask, lstm_seq_out, dropout, c
         output = tf.keras.layers.Dropout(dropout)(output, training=True)
         output = tf.keras.layers.MaxPool1D(2)(output)
     output = tf.keras.layers.Flatten(name='feature_flatten')(output)
-    return tf.keras.layers.Dense(output_units, use_bias=False, name='feature_regression_output')(output)
+    return tf.keras.layers.Dense(output_units, use_bias=False, name='feature_regression_output', dtype='float32')(output)
 
-def transfer_learn_feature_regression(load_prev_path, lstm_seq_out, dropout, root_path, num_enc_layers, use_ema=False, ema_momentum=None, **config):
+def transfer_learn_feature_regression(load_prev_path, lstm_seq_out, dropout, root_path, num_enc_layers, use_ema=False, ema_momentum=None, asv_embeddings=None, feature_dim=None, mixed_precision=None, jit_compile=False, **config):
+    set_precision(mixed_precision)
     if load_prev_path:
         model = tf.keras.models.load_model(os.path.join(root_path, 'model.keras'))
         lr = tf.keras.optimizers.schedules.ExponentialDecay(0.0005, decay_steps=10000, decay_rate=0.99, staircase=True)
@@ -126,7 +327,7 @@ def transfer_learn_feature_regression(load_prev_path, lstm_seq_out, dropout, roo
             optimizer = tf.keras.optimizers.AdamW(learning_rate=lr, epsilon=1e-8, ema_momentum=ema_momentum, use_ema=use_ema, ema_overwrite_frequency=None)
         else:
             optimizer = tf.keras.optimizers.AdamW(learning_rate=lr, epsilon=1e-8)
-        model.compile(optimizer=optimizer,loss=loss, metrics=[MAE()])
+        model.compile(optimizer=optimizer,loss=loss, metrics=[MAE()], jit_compile=jit_compile)
         return model
 
     conv_config = [
@@ -145,14 +346,19 @@ def transfer_learn_feature_regression(load_prev_path, lstm_seq_out, dropout, roo
             self.i = self.add_weight(name='i', initializer='zero', dtype=tf.float32)
 
         def update_state(self, y_true, y_pred,  **kwargs):
-            self.loss.assign_add(tf.reduce_sum(tf.abs(y_pred-y_true)))
+            self.loss.assign_add(tf.reduce_sum(tf.abs(tf.cast(y_pred, tf.float32)-y_true)))
             self.i.assign_add(16.0)
 
         def result(self):
             return self.loss / self.i
         
-    input, base_output = get_base_model(**config)
-    microbe_mask = tf.cast(tf.not_equal(input[:, :, 0], 0), tf.bool)
+    if feature_dim is not None:
+        input, base_output, microbe_mask = get_feature_input(feature_dim)
+    elif asv_embeddings is not None:
+        input, base_output, microbe_mask = get_cached_base_model(asv_embeddings=asv_embeddings, **config)
+    else:
+        input, base_output = get_base_model(**config)
+        microbe_mask = tf.cast(tf.not_equal(input[:, :, 0], 0), tf.bool)
     output = _add_feature_regression_module(base_output, microbe_mask,
                                        lstm_seq_out, dropout, conv_config, 
                                        num_enc_layers, output_units=1)
@@ -163,7 +369,7 @@ def transfer_learn_feature_regression(load_prev_path, lstm_seq_out, dropout, roo
         optimizer = tf.keras.optimizers.AdamW(learning_rate=lr, epsilon=1e-8, ema_momentum=ema_momentum, use_ema=use_ema, ema_overwrite_frequency=None)
     else:
         optimizer = tf.keras.optimizers.AdamW(learning_rate=lr, epsilon=1e-8)
-    model.compile(optimizer=optimizer,loss=loss, metrics=[MAE()])
+    model.compile(optimizer=optimizer,loss=loss, metrics=[MAE()], jit_compile=jit_compile)
     return model
 
 
@@ -183,9 +389,10 @@ def _add_feature_classification_module(input, microbe_mask, lstm_seq_out, dropou
     for (conv_filter, kernel_size, stride, padding) in conv_config:
         output = tf.keras.layers.Conv1D(conv_filter, kernel_size, strides=stride, padding=padding)(output)
     output = tf.keras.layers.Flatten(name='classification_flatten')(output)   
-    return tf.keras.layers.Dense(output_units, activation='sigmoid', name='classification_output')(output)
+    return tf.keras.layers.Dense(output_units, activation='sigmoid', name='classification_output', dtype='float32')(output)
 
-def transfer_learn_feature_classification(continue_training, lstm_seq_out, dropout, root_path, num_enc_layers, use_ema=False, ema_momentum=None, **config):
+def transfer_learn_feature_classification(continue_training, lstm_seq_out, dropout, root_path, num_enc_layers, use_ema=False, ema_momentum=None, asv_embeddings=None, feature_dim=None, mixed_precision=None, jit_compile=False, **config):
+    set_precision(mixed_precision)
     METRICS = [
         tf.keras.metrics.BinaryCrossentropy(name='cross entropy'),  # same as model's loss
         tf.keras.metrics.MeanSquaredError(name='Brier score'),
@@ -208,8 +415,13 @@ def transfer_learn_feature_classification(continue_training, lstm_seq_out, dropo
                     create_conv_config(num_filters=64, kernel_size=2, stride=2, padding='valid'),
                 ]
     
-    input, base_output = get_base_model(**config)
-    microbe_mask = tf.cast(tf.not_equal(input[:, :, 0], 0), tf.bool)
+    if feature_dim is not None:
+        input, base_output, microbe_mask = get_feature_input(feature_dim)
+    elif asv_embeddings is not None:
+        input, base_output, microbe_mask = get_cached_base_model(asv_embeddings=asv_embeddings, **config)
+    else:
+        input, base_output = get_base_model(**config)
+        microbe_mask = tf.cast(tf.not_equal(input[:, :, 0], 0), tf.bool)
     output = _add_feature_classification_module(base_output, microbe_mask,
                                        lstm_seq_out, dropout, conv_config, 
                                        num_enc_layers, output_units=1)
@@ -220,5 +432,5 @@ def transfer_learn_feature_classification(continue_training, lstm_seq_out, dropo
     else:
         optimizer = tf.keras.optimizers.AdamW(learning_rate=lr, epsilon=1e-8)
     loss = tf.keras.losses.BinaryCrossentropy(reduction='sum_over_batch_size')
-    model.compile(optimizer=optimizer,loss=loss, metrics=METRICS)
+    model.compile(optimizer=optimizer,loss=loss, metrics=METRICS, jit_compile=jit_compile)
     return model
\ No newline at end of file
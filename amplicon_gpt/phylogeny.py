@@ -0,0 +1,102 @@
+import numpy as np
+from scipy.sparse import csc_matrix, csr_matrix
+from skbio import TreeNode
+from amplicon_gpt.cache import load_artifact
+
+def _build_ancestors(tree_path, o_ids):
+    """
+    Walks the tree once in postorder and returns the branch lengths of
+    every node and, for every observation, the nodes on its path to the
+    root (zero length branches and the root are skipped as they never
+    contribute to the distance).
+    """
+    tree = TreeNode.read(tree_path, convert_underscores=False)
+    nodes = list(tree.postorder(include_self=True))
+    node_index = {id(node): i for i, node in enumerate(nodes)}
+    parent = np.array([node_index[id(node.parent)] if node.parent is not None else -1
+                       for node in nodes])
+    lengths = np.array([node.length or 0.0 for node in nodes], dtype=np.float32)
+    lengths[parent == -1] = 0.0
+
+    tip_index = {node.name: i for i, node in enumerate(nodes) if node.is_tip()}
+    current = np.array([tip_index.get(o_id, -1) for o_id in o_ids])
+    obs = np.arange(len(o_ids))
+    rows, cols = [], []
+    # climb all tips one level at a time
+    while len(current):
+        valid = current >= 0
+        current, obs = current[valid], obs[valid]
+        keep = lengths[current] > 0
+        rows.append(current[keep])
+        cols.append(obs[keep])
+        current = parent[current]
+
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    ancestors = csc_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)),
+                           shape=(len(nodes), len(o_ids)))
+    ancestors.sort_indices()
+    return {
+        'lengths': lengths,
+        'ancestors_indptr': ancestors.indptr,
+        'ancestors_indices': ancestors.indices
+    }
+
+class BatchUnifrac:
+    """
+    Computes unweighted unifrac distances between the samples of a batch
+    only, so the cost of pretraining scales with the number of batches
+    instead of the number of sample pairs.
+
+    Args:
+        lengths: (n_nodes,) branch length of each node
+        ancestors: (n_nodes, n_obs) csc indicator of the nodes on the
+            path from each observation to the root
+        row_splits: (n_samples + 1,) start/end of each sample in indices
+        indices: observation indices of each sample
+    """
+    def __init__(self, lengths, ancestors, row_splits, indices):
+        self.lengths = lengths
+        self.ancestors = ancestors
+        self.row_splits = row_splits
+        self.indices = indices
+
+    def __call__(self, sample_indices):
+        sample_indices = np.asarray(sample_indices)
+        starts = self.row_splits[sample_indices]
+        sizes = self.row_splits[sample_indices + 1] - starts
+        obs = np.concatenate([self.indices[s:s + n] for s, n in zip(starts, sizes)])
+        columns = np.repeat(np.arange(len(sample_indices)), sizes)
+        batch_obs, inverse = np.unique(obs, return_inverse=True)
+        samples = csr_matrix((np.ones(len(obs), dtype=np.float32), (inverse, columns)),
+                             shape=(len(batch_obs), len(sample_indices)))
+
+        # nodes observed in each sample of the batch
+        observed = (self.ancestors[:, batch_obs] @ samples).tocsr()
+        nodes = np.flatnonzero(observed.getnnz(axis=1))
+        observed = (observed[nodes].toarray() > 0).astype(np.float32)
+        lengths = self.lengths[nodes]
+
+        total = lengths @ observed
+        shared = (observed * lengths[:, np.newaxis]).T @ observed
+        union = total[:, np.newaxis] + total[np.newaxis, :] - shared
+        unique = union - shared
+        distances = np.divide(unique, union, out=np.zeros_like(union), where=union > 0)
+        np.fill_diagonal(distances, 0.0)
+        return distances.astype(np.float32)
+
+def load_batch_unifrac(table_path, tree_path, samples, cache_dir=None):
+    """
+    Returns a BatchUnifrac for the table, the tree traversal is cached
+    and only recomputed when the table or tree changes.
+
+    Args:
+        samples: the cached samples of the table (see
+            data_utils.load_encoded_table)
+    """
+    compute = lambda: _build_ancestors(tree_path, samples['observation_ids'])
+    phylogeny = load_artifact('phylogeny', compute, [table_path, tree_path], {}, cache_dir)
+    n_nodes, n_obs = len(phylogeny['lengths']), len(samples['observation_ids'])
+    ancestors = csc_matrix((np.ones(len(phylogeny['ancestors_indices']), dtype=np.float32),
+                            phylogeny['ancestors_indices'], phylogeny['ancestors_indptr']),
+                           shape=(n_nodes, n_obs))
+    return BatchUnifrac(phylogeny['lengths'], ancestors, samples['row_splits'], samples['indices'])
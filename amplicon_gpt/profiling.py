@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import time
+import collections
+import numpy as np
+import tensorflow as tf
+
+def _count_asvs(inputs):
+    """
+    Returns the number of samples, real ASVs and (padded) ASV slots of a
+    batch of model inputs, the first tensor of inputs is the one with the
+    ASV axis (tokens, observation indices or ASV strings, 0 or '' being
+    padding). Features without an ASV axis count no ASVs.
+    """
+    x = tf.nest.flatten(inputs)[0]
+    if isinstance(x, tf.RaggedTensor):
+        lengths = x.row_lengths()
+        samples = x.nrows()
+        return samples, tf.reduce_sum(lengths), samples * tf.reduce_max(lengths)
+    samples = tf.shape(x, out_type=tf.int64)[0]
+    if x.shape.rank is None or x.shape.rank < 2 or x.dtype.is_floating:
+        return samples, tf.constant(0, tf.int64), tf.constant(0, tf.int64)
+    present = tf.not_equal(x, '' if x.dtype == tf.string else tf.zeros([], x.dtype))
+    if x.shape.rank > 2:
+        present = tf.reduce_any(present, axis=list(range(2, x.shape.rank)))
+    return samples, tf.math.count_nonzero(present, dtype=tf.int64), samples * tf.shape(x, out_type=tf.int64)[1]
+
+def _rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        return _peak_rss_mb()
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+def _format(value):
+    return 'n/a' if value is None else f'{value:.4g}'
+
+def _rates(steps):
+    seconds = sum(step['step_time'] for step in steps)
+    data_wait = sum(step['data_wait'] for step in steps)
+    asvs = sum(step['asvs'] for step in steps)
+    slots = sum(step['slots'] for step in steps)
+    return {
+        'steps': len(steps),
+        'seconds': seconds,
+        'data_wait_fraction': data_wait / seconds if seconds else None,
+        'samples_per_second': sum(step['samples'] for step in steps) / seconds if seconds else None,
+        'asvs_per_second': asvs / seconds if seconds and slots else None,
+        'padding_efficiency': asvs / slots if slots else None,
+    }
+
+class StepProfiler(tf.keras.callbacks.Callback):
+    def __init__(self, root_path, logdir=None, profile_steps=None, **kwargs):
+        """
+        Records the wall time of each training step split into the wait for
+        the input pipeline and the compute, the samples and ASVs per second,
+        the padding efficiency and the host memory (RSS). Steps are written
+        to TensorBoard in logdir (default root_path/logs) and summarized in
+        logdir/profile.json at the end of training. profile_steps [start,
+        stop] captures a tf.profiler trace of these (global) steps.
+
+        The training dataset must be passed through instrument.
+        """
+        super().__init__()
+        self.logdir = logdir if logdir is not None else os.path.join(root_path, 'logs')
+        self.profile_steps = profile_steps
+        self.ready = collections.deque()
+        self.writer = None
+        self.tracing = False
+        self.global_step = 0
+        self.steps = []
+        self.epochs = []
+
+    def instrument(self, dataset):
+        """
+        Adds a last (synchronous) stage to dataset that notes when each batch
+        is handed to the training step and how many ASVs it holds.
+        """
+        def mark(*element):
+            samples, asvs, slots = _count_asvs(element[0])
+            ready = tf.py_function(self._record, [samples, asvs, slots], tf.int64)
+            with tf.control_dependencies([ready]):
+                element = tf.nest.map_structure(tf.identity, element)
+            return element if len(element) > 1 else element[0]
+        options = tf.data.Options()
+        # a prefetch after the mark would hide the wait
+        options.experimental_optimization.inject_prefetch = False
+        return dataset.map(mark).with_options(options)
+
+    def _record(self, samples, asvs, slots):
+        self.ready.append((time.perf_counter(), int(samples), int(asvs), int(slots)))
+        return 0
+
+    def callbacks(self):
+        """
+        This callback and the keras TensorBoard callback of the epoch logs.
+        """
+        return [self, tf.keras.callbacks.TensorBoard(log_dir=self.logdir, profile_batch=0)]
+
+    def on_train_begin(self, logs=None):
+        os.makedirs(self.logdir, exist_ok=True)
+        self.writer = tf.summary.create_file_writer(os.path.join(self.logdir, 'profile'))
+
+    def on_epoch_begin(self, epoch, logs=None):
+        # batches left over by the iterator of the previous epoch
+        self.ready.clear()
+        self.epoch_start = len(self.steps)
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.profile_steps and self.global_step == self.profile_steps[0]:
+            tf.profiler.experimental.start(self.logdir)
+            self.tracing = True
+        self.step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        end = time.perf_counter()
+        step_time = end - self.step_start
+        if self.ready:
+            ready, samples, asvs, slots = self.ready.popleft()
+        else:
+            ready, samples, asvs, slots = self.step_start, 0, 0, 0
+        data_wait = min(max(ready - self.step_start, 0.0), step_time)
+        step = {'step_time': step_time, 'data_wait': data_wait, 'samples': samples,
+                'asvs': asvs, 'slots': slots, 'rss_mb': _rss_mb()}
+        self.steps.append(step)
+
+        with self.writer.as_default(step=self.global_step):
+            tf.summary.scalar('step_time', step_time)
+            tf.summary.scalar('data_wait', data_wait)
+            tf.summary.scalar('compute', step_time - data_wait)
+            tf.summary.scalar('samples_per_second', samples / step_time)
+            if slots:
+                tf.summary.scalar('asvs_per_second', asvs / step_time)
+                tf.summary.scalar('padding_efficiency', asvs / slots)
+            if step['rss_mb'] is not None:
+                tf.summary.scalar('rss_mb', step['rss_mb'])
+
+        if self.tracing and self.global_step >= self.profile_steps[1]:
+            tf.profiler.experimental.stop()
+            self.tracing = False
+        self.global_step += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epochs.append(dict(_rates(self.steps[self.epoch_start:]), epoch=epoch))
+        self.writer.flush()
+
+    def summary(self):
+        """
+        The profile of the training so far, the rates leave out the first
+        step (tracing and compiling the train function).
+        """
+        step_times = np.array([step['step_time'] for step in self.steps])
+        summary = dict(_rates(self.steps[1:]),
+                       total_steps=len(self.steps),
+                       first_step_time=float(step_times[0]) if len(step_times) else None,
+                       step_time={'median': float(np.median(step_times[1:])),
+                                  'p90': float(np.percentile(step_times[1:], 90))}
+                       if len(step_times) > 1 else None,
+                       peak_rss_mb=_peak_rss_mb(),
+                       profile_steps=self.profile_steps,
+                       epochs=self.epochs)
+        for device in tf.config.list_logical_devices('GPU'):
+            summary[f'{device.name}_peak_mb'] = tf.config.experimental.get_memory_info(device.name)['peak'] / 2**20
+        return summary
+
+    def on_train_end(self, logs=None):
+        if self.tracing:
+            tf.profiler.experimental.stop()
+            self.tracing = False
+        self.writer.flush()
+        summary = self.summary()
+        with open(os.path.join(self.logdir, 'profile.json'), 'w') as f:
+            json.dump(summary, f, indent=4)
+        print(f"profile: {_format(summary['samples_per_second'])} samples/s, "
+              f"{_format(summary['asvs_per_second'])} ASVs/s, "
+              f"data wait {_format(summary['data_wait_fraction'])} of the step time, "
+              f"padding efficiency {_format(summary['padding_efficiency'])}, "
+              f"peak RSS {_format(summary['peak_rss_mb'])} MB")
@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from biom import Table
+from biom.util import biom_open
+from amplicon_gpt.biom_reader import read_ids, read_samples
+
+class TestBiomReader(unittest.TestCase):
+
+    def setUp(self):
+        data = np.array([[1, 0, 3, 0, 0, 2],
+                         [0, 2, 1, 0, 1, 0],
+                         [4, 0, 0, 0, 0, 1],
+                         [0, 1, 0, 0, 3, 0]])
+        self.table = Table(data, ['O0', 'O1', 'O2', 'O3'], ['S0', 'S1', 'S2', 'S3', 'S4', 'S5'])
+        self.tmp = tempfile.TemporaryDirectory()
+        self.table_path = os.path.join(self.tmp.name, 'table.biom')
+        with biom_open(self.table_path, 'w') as f:
+            self.table.to_hdf5(f, 'test')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_read_ids(self):
+        np.testing.assert_array_equal(read_ids(self.table_path), self.table.ids())
+        np.testing.assert_array_equal(read_ids(self.table_path, axis='observation'),
+                                      self.table.ids(axis='observation'))
+
+    def test_read_ids_tsv(self):
+        tsv_path = os.path.join(self.tmp.name, 'table.tsv')
+        with open(tsv_path, 'w') as f:
+            f.write(self.table.to_tsv())
+        np.testing.assert_array_equal(read_ids(tsv_path), self.table.ids())
+        np.testing.assert_array_equal(read_ids(tsv_path, axis='observation'),
+                                      self.table.ids(axis='observation'))
+
+    def test_read_samples(self):
+        samples = read_samples(self.table_path, sample_ids=['S5', 'S0', 'S4', 'S3'],
+                               min_count=1, chunk_size=2)
+        np.testing.assert_array_equal(samples['sample_ids'], ['S0', 'S3', 'S4', 'S5'])
+        np.testing.assert_array_equal(samples['row_splits'], [0, 1, 1, 2, 3])
+        np.testing.assert_array_equal(samples['indices'], [2, 3, 0])
+        np.testing.assert_array_equal(samples['counts'], [4, 3, 2])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from amplicon_gpt.cache import load_artifact
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp.name, 'cache')
+        self.calls = 0
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _write(self, name, content):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def _load(self, path, **params):
+        def compute():
+            self.calls += 1
+            with open(path) as f:
+                return {'values': np.array([len(f.read())] + list(params.values()), dtype=np.float64)}
+        return load_artifact('samples', compute, [path], params, self.cache_dir)['values']
+
+    def _entries(self):
+        return len(os.listdir(os.path.join(self.cache_dir, 'samples')))
+
+    def test_params_and_inputs_coexist(self):
+        table = self._write('table.biom', 'abc')
+        other = self._write('other.biom', 'abcd')
+        self._load(table, min_count=0)
+        self._load(table, min_count=0.5)
+        self._load(other, min_count=0)
+        self.assertEqual(self._entries(), 3)
+        np.testing.assert_array_equal(self._load(table, min_count=0), [3, 0])
+        np.testing.assert_array_equal(self._load(other, min_count=0), [4, 0])
+        self.assertEqual(self.calls, 3)
+
+    def test_changed_input_replaces_entry(self):
+        table = self._write('table.biom', 'abc')
+        self._load(table, min_count=0)
+        self._load(table, min_count=0.5)
+        self._write('table.biom', 'abcdef')
+        np.testing.assert_array_equal(self._load(table, min_count=0), [6, 0])
+        # the entry of the old content with min_count=0 is removed
+        self.assertEqual(self._entries(), 2)
+
+if __name__ == '__main__':
+    unittest.main()
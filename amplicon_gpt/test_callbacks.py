@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import tensorflow as tf
+from amplicon_gpt.callbacks import (
+    StreamingMAE, StreamingCurves, evaluate_dataset, mean_confidence_interval, MAE_Scatter
+)
+
+class TestEvaluateDataset(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.x = rng.random((37, 4)).astype(np.float32)
+        self.y = rng.random((37, 1)).astype(np.float32)
+        self.calls = 0
+
+    def _gen(self):
+        self.calls += 1
+        order = np.random.permutation(len(self.x))
+        for i in range(0, len(order), 8):
+            yield self.x[order[i:i + 8]], self.y[order[i:i + 8]]
+
+    def test_single_pass(self):
+        dataset = tf.data.Dataset.from_generator(
+            self._gen, output_signature=(tf.TensorSpec((None, 4), tf.float32),
+                                         tf.TensorSpec((None, 1), tf.float32)))
+        inputs = tf.keras.Input((4,))
+        model = tf.keras.Model(inputs, tf.keras.layers.Dense(1)(inputs))
+        mae = StreamingMAE()
+        labels, predictions = evaluate_dataset(model, dataset, [mae])
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(labels.shape, (37,))
+        # predictions stay aligned with the randomized labels
+        expected = model.predict(self.x, verbose=0)[:, 0]
+        order = [np.flatnonzero(self.y[:, 0] == label)[0] for label in labels]
+        np.testing.assert_allclose(predictions, expected[order], rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(mae.result(), mean_confidence_interval(np.abs(labels - predictions)),
+                                   rtol=1e-5)
+
+    def test_streaming_curves(self):
+        labels = np.array([0, 0, 1, 1, 1, 0])
+        scores = np.array([0.1, 0.6, 0.8, 0.4, 0.95, 0.2])
+        curves = StreamingCurves(num_thresholds=10)
+        curves.update(labels[:3], scores[:3])
+        curves.update(labels[3:], scores[3:])
+        precision, recall, fpr = curves.result()
+        self.assertEqual(recall[0], 0)
+        self.assertEqual(recall[-1], 1)
+        self.assertEqual(fpr[-1], 1)
+        # the thresholds 0.5 and 0.7 lie between the scores
+        np.testing.assert_allclose([recall[5], fpr[5], precision[5]], [2 / 3, 1 / 3, 2 / 3])
+        np.testing.assert_allclose([recall[3], fpr[3], precision[3]], [2 / 3, 0, 1])
+
+class TestCheckpoint(unittest.TestCase):
+
+    def test_checkpoint_continues_training(self):
+        rng = np.random.default_rng(0)
+        x = rng.random((32, 4)).astype(np.float32)
+        y = (x.sum(axis=1, keepdims=True) * 10 + 20).astype(np.float32)
+        dataset = tf.data.Dataset.from_tensor_slices((x, y)).batch(8)
+        inputs = tf.keras.Input((4,))
+        model = tf.keras.Model(inputs, tf.keras.layers.Dense(1)(inputs))
+        model.compile('adam', 'mse')
+        with tempfile.TemporaryDirectory() as root_path:
+            model.fit(dataset, epochs=1, verbose=0,
+                      callbacks=[MAE_Scatter(root_path, dataset, 'gut', 'training')])
+            # the checkpoint keeps the compile config and optimizer state
+            # (i.e. for --continue-training)
+            checkpoint = tf.keras.models.load_model(os.path.join(root_path, 'model.keras'))
+            self.assertEqual(len(checkpoint.optimizer.variables()), len(model.optimizer.variables()))
+            checkpoint.fit(dataset, epochs=1, verbose=0)
+
+if __name__ == '__main__':
+    unittest.main()
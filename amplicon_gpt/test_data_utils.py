@@ -1,10 +1,23 @@
+import os
+import json
 import unittest
 import numpy as np
+import tensorflow as tf
 from biom.table import Table
-from amplicon_gpt.data_utils import get_sequencing_data
+from amplicon_gpt.data_utils import (
+    encode_sequences, encode_table, get_samples, select_top_k, get_sequencing_data, create_dataset,
+    _read_submatrix, _read_bank_submatrix, _add_memory_bank
+)
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', 'shu-aging', 'gut-configure.json')
 
 class TestSequencingData(unittest.TestCase):
 
+    def test_encode_sequences(self):
+        tokens = encode_sequences(['ACGTN', 'TG'], 4)
+        self.assertEqual(tokens.dtype, np.uint8)
+        np.testing.assert_array_equal(tokens, [[1, 2, 3, 4], [4, 3, 0, 0]])
+
     def test_get_sequencing_data(self):
         rng = np.random.default_rng(12345)
         rints = rng.integers(low=0, high=4, size=3)
@@ -12,4 +25,69 @@ class TestSequencingData(unittest.TestCase):
         data = np.arange(100).reshape(20, 5)
         s_ids = ['S%d' % i for i in range(5)]
         o_ids = [''.join([nuc_chars[i] for i in rng.integers(low=0, high=4, size=5)]) for _ in range(20)]
-        table = Table(data, o_ids, s_ids)
\ No newline at end of file
+        table = Table(data, o_ids, s_ids)
+
+        sequencing_data = encode_table(table, 5, min_count=0.5)
+        self.assertEqual(len(sequencing_data), 5)
+        for s_id, sample in zip(s_ids, sequencing_data):
+            o_inds = np.argwhere(table.data(s_id, axis='sample') > 0.5).flatten()
+            expected = [[nuc_chars.index(c) + 1 for c in o_ids[i]] for i in o_inds]
+            np.testing.assert_array_equal(sample, expected)
+
+    def test_select_top_k(self):
+        encoded = {'sample_ids': np.array(['S0', 'S1', 'S2']),
+                   'row_splits': np.array([0, 3, 3, 6]),
+                   'indices': np.array([1, 4, 7, 0, 2, 5], dtype=np.int32),
+                   'counts': np.array([1, 5, 5, 2, 9, 1], dtype=np.float32)}
+        top_k = select_top_k(encoded, 2)
+        np.testing.assert_array_equal(top_k['row_splits'], [0, 2, 2, 4])
+        np.testing.assert_array_equal(top_k['indices'], [4, 7, 0, 2])
+        samples, counts = get_samples(top_k, drop_empty=True, with_counts=True)
+        np.testing.assert_array_equal(samples[1], [0, 2])
+        np.testing.assert_array_equal(counts[1], [2, 9])
+
+    def test_read_submatrix_rows(self):
+        distances = np.arange(36, dtype=np.float32).reshape(6, 6)
+        indices = np.array([4, 1, 5, 0])
+        np.testing.assert_array_equal(_read_submatrix(distances, indices),
+                                      distances[np.ix_(indices, indices)])
+        np.testing.assert_array_equal(_read_submatrix(distances, indices, np.array([2, 3])),
+                                      distances[np.ix_([5, 0], indices)])
+
+    def test_read_bank_submatrix(self):
+        distances = np.arange(36, dtype=np.float32).reshape(6, 6)
+        bank = _read_bank_submatrix(distances, np.array([4, 1]), np.array([3, -1, 0, -1]))
+        np.testing.assert_array_equal(bank[:, [0, 2]], distances[np.ix_([4, 1], [3, 0])])
+        self.assertTrue(np.isnan(bank[:, [1, 3]]).all())
+
+    def test_add_memory_bank(self):
+        indices = np.arange(10, dtype=np.int64).reshape(5, 2)
+        dataset = tf.data.Dataset.from_tensor_slices((indices, indices.astype(np.float32)))
+        # repeated before the scan as in batch_dist_dataset
+        batches = list(_add_memory_bank(dataset.repeat(2), 4, 2).as_numpy_iterator())
+        self.assertEqual(len(batches), 10)
+        slots = [slot for _, _, _, slot in batches]
+        self.assertEqual(slots, [0, 1] * 5)
+        # the bank carries over into the second epoch
+        expected = [[-1, -1, -1, -1], [0, 1, -1, -1], [0, 1, 2, 3], [4, 5, 2, 3], [4, 5, 6, 7],
+                    [8, 9, 6, 7], [8, 9, 0, 1], [2, 3, 0, 1], [2, 3, 4, 5], [6, 7, 4, 5]]
+        for step, (ind, x, bank_indices, _) in enumerate(batches):
+            np.testing.assert_array_equal(ind, indices[step % 5])
+            np.testing.assert_array_equal(bank_indices, expected[step])
+
+    def test_create_dataset_from_config(self):
+        # the commands pass the whole config to the dataset builders
+        with open(CONFIG_PATH) as f:
+            config = json.load(f)
+        config['batch_size'] = 2
+        encoded = {'sequences': encode_sequences(['ACGT', 'GGTA', 'TTAC'], config['seq_len'])}
+        samples = [np.array([0, 2]), np.array([1]), np.array([0, 1, 2]), np.array([2])]
+        sequencing_data = get_sequencing_data(encoded, samples)
+        dataset = create_dataset(sequencing_data, np.arange(4, dtype=np.float32), groups=None,
+                                 randomize=False, **config)
+        tokens, ages = next(iter(dataset))
+        self.assertEqual(tokens.shape, (2, 2, config['max_num_per_seq']))
+        np.testing.assert_array_equal(ages.numpy()[:, 0], [0, 1])
+
+if __name__ == '__main__':
+    unittest.main()
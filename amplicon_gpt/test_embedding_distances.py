@@ -0,0 +1,47 @@
+import unittest
+import numpy as np
+import scipy.stats
+from scipy.spatial.distance import pdist, squareform
+from skbio.stats.distance import DistanceMatrix
+import skbio.stats.ordination
+from amplicon_gpt.embedding_distances import compare_distances, embedding_pcoa, randomized_pcoa
+
+class TestEmbeddingDistances(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        points = rng.random((60, 3))
+        self.distances = squareform(pdist(points)) / np.sqrt(3)
+        self.embeddings = points @ rng.random((3, 8)) + 0.1 * rng.standard_normal((60, 8))
+        self.indices = np.sort(rng.choice(60, 40, replace=False))
+        self.ids = [f'S{i}' for i in self.indices]
+
+    def test_compare_distances(self):
+        embeddings = self.embeddings[self.indices]
+        result = compare_distances(embeddings, self.distances, self.indices, block_size=16)
+        pred = pdist(embeddings)
+        true = squareform(self.distances[np.ix_(self.indices, self.indices)])
+        self.assertEqual(result['num_pairs'], len(pred))
+        self.assertAlmostEqual(result['mantel_r'], scipy.stats.pearsonr(pred, true)[0])
+        self.assertAlmostEqual(result['spearman_rho'], scipy.stats.spearmanr(pred, true)[0], places=3)
+        # a BatchUnifrac like source gives the same result
+        source = lambda indices: self.distances[np.ix_(indices, indices)]
+        self.assertEqual(compare_distances(embeddings, source, self.indices, block_size=16), result)
+
+    def test_pcoa(self):
+        embeddings = self.embeddings[self.indices]
+        expected = skbio.stats.ordination.pcoa(DistanceMatrix(squareform(pdist(embeddings)), self.ids),
+                                               method='eigh', number_of_dimensions=3)
+        pcoa = embedding_pcoa(embeddings, self.ids)
+        np.testing.assert_allclose(pcoa.eigvals.values, expected.eigvals.values[:3])
+        np.testing.assert_allclose(np.abs(pcoa.samples.values), np.abs(expected.samples.values[:, :3]), atol=1e-8)
+
+        true = DistanceMatrix(self.distances[np.ix_(self.indices, self.indices)], self.ids)
+        expected = skbio.stats.ordination.pcoa(true, method='eigh', number_of_dimensions=3)
+        pcoa = randomized_pcoa(self.distances, self.indices, self.ids, block_size=16, seed=0)
+        np.testing.assert_allclose(pcoa.eigvals.values, expected.eigvals.values[:3], rtol=1e-4)
+        np.testing.assert_allclose(pcoa.proportion_explained.values,
+                                   expected.proportion_explained.values[:3], rtol=1e-4)
+
+if __name__ == '__main__':
+    unittest.main()
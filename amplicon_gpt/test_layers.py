@@ -0,0 +1,91 @@
+import unittest
+import numpy as np
+import tensorflow as tf
+from amplicon_gpt.layers import (
+    NucleotideSequenceEmbedding, ConvNucleotideEmbedding, SetSampleEncoder, PoolingByMultiheadAttention,
+    _chunked_attention
+)
+
+def _padded_outputs(layer):
+    rng = np.random.default_rng(0)
+    tokens = rng.integers(1, 5, size=(2, 3, 10)).astype(np.int32)
+    padded = np.zeros((2, 5, 10), dtype=np.int32)
+    padded[:, :3] = tokens
+    return layer(tokens).numpy(), layer(padded).numpy()
+
+class TestNucleotideSequenceEmbedding(unittest.TestCase):
+
+    def test_padding(self):
+        output, padded_output = _padded_outputs(NucleotideSequenceEmbedding(8, 0.0))
+        np.testing.assert_allclose(padded_output[:, :3], output, atol=1e-6)
+        np.testing.assert_array_equal(padded_output[:, 3:], 0.0)
+
+class TestConvNucleotideEmbedding(unittest.TestCase):
+
+    def test_padding(self):
+        output, padded_output = _padded_outputs(ConvNucleotideEmbedding(8, 0.0))
+        np.testing.assert_allclose(padded_output[:, :3], output, atol=1e-6)
+        np.testing.assert_array_equal(padded_output[:, 3:], 0.0)
+
+    def test_config(self):
+        layer = ConvNucleotideEmbedding(8, 0.1, kernel_size=3, num_conv_layers=2)
+        restored = ConvNucleotideEmbedding.from_config(layer.get_config())
+        self.assertEqual(restored.name, layer.name)
+        self.assertEqual(restored.kernel_size, 3)
+        self.assertEqual(len(restored.convs), 2)
+
+class TestAttention(unittest.TestCase):
+
+    def test_chunked_attention(self):
+        rng = np.random.default_rng(0)
+        query, key, value = [tf.constant(rng.normal(size=(2, 3, 10, 4)), dtype=tf.float32) for _ in range(3)]
+        key_mask = tf.constant(np.arange(10)[np.newaxis] < np.array([[10], [6]]))
+        scores = tf.einsum('bhqd,bhkd->bhqk', query, key).numpy()
+        scores[~np.broadcast_to(key_mask.numpy()[:, np.newaxis, np.newaxis], scores.shape)] = -np.inf
+        weights = np.exp(scores - scores.max(axis=-1, keepdims=True))
+        weights /= weights.sum(axis=-1, keepdims=True)
+        expected = np.einsum('bhqk,bhkd->bhqd', weights, value.numpy())
+        output = _chunked_attention(query, key, value, key_mask, chunk_size=4)
+        np.testing.assert_allclose(output.numpy(), expected, atol=1e-5)
+
+class TestSetSampleEncoder(unittest.TestCase):
+
+    def test_permutation_and_padding(self):
+        encoder = SetSampleEncoder(8, 0.0, 2, 2, 16, num_inducing_points=4)
+        rng = np.random.default_rng(0)
+        asvs = rng.normal(size=(1, 2000, 8)).astype(np.float32)
+        output = encoder(asvs).numpy()
+
+        order = rng.permutation(2000)
+        np.testing.assert_allclose(encoder(asvs[:, order]).numpy(), output[:, order], atol=1e-4)
+
+        padded = np.concatenate([asvs, np.zeros((1, 5, 8), dtype=np.float32)], axis=1)
+        mask = np.arange(2005)[np.newaxis] < 2000
+        np.testing.assert_allclose(encoder(padded, mask=mask).numpy()[:, :2000], output, atol=1e-4)
+
+    def test_ragged(self):
+        encoder = SetSampleEncoder(8, 0.0, 1, 2, 16, num_inducing_points=4)
+        rng = np.random.default_rng(0)
+        samples = [rng.normal(size=(n, 8)).astype(np.float32) for n in (3, 7)]
+        output = encoder(tf.ragged.constant(samples, ragged_rank=1))
+        for sample, sample_output in zip(samples, output):
+            np.testing.assert_allclose(sample_output.numpy(), encoder(sample[np.newaxis]).numpy()[0], atol=1e-5)
+
+class TestPoolingByMultiheadAttention(unittest.TestCase):
+
+    def test_permutation_and_padding(self):
+        pooling = PoolingByMultiheadAttention(2, 16, 0.0)
+        rng = np.random.default_rng(0)
+        asvs = rng.normal(size=(2, 50, 8)).astype(np.float32)
+        output = pooling(asvs).numpy()
+        self.assertEqual(output.shape, (2, 8))
+        np.testing.assert_allclose(pooling(asvs[:, rng.permutation(50)]).numpy(), output, atol=1e-5)
+
+        padded = np.concatenate([asvs, rng.normal(size=(2, 5, 8)).astype(np.float32)], axis=1)
+        mask = np.arange(55)[np.newaxis].repeat(2, axis=0) < 50
+        np.testing.assert_allclose(pooling(padded, mask=mask).numpy(), output, atol=1e-5)
+        ragged = tf.RaggedTensor.from_tensor(padded, lengths=[50, 50])
+        np.testing.assert_allclose(pooling(ragged).numpy(), output, atol=1e-5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+import unittest
+import numpy as np
+import tensorflow as tf
+from amplicon_gpt.losses import unifrac_bank_loss
+
+class TestUnifracBankLoss(unittest.TestCase):
+
+    def test_dense(self):
+        rng = np.random.default_rng(0)
+        y_pred = rng.random((3, 4)).astype(np.float32)
+        bank = rng.random((5, 4)).astype(np.float32)
+        y_true = rng.random((3, 5)).astype(np.float32)
+        # empty bank slots
+        y_true[:, [1, 4]] = np.nan
+
+        distances = np.linalg.norm(y_pred[:, None] - bank[None], axis=-1)
+        valid = ~np.isnan(y_true)
+        expected = np.sum(np.square(distances - y_true)[valid] / 2.0) / len(y_pred)
+
+        y_pred, bank = tf.constant(y_pred), tf.Variable(bank)
+        with tf.GradientTape() as tape:
+            loss = unifrac_bank_loss(tf.constant(y_true), y_pred, bank)
+        self.assertAlmostEqual(float(loss), expected, places=5)
+        # the bank is not trained
+        self.assertIsNone(tape.gradient(loss, bank))
+
+if __name__ == '__main__':
+    unittest.main()
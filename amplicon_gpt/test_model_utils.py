@@ -0,0 +1,54 @@
+import unittest
+import numpy as np
+import tensorflow as tf
+from amplicon_gpt.data_utils import batch_dist_dataset
+from amplicon_gpt.losses import unifrac_loss_var
+from amplicon_gpt.model_utils import MemoryBank, MemoryBankModel, transfer_learn_base
+
+class TestMemoryBankModel(unittest.TestCase):
+
+    def test_fit(self):
+        rng = np.random.default_rng(0)
+        x = rng.random((6, 3)).astype(np.float32)
+        distances = rng.random((6, 6)).astype(np.float32)
+        dataset = tf.data.Dataset.from_tensor_slices((np.arange(6, dtype=np.int64), x))
+        dataset = batch_dist_dataset(dataset, distances, batch_size=2, memory_bank_size=4)
+
+        inputs = tf.keras.Input((3,))
+        model = MemoryBankModel(inputs=inputs, outputs=tf.keras.layers.Dense(2)(inputs))
+        model.memory_bank = MemoryBank(4, 2)
+        # a zero learning rate keeps the outputs of the batches fixed
+        model.compile(optimizer=tf.keras.optimizers.SGD(learning_rate=0.0), loss=unifrac_loss_var)
+        history = model.fit(dataset, epochs=2, steps_per_epoch=3, verbose=0)
+
+        # six batches of the samples (0, 1), (2, 3), (4, 5), (0, 1), ... the
+        # bank carries over into the second epoch, the last two batches are
+        # in slots 0 and 1
+        outputs = model.predict(x, verbose=0)
+        np.testing.assert_allclose(model.memory_bank.embeddings.numpy(), outputs[[2, 3, 4, 5]],
+                                   rtol=1e-5, atol=1e-6)
+        self.assertGreater(history.history['bank_loss'][1], 0)
+        # the first batch of the second epoch compares to the last two of the first
+        _, (_, bank_distances, slot) = next(iter(dataset.skip(3)))
+        self.assertEqual(int(slot), 1)
+        np.testing.assert_array_equal(bank_distances.numpy(), distances[np.ix_([0, 1], [4, 5, 2, 3])])
+
+class TestSetBaseModel(unittest.TestCase):
+
+    def test_permutation_invariant(self):
+        # no dropout, the encoding blocks are always called with training=True
+        model = transfer_learn_base(None, 128, 2, 6, 0.0, None, input_type='tokens', sample_encoder='isab',
+                                    num_inducing_points=4)
+        rng = np.random.default_rng(0)
+        tokens = rng.integers(1, 5, size=(2, 7, 6)).astype(np.int32)
+        # the last ASVs of the second sample are padding
+        tokens[1, 5:] = 0
+        output = model(tokens, training=False).numpy()
+
+        shuffled = tokens.copy()
+        shuffled[0] = tokens[0, rng.permutation(7)]
+        shuffled[1, :5] = tokens[1, rng.permutation(5)]
+        np.testing.assert_allclose(model(shuffled, training=False).numpy(), output, atol=1e-5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import io
+import os
+import tempfile
+import unittest
+import numpy as np
+from scipy.sparse import csc_matrix
+from skbio import TreeNode
+from skbio.diversity import beta_diversity
+from amplicon_gpt.phylogeny import _build_ancestors, BatchUnifrac
+
+class TestBatchUnifrac(unittest.TestCase):
+
+    def test_batch_unifrac(self):
+        newick = '(((O0:0.5,O1:0.3):0.2,O2:0.7):0.1,((O3:0.4,O4:0.6):0.8,O5:0.2):0.3);'
+        o_ids = ['O0', 'O1', 'O2', 'O3', 'O4', 'O5']
+        data = np.array([[1, 0, 3, 0, 0],
+                         [0, 2, 1, 0, 1],
+                         [4, 0, 0, 0, 0],
+                         [0, 1, 0, 2, 0],
+                         [0, 0, 2, 0, 1],
+                         [1, 1, 0, 0, 0]])
+        with tempfile.TemporaryDirectory() as tmp:
+            tree_path = os.path.join(tmp, 'tree.nwk')
+            with open(tree_path, 'w') as f:
+                f.write(newick)
+            phylogeny = _build_ancestors(tree_path, o_ids)
+
+        matrix = csc_matrix(data)
+        ancestors = csc_matrix((np.ones(len(phylogeny['ancestors_indices']), dtype=np.float32),
+                                phylogeny['ancestors_indices'], phylogeny['ancestors_indptr']),
+                               shape=(len(phylogeny['lengths']), len(o_ids)))
+        batch_unifrac = BatchUnifrac(phylogeny['lengths'], ancestors, matrix.indptr, matrix.indices)
+
+        s_ids = ['S%d' % i for i in range(data.shape[1])]
+        expected = beta_diversity('unweighted_unifrac', data.T, ids=s_ids, taxa=o_ids,
+                                  tree=TreeNode.read(io.StringIO(newick))).data
+        sample_indices = np.array([3, 0, 4, 1])
+        np.testing.assert_allclose(batch_unifrac(sample_indices),
+                                   expected[np.ix_(sample_indices, sample_indices)], atol=1e-6)
+
+if __name__ == '__main__':
+    unittest.main()
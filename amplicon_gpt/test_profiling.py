@@ -0,0 +1,31 @@
+import unittest
+import numpy as np
+import tensorflow as tf
+from amplicon_gpt.profiling import StepProfiler, _count_asvs
+
+class TestProfiling(unittest.TestCase):
+
+    def test_count_asvs(self):
+        tokens = np.zeros((2, 4, 3), dtype=np.int32)
+        tokens[0, :3, 0] = 1
+        tokens[1, :1, 2] = 2
+        self.assertEqual([int(v) for v in _count_asvs(tf.constant(tokens))], [2, 4, 8])
+        indices = tf.ragged.constant([[0, 5], [3], [4, 1, 2]], dtype=tf.int64)
+        self.assertEqual([int(v) for v in _count_asvs(indices)], [3, 6, 9])
+        # only the first input has the ASV axis
+        inputs = (tf.constant([['a', ''], ['b', 'c']]), tf.constant([[1.0, 0.0], [0.5, 0.5]]))
+        self.assertEqual([int(v) for v in _count_asvs(inputs)], [2, 3, 4])
+        self.assertEqual([int(v) for v in _count_asvs(tf.zeros((5, 8)))], [5, 0, 0])
+
+    def test_instrument(self):
+        x = np.zeros((6, 3, 2), dtype=np.int32)
+        x[:, :2] = 1
+        dataset = tf.data.Dataset.from_tensor_slices((x, np.arange(6))).batch(4)
+        profiler = StepProfiler('unused')
+        batches = list(profiler.instrument(dataset))
+        self.assertEqual(len(batches), 2)
+        np.testing.assert_array_equal(batches[1][1], [4, 5])
+        self.assertEqual([record[1:] for record in profiler.ready], [(4, 8, 12), (2, 4, 6)])
+
+if __name__ == '__main__':
+    unittest.main()
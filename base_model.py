@@ -7,12 +7,10 @@ import os
 import numpy as np
 import tensorflow as tf
 from amplicon_gpt.model_utils import load_full_base_model
-from amplicon_gpt.data_utils import create_base_sequencing_data
-from amplicon_gpt.losses import _pairwise_distances
-from unifrac import unweighted
-from biom import load_table
-from skbio.stats.distance import DistanceMatrix
-import skbio.stats.ordination
+import amplicon_gpt._parameter_descriptions as desc
+from amplicon_gpt.data_utils import create_base_sequencing_data, create_embedding_dataset, get_unifrac_distances
+from amplicon_gpt.biom_reader import read_ids
+from amplicon_gpt.embedding_distances import compare_distances, embedding_pcoa, randomized_pcoa
 
 @click.group('base_model')
 @click.pass_context
@@ -25,25 +23,100 @@ def base_model(ctx):
 def unifrac_distance(ctx, config_json):
     with open(config_json) as f:
         config = json.load(f)
-    table = load_table(config['table_path'])
+    sample_ids = read_ids(config['table_path'])
     dataset = create_base_sequencing_data(**config)
     base_model = load_full_base_model(**config)
-    total_samples = int(table.shape[1] / config['batch_size']) * config['batch_size']
+    total_samples = int(len(sample_ids) / config['batch_size']) * config['batch_size']
     
+    # all samples unless num_samples is given, the distances are only
+    # visited block by block so the whole table fits
     sample_indices = np.arange(total_samples)
-    np.random.shuffle(sample_indices)
-    sample_indices = sample_indices[:config['num_samples']]
-    pred = base_model.predict(dataset)
-
-    pred = tf.constant(pred[sample_indices])
-    distances = _pairwise_distances(pred, squared=False)
-    pred_unifrac_distances = DistanceMatrix(distances.numpy(), table.ids(axis='sample')[sample_indices], validate=False)
-    pred_pcoa = skbio.stats.ordination.pcoa(pred_unifrac_distances, method='eigh', inplace=False)
+    num_samples = config.get('num_samples')
+    if num_samples is not None and num_samples < total_samples:
+        rng = np.random.default_rng(config.get('seed'))
+        sample_indices = np.sort(rng.choice(total_samples, num_samples, replace=False))
+    pred = base_model.predict(dataset)[sample_indices]
+    dimensions = config.get('pcoa_dimensions', 3)
+
+    pred_pcoa = embedding_pcoa(pred, sample_ids[sample_indices], number_of_dimensions=dimensions)
     pred_pcoa.write(config['pred_pcoa_path'])
 
-    true_unifrac_distances = unweighted(config['table_path'], config['tree_path']).filter(table.ids(axis='sample')[sample_indices])
-    true_pcoa = skbio.stats.ordination.pcoa(true_unifrac_distances, method='eigh', inplace=False)
+    distances = get_unifrac_distances(**config)
+    true_pcoa = randomized_pcoa(distances, sample_indices, sample_ids[sample_indices],
+                                number_of_dimensions=dimensions, seed=config.get('seed'))
     true_pcoa.write(config['true_pcoa_path'])
+    print(compare_distances(pred, distances, sample_indices))
+
+def _save_shard(path, array):
+    # write next to the shard and rename so a killed run never leaves a
+    # partial shard behind
+    tmp_path = f'{path}.tmp.npy'
+    np.save(tmp_path, array, allow_pickle=False)
+    os.replace(tmp_path, path)
+
+def _complete_shards(output_dir):
+    shard = 0
+    while os.path.exists(os.path.join(output_dir, f'embeddings-{shard:05d}.npy')):
+        shard += 1
+    return shard
+
+@base_model.command('embed', short_help=desc.EMBED)
+@click.pass_context
+@click.option('--config-json', required=True, type=click.Path(exists=True))
+@click.option('--output-dir', required=True, type=click.Path(), help=desc.OUTPUT_DIR)
+@click.option('--encoder-path', default=None, type=click.Path(exists=True), help=desc.ENCODER_PATH)
+@click.option('--batch-size', default=None, type=int, help=desc.BATCH_SIZE)
+@click.option('--shard-size', default=16384, type=int, help=desc.SHARD_SIZE)
+def embed(ctx, config_json, output_dir, encoder_path, batch_size, shard_size):
+    with open(config_json) as f:
+        config = json.load(f)
+    if encoder_path is not None:
+        config['base_model_path'] = encoder_path
+    if batch_size is not None:
+        config['batch_size'] = batch_size
+    batch_size = config['batch_size']
+    shard_size = -(-shard_size // batch_size) * batch_size
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, 'manifest.json')
+    if os.path.exists(manifest_path):
+        # resuming, the shard layout has to match the previous run
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        for path in ['base_model_path', 'table_path']:
+            if os.path.abspath(manifest[path]) != os.path.abspath(config[path]):
+                raise click.UsageError(f'{path} {config[path]} does not match the {path} '
+                                       f'{manifest[path]} of the previous run in {output_dir}')
+        shard_size = manifest['shard_size']
+        if shard_size % batch_size:
+            raise click.UsageError(f'batch size must divide the shard size ({shard_size}) of the previous run')
+    else:
+        with open(manifest_path, 'w') as f:
+            json.dump({'base_model_path': config['base_model_path'],
+                       'table_path': config['table_path'],
+                       'shard_size': shard_size}, f)
+
+    shard = _complete_shards(output_dir)
+    start = shard * shard_size
+    dataset, sample_ids = create_embedding_dataset(start=start, **config)
+    if start >= len(sample_ids):
+        print('all samples are already embedded')
+        return
+    print(f'embedding samples {start} to {len(sample_ids)}...')
+    encoder = load_full_base_model(**config)
+
+    embeddings = []
+    for tokens in dataset:
+        embeddings.append(encoder(tokens, training=False).numpy())
+        end = min(start + shard_size, len(sample_ids))
+        if len(embeddings) * batch_size >= end - start:
+            # drop the copies filling the last batch
+            _save_shard(os.path.join(output_dir, f'sample_ids-{shard:05d}.npy'),
+                        np.asarray(sample_ids[start:end]).astype(np.str_))
+            _save_shard(os.path.join(output_dir, f'embeddings-{shard:05d}.npy'),
+                        np.concatenate(embeddings)[:end - start])
+            embeddings = []
+            shard, start = shard + 1, end
 
 def main():
     base_model(prog_name='base_model')
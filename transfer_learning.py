@@ -1,17 +1,22 @@
 import click
 import os
+import sys
 import json
 import numpy as np
 import pandas as pd
 import os
 import tensorflow as tf
 import amplicon_gpt._parameter_descriptions as desc
-from amplicon_gpt.callbacks import MAE_Scatter, mean_absolute_error, mean_confidence_interval, Accuracy, ProjectEncoder
+from amplicon_gpt.callbacks import MAE_Scatter, mean_absolute_error, mean_confidence_interval, Accuracy, ProjectEncoder, plot_curves
 from amplicon_gpt.data_utils import (
     create_sequencing_data, create_dataset, create_veg_sequencing_data, create_veg_dataset, create_unifrac_sequencing_data,
-    get_sequencing_dataset, get_unifrac_dataset, combine_seq_dist_dataset, batch_dist_dataset
+    get_sequencing_dataset, get_observation_ids, get_unifrac_distances, combine_seq_dist_dataset, batch_dist_dataset,
+    get_token_inputs, save_tokenizer, replica_dist_dataset
 )
-from amplicon_gpt.model_utils import transfer_learn_feature_regression, transfer_learn_feature_classification, transfer_learn_base
+from amplicon_gpt.model_utils import transfer_learn_feature_regression, transfer_learn_feature_classification, transfer_learn_base, load_asv_embeddings
+from amplicon_gpt.feature_store import load_feature_store
+from amplicon_gpt.distributed import get_strategy, is_chief, launch_local_workers, worker_save_path
+from amplicon_gpt.profiling import StepProfiler
 
 # Allow using -h to show help information
 # https://click.palletsprojects.com/en/7.x/documentation/#help-parameter-customization
@@ -42,7 +47,12 @@ def transfer_learning():
     required=False, default=False, is_flag=True,
     help=desc.OUTPUT_MODEL_SUMMARY
 )
-def regression(config_json, continue_training, output_model_summary):
+@click.option(
+    '--profile',
+    required=False, default=False, is_flag=True,
+    help=desc.PROFILE
+)
+def regression(config_json, continue_training, output_model_summary, profile):
     with open(config_json) as f:
         config = json.load(f)
 
@@ -51,9 +61,15 @@ def regression(config_json, continue_training, output_model_summary):
         initial_epoch=0 # load finishing epoch from root directory
 
     (training_seq, training_age), (val_seq, val_age) = create_sequencing_data(split_percent=config['validation_percent'], **config)
-    training_dataset = create_dataset(training_seq, training_age, groups=None, randomize=True, repeat=config['mini_epochs'], **config)
-    validation_dataset = create_dataset(val_seq, val_age, groups=None, randomize=False, **config)
-    model = transfer_learn_feature_regression(continue_training, **config)
+    asv_embeddings = load_asv_embeddings(**config) if config.get('cache_asv_embeddings') else None
+    training_store, val_store, feature_dim = None, None, None
+    if config.get('use_feature_store'):
+        training_store = load_feature_store(training_seq, asv_embeddings=asv_embeddings, **config)
+        val_store = load_feature_store(val_seq, asv_embeddings=asv_embeddings, **config)
+        feature_dim = training_store.values.shape[1]
+    training_dataset = create_dataset(training_seq, training_age, groups=None, randomize=True, repeat=config['mini_epochs'], feature_store=training_store, **config)
+    validation_dataset = create_dataset(val_seq, val_age, groups=None, randomize=False, feature_store=val_store, **config)
+    model = transfer_learn_feature_regression(continue_training, asv_embeddings=asv_embeddings, feature_dim=feature_dim, **config)
 
     if output_model_summary:
         model.summary()
@@ -63,15 +79,19 @@ def regression(config_json, continue_training, output_model_summary):
     else:
         patience=10
 
-    t_dataset = create_dataset(training_seq, training_age, groups=None, randomize=False, **config)
+    t_dataset = create_dataset(training_seq, training_age, groups=None, randomize=False, feature_store=training_store, **config)
     # mae_dataset = create_dataset(sequencing_data, age_data, groups=None, randomize=False, **config)
+    callbacks = [tf.keras.callbacks.EarlyStopping(monitor='val_loss', start_from_epoch=0, patience=patience, mode='min'),
+                 MAE_Scatter(**config, title='training', dataset=t_dataset),
+                 MAE_Scatter(**config, title='validation', dataset=validation_dataset)]
+    if profile:
+        profiler = StepProfiler(**config)
+        training_dataset = profiler.instrument(training_dataset)
+        callbacks += profiler.callbacks()
     model.fit(
         training_dataset, validation_data=validation_dataset,
          epochs=config['epochs'], initial_epoch=0, batch_size=config['batch_size'],
-         callbacks=[
-                    tf.keras.callbacks.EarlyStopping(monitor='val_loss', start_from_epoch=0, patience=patience, mode='min'),
-                    MAE_Scatter(**config, title='training', dataset=t_dataset),
-                    MAE_Scatter(**config, title='validation', dataset=validation_dataset)]
+         callbacks=callbacks
     )
     model.save(os.path.join(config['root_path'], 'model.keras'), save_format='keras')
 
@@ -92,27 +112,83 @@ def regression(config_json, continue_training, output_model_summary):
     required=False, default=False, is_flag=True,
     help=desc.OUTPUT_MODEL_SUMMARY
 )
-def unifrac(config_json, continue_training, output_model_summary):
+@click.option(
+    '--local-workers',
+    required=False, default=None, type=int,
+    help=desc.LOCAL_WORKERS
+)
+@click.option(
+    '--profile',
+    required=False, default=False, is_flag=True,
+    help=desc.PROFILE
+)
+def unifrac(config_json, continue_training, output_model_summary, local_workers, profile):
+    if local_workers and 'TF_CONFIG' not in os.environ:
+        sys.exit(launch_local_workers(local_workers))
     with open(config_json) as f:
         config = json.load(f)
 
+    strategy = get_strategy(**config)
+    num_replicas = strategy.num_replicas_in_sync
+    if num_replicas > 1:
+        if config['batch_size'] % num_replicas != 0:
+            raise click.UsageError(f"batch_size {config['batch_size']} is not divisible by the {num_replicas} replicas")
+        if config.get('memory_bank_size'):
+            raise click.UsageError('memory_bank_size is not supported in distributed training')
+        # every worker must build the same global batches
+        config.setdefault('seed', 0)
+
     seq_dataset = get_sequencing_dataset(**config)
-    unifrac_dataset = get_unifrac_dataset(**config)
-    sequence_tokenizer = tf.keras.layers.TextVectorization(max_tokens=10, split='character', output_mode='int', output_sequence_length=100)
-    sequence_tokenizer.adapt(seq_dataset.take(1))
-    dataset = combine_seq_dist_dataset(seq_dataset, unifrac_dataset, **config)
+    distances = get_unifrac_distances(**config)
+    if config.get('input_type') == 'tokens':
+        # tokenize outside of the model, the tokenizer is saved next to it
+        sequence_tokenizer = None
+        get_inputs = get_token_inputs(**config)
+        if is_chief(strategy):
+            save_tokenizer(os.path.join(config['root_path'], 'tokenizer.json'), **config)
+    else:
+        # the base model takes the ASV strings
+        o_ids = tf.constant(get_observation_ids(**config))
+        get_asv_id = lambda x: tf.gather(o_ids, tf.expand_dims(x, -1))
+        seq_dataset = seq_dataset.map(get_asv_id, num_parallel_calls=tf.data.AUTOTUNE)
+        sequence_tokenizer = tf.keras.layers.TextVectorization(max_tokens=10, split='character', output_mode='int', output_sequence_length=100)
+        sequence_tokenizer.adapt(seq_dataset.take(1))
+        get_inputs = None
+    dataset = combine_seq_dist_dataset(seq_dataset, **config)
 
     size = seq_dataset.cardinality().numpy()
     batch_size = config['batch_size']
     train_size = int(size*config['train_percent']/batch_size)*batch_size
 
     training_dataset = dataset.take(train_size).prefetch(tf.data.AUTOTUNE)
-    training_dataset = batch_dist_dataset(training_dataset, shuffle=True, **config)
-    
     val_data = dataset.skip(train_size).prefetch(tf.data.AUTOTUNE)
-    validation_dataset = batch_dist_dataset(val_data, **config)
+    profiler, instrument = None, lambda dataset: dataset
+    if profile:
+        logdir = config.get('logdir', os.path.join(config['root_path'], 'logs'))
+        if not is_chief(strategy):
+            # every worker profiles its own steps
+            logdir = os.path.join(logdir, f'worker-{strategy.cluster_resolver.task_id}')
+        profiler = StepProfiler(**dict(config, logdir=logdir))
+        instrument = profiler.instrument
+    steps = {}
+    if num_replicas > 1:
+        # distributed datasets have no known length
+        steps = {'steps_per_epoch': train_size // batch_size, 'validation_steps': (size - train_size) // batch_size}
+        training_dataset = strategy.distribute_datasets_from_function(
+            lambda context: instrument(replica_dist_dataset(training_dataset, distances, input_context=context, shuffle=True, get_inputs=get_inputs, **config)))
+        validation_dataset = strategy.distribute_datasets_from_function(
+            lambda context: replica_dist_dataset(val_data, distances, input_context=context, get_inputs=get_inputs, **config))
+    else:
+        if config.get('memory_bank_size'):
+            # the memory bank dataset is infinite (the bank carries over the epochs)
+            steps = {'steps_per_epoch': (config.get('repeat') or 1) * train_size // batch_size}
+        training_dataset = instrument(batch_dist_dataset(training_dataset, distances, shuffle=True, get_inputs=get_inputs, **config))
+        # the memory bank is only used in training
+        validation_dataset = batch_dist_dataset(val_data, distances, get_inputs=get_inputs, **dict(config, memory_bank_size=None))
 
-    model = transfer_learn_base(sequence_tokenizer=sequence_tokenizer, load_prev_path=False, **config)
+    with strategy.scope():
+        model = transfer_learn_base(sequence_tokenizer=sequence_tokenizer, load_prev_path=False,
+                                    **dict(config, batch_size=batch_size // num_replicas))
     
     if output_model_summary:
         model.summary()
@@ -122,21 +198,28 @@ def unifrac(config_json, continue_training, output_model_summary):
     else:
         patience=10
     config['repeat'] = 1
-    
+
+    callbacks = [tf.keras.callbacks.EarlyStopping(monitor='val_loss', start_from_epoch=0, patience=patience, mode='min'),
+                 ProjectEncoder(seq_dataset, distances=distances, get_inputs=get_inputs, chief=is_chief(strategy), **config)]
+    if profiler is not None:
+        callbacks += profiler.callbacks()
     model.fit(
         training_dataset, validation_data=validation_dataset,
-        epochs=config['epochs'], initial_epoch=0, batch_size=config['batch_size'],
-        callbacks=[
-                    tf.keras.callbacks.EarlyStopping(monitor='val_loss', start_from_epoch=0, patience=patience, mode='min'),
-                    ProjectEncoder(seq_dataset.ragged_batch(32),**config)
-        ]
+        epochs=config['epochs'], initial_epoch=0,
+        callbacks=callbacks, **steps
     )
-    model.save(os.path.join(config['root_path'], 'model.keras'), save_format='keras')
+    with worker_save_path(os.path.join(config['root_path'], 'model.keras'), is_chief(strategy)) as path:
+        model.save(path, save_format='keras')
 
 @transfer_learning.command('veg_classifier')
 @click.pass_context
 @click.option('--config-json', type=click.Path(exists=True))
-def veg_classifier(ctx, config_json):
+@click.option(
+    '--profile',
+    required=False, default=False, is_flag=True,
+    help=desc.PROFILE
+)
+def veg_classifier(ctx, config_json, profile):
     with open(config_json) as f:
         config = json.load(f)
     training_percent = config['training_percent']
@@ -146,21 +229,31 @@ def veg_classifier(ctx, config_json):
     epochs = config['epochs']
 
     sequencing_data, categories = create_veg_sequencing_data(**config)
-    training_dataset = create_veg_dataset(sequencing_data, categories, randomize=True, limit_size=training_percent, **config)
-    validation_dataset = create_veg_dataset(sequencing_data, categories, randomize=True, limit_size=validation_percent, **config)
-    model = transfer_learn_feature_classification(**config)
+    asv_embeddings = load_asv_embeddings(**config) if config.get('cache_asv_embeddings') else None
+    feature_store, feature_dim = None, None
+    if config.get('use_feature_store'):
+        feature_store = load_feature_store(sequencing_data, asv_embeddings=asv_embeddings, **config)
+        feature_dim = feature_store.values.shape[1]
+    training_dataset = create_veg_dataset(sequencing_data, categories, randomize=True, limit_size=training_percent, feature_store=feature_store, **config)
+    validation_dataset = create_veg_dataset(sequencing_data, categories, randomize=True, limit_size=validation_percent, feature_store=feature_store, **config)
+    model = transfer_learn_feature_classification(asv_embeddings=asv_embeddings, feature_dim=feature_dim, **config)
     model.summary()
 
-    acc_dataset = create_veg_dataset(sequencing_data, categories, randomize=False, limit_size=.5, **config)
+    acc_dataset = create_veg_dataset(sequencing_data, categories, randomize=False, limit_size=.5, feature_store=feature_store, **config)
     if 'patience' in config:
         patience=config['patience']
     else:
         patience=10
+    callbacks = [tf.keras.callbacks.EarlyStopping(monitor='val_accuracy', start_from_epoch=0, patience=patience, mode='max'),
+                 Accuracy(**config, dataset=acc_dataset)]
+    if profile:
+        profiler = StepProfiler(**config)
+        training_dataset = profiler.instrument(training_dataset)
+        callbacks += profiler.callbacks()
     model.fit(
         training_dataset, validation_data=validation_dataset,
          epochs=epochs, initial_epoch=0, batch_size=batch_size,
-         callbacks=[tf.keras.callbacks.EarlyStopping(monitor='val_accuracy', start_from_epoch=0, patience=patience, mode='max'),
-                    Accuracy(**config, dataset=acc_dataset)]
+         callbacks=callbacks
     )
     model.save(os.path.join(config['root_path'], 'model.keras'), save_format='keras')
 
@@ -172,44 +265,16 @@ def veg_auc(ctx, config_json):
         config = json.load(f)
     acc_percent = config['acc_percent']
     sequencing_data, categories = create_veg_sequencing_data(**config)
-    model = transfer_learn_feature_classification(**config)
+    asv_embeddings = load_asv_embeddings(**config) if config.get('cache_asv_embeddings') else None
+    feature_store, feature_dim = None, None
+    if config.get('use_feature_store'):
+        feature_store = load_feature_store(sequencing_data, asv_embeddings=asv_embeddings, **config)
+        feature_dim = feature_store.values.shape[1]
+    model = transfer_learn_feature_classification(asv_embeddings=asv_embeddings, feature_dim=feature_dim, **config)
     model.summary()
-    acc_dataset = create_veg_dataset(sequencing_data, categories, randomize=False, limit_size=acc_percent, **config)
-    fname=os.path.join('agp/veg-cat', 
-                                f'auc.png')
-    import sklearn
-    import matplotlib.pyplot as plt
-    def plot_prc(name, labels, predictions, **kwargs):
-        precision, recall, _ = sklearn.metrics.precision_recall_curve(labels, predictions)
-
-        plt.plot(precision, recall, label=name, linewidth=2, **kwargs)
-        plt.xlabel('Precision')
-        plt.ylabel('Recall')
-        plt.grid(True)
-        ax = plt.gca()
-        ax.set_aspect('equal')
-        plt.savefig(fname)
-
-    def plot_roc(name, labels, predictions, **kwargs):
-        fp, tp, _ = sklearn.metrics.roc_curve(labels, predictions)
-
-        plt.plot(100*fp, 100*tp, label=name, linewidth=2, **kwargs)
-        plt.xlabel('False positives [%]')
-        plt.ylabel('True positives [%]')
-        plt.xlim([-0.5,20])
-        plt.ylim([80,100.5])
-        plt.grid(True)
-        ax = plt.gca()
-        ax.set_aspect('equal')
-        fname=os.path.join('agp/veg-cat', 
-                                f'roc.png')
-        plt.savefig(fname)
-
-
-    pred_cat = tf.squeeze(model.predict(acc_dataset)).numpy()
-    true_cat = np.concatenate([tf.squeeze(ys).numpy() for (_, ys) in acc_dataset])
-    plot_prc('AUC', true_cat, pred_cat)
-    plot_roc('ROC', true_cat, pred_cat)
+    acc_dataset = create_veg_dataset(sequencing_data, categories, randomize=False, limit_size=acc_percent, feature_store=feature_store, **config)
+    plot_curves(acc_dataset, model, os.path.join('agp/veg-cat', 'auc.png'),
+                os.path.join('agp/veg-cat', 'roc.png'))
 
 
 @transfer_learning.command('mae_plot')
@@ -220,8 +285,13 @@ def mae_plot(ctx, config_json):
         config = json.load(f)
     config['load_prev_path'] = True
     sequencing_data, age_data, groups = create_sequencing_data(**config)
-    model = transfer_learn_feature_regression(**config)
-    mae_dataset = create_dataset(sequencing_data, age_data, groups=None, randomize=False, limit_size=1.0, **config)
+    asv_embeddings = load_asv_embeddings(**config) if config.get('cache_asv_embeddings') else None
+    feature_store, feature_dim = None, None
+    if config.get('use_feature_store'):
+        feature_store = load_feature_store(sequencing_data, asv_embeddings=asv_embeddings, **config)
+        feature_dim = feature_store.values.shape[1]
+    model = transfer_learn_feature_regression(asv_embeddings=asv_embeddings, feature_dim=feature_dim, **config)
+    mae_dataset = create_dataset(sequencing_data, age_data, groups=None, randomize=False, limit_size=1.0, feature_store=feature_store, **config)
     mean_absolute_error(mae_dataset, model, config['final_figure_path'], config['s_type'])
 
 def main():